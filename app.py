@@ -1,118 +1,2692 @@
 import streamlit as st
 import pandas as pd
 import gspread
+from gspread.utils import rowcol_to_a1, a1_to_rowcol, numericise_all, absolute_range_name
+from gspread.urls import DRIVE_FILES_API_V3_URL
 from google.oauth2.service_account import Credentials
-from datetime import date
+from datetime import date, datetime, timedelta
 import numpy as np 
 import time
-from collections import defaultdict
+import json
+import os
+import sqlite3
+import threading
+import random
+import requests
+import functools
+import heapq
+import itertools
+import zlib
+from collections import defaultdict, deque
+
+from formato import formato_argentino, formato_numero, parsear_numero
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # Sin pyarrow no se guardan snapshots
+    pa = None
+
+# =====================
+# CONFIGURACIÓN OPTIMIZADA GOOGLE SHEETS
+# =====================
+SHEET_NAME = "textil_sistema"
+
+# Esquema de cada hoja: columnas (en orden) y su tipo
+#   entero / numero: numéricos; moneda: montos, también en formato argentino ("USD 1.234,50")
+#   fecha: fechas; categoria: pocos valores repetidos; texto: cadenas
+#   curva: cantidades por talle codificadas en una celda (ver codificar_talles)
+ESQUEMA = {
+    "Compras": {
+        "ID": "entero", "Fecha": "fecha", "Proveedor": "categoria", "Tipo de tela": "texto",
+        "Total metros": "numero", "Precio por metro": "moneda", "Total rollos": "entero",
+        "Valor total": "moneda", "Precio promedio rollo": "moneda"
+    },
+    "Detalle_Compras": {"ID Compra": "entero", "Tipo de tela": "texto", "Color": "texto", "Rollos": "entero"},
+    "Stock": {"Tipo de tela": "texto", "Color": "texto", "Rollos": "entero"},
+    "Cortes": {
+        "ID": "entero", "Fecha": "fecha", "Número de corte": "texto", "Artículo": "texto",
+        "Tipo de tela": "texto", "Total rollos": "entero", "Consumo total": "numero",
+        "Prendas": "entero", "Consumo por prenda": "numero"
+    },
+    "Detalle_Cortes": {
+        "ID Corte": "entero", "Color": "texto", "Rollos": "entero", "Tipo de tela": "texto", "Talles": "curva"
+    },
+    "Talleres": {
+        "ID Corte": "entero", "Número de Corte": "texto", "Artículo": "texto", "Taller": "categoria",
+        "Fecha Envío": "fecha", "Fecha Entrega": "fecha", "Prendas Recibidas": "entero",
+        "Prendas Falladas": "entero", "Estado": "categoria", "Días Transcurridos": "entero"
+    },
+    "Nombre_talleres": {"Taller": "texto"},
+    "Historial_Entregas": {"ID Corte": "entero", "Fecha": "fecha"},
+    "Devoluciones": {"ID Corte": "entero", "Fecha": "fecha"},
+    "Proveedores": {"Nombre": "texto"},
+    # Libro de movimientos de inventario (solo se agregan filas): Rollos con signo.
+    # Costo rollo: USD por rollo de las compras (valorización del stock)
+    "Movimientos": {
+        "Fecha": "fecha", "Tipo": "categoria", "ID Compra": "entero", "ID Corte": "entero",
+        "Tipo de tela": "texto", "Color": "texto", "Rollos": "entero", "Costo rollo": "moneda"
+    },
+}
+
+# Talles de la curva de un corte, en el orden en que se codifican (solo se agregan al final)
+TALLES = [5, 6, 7, 8, 9, 10]
+ANCHO_TALLE = 4  # Dígitos por talle en el código de la curva
+
+# Encabezados por defecto de las hojas que se crean desde la app
+COLUMNAS = {hoja: list(columnas) for hoja, columnas in ESQUEMA.items()}
+
+# Hojas del spreadsheet que usa la app
+HOJAS_REPLICA = [
+    "Compras", "Detalle_Compras", "Stock", "Cortes", "Detalle_Cortes", "Talleres",
+    "Nombre_talleres", "Historial_Entregas", "Devoluciones", "Proveedores", "Movimientos"
+]
+
+# Historial particionado por año: la hoja "caliente" guarda los años abiertos y cada año
+# cerrado pasa a su hoja "fría" (Compras_2023, ...). El detalle sigue a su cabecera por ID
+HOJAS_ARCHIVO = {
+    "Compras": {"Detalle_Compras": "ID Compra"},
+    "Cortes": {"Detalle_Cortes": "ID Corte", "Historial_Entregas": "ID Corte"},
+}
+HOJAS_PARTICIONADAS = [h for cabecera, hijos in HOJAS_ARCHIVO.items() for h in [cabecera, *hijos]]
+
+# Backend de almacenamiento: "gspread" (Google Sheets) o "falso" (en memoria / disco)
+BACKEND = os.environ.get("TEXTIL_BACKEND", "gspread")
+
+def hoja_base(hoja_nombre):
+    """Hoja de la que es partición fría (Compras_2023 -> Compras), o la misma hoja"""
+    base, _, anio = hoja_nombre.rpartition("_")
+    if base in HOJAS_PARTICIONADAS and len(anio) == 4 and anio.isdigit():
+        return base
+    return hoja_nombre
+
+def es_particion_fria(hoja_nombre):
+    return hoja_base(hoja_nombre) != hoja_nombre
+
+def _valor_celda(valor):
+    """Convierte un valor de pandas/numpy a un tipo aceptado por la API"""
+    tipo = type(valor)
+    if tipo is str or tipo is int:
+        return valor  # Caso más común: se llama por cada celda que se escribe o se replica
+    if isinstance(valor, np.generic):
+        valor = valor.item()
+    if pd.isna(valor):
+        return ""
+    if isinstance(valor, (datetime, date)):
+        return valor.strftime("%Y-%m-%d")
+    return valor
+
+def _normalizar(valor):
+    """Valor comparable entre lo que se envió y lo que devuelve la hoja (100 == 100.0 == "100")"""
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return str(valor).strip()
+
+def tipar_hoja(df, hoja_nombre):
+    """Convierte una sola vez las columnas de la hoja a los tipos declarados en ESQUEMA"""
+    for columna, tipo in ESQUEMA.get(hoja_base(hoja_nombre), {}).items():
+        if columna not in df.columns:
+            continue
+        serie = df[columna]
+        if tipo == "entero":
+            df[columna] = pd.to_numeric(serie, errors="coerce").fillna(0).astype("int64")
+        elif tipo == "numero":
+            df[columna] = pd.to_numeric(serie, errors="coerce")
+        elif tipo == "moneda":
+            df[columna] = parsear_numero(serie)
+        elif tipo == "fecha":
+            df[columna] = pd.to_datetime(serie, errors="coerce")
+        elif tipo == "categoria":
+            df[columna] = serie.fillna("").astype(str).astype("category")
+        else:
+            df[columna] = serie.fillna("").astype(str)
+    return df
+
+def codificar_talles(cantidades):
+    """Curva [prendas por talle, en el orden de TALLES] -> "T" + ANCHO_TALLE dígitos por talle
+    ("T001200150000..."). La T evita que Sheets la lea como número; "" si no hay prendas"""
+    if not cantidades or not any(cantidades):
+        return ""
+    if len(cantidades) > len(TALLES) or max(cantidades) >= 10 ** ANCHO_TALLE or min(cantidades) < 0:
+        raise ValueError(f"Curva de talles fuera de rango: {list(cantidades)}")
+    return "T" + "".join(f"{int(c):0{ANCHO_TALLE}d}" for c in cantidades)
+
+def matriz_talles(codigos):
+    """Decodifica las curvas en una matriz de enteros (una fila por código, una columna por
+    talle), vectorizado. Los códigos más cortos se completan con 0; los inválidos dan 0"""
+    ancho = 1 + ANCHO_TALLE * len(TALLES)
+    texto = pd.Series(codigos, dtype="object").fillna("").astype(str).str.slice(0, ancho).str.ljust(ancho, "0")
+    caracteres = np.array(texto.tolist(), dtype=f"U{ancho}").view(np.uint32).reshape(len(texto), ancho)
+    digitos = caracteres[:, 1:].astype(np.int64) - ord("0")
+    invalidos = (caracteres[:, 0] != ord("T")) | ((digitos < 0) | (digitos > 9)).any(axis=1)
+    matriz = digitos.reshape(len(texto), len(TALLES), ANCHO_TALLE) @ (10 ** np.arange(ANCHO_TALLE - 1, -1, -1))
+    matriz[invalidos] = 0
+    return matriz
+
+# =====================
+# BACKENDS DE ALMACENAMIENTO
+# =====================
+def _registros(valores):
+    """Convierte la matriz de una hoja en registros, igual que get_all_records"""
+    if not valores:
+        return []
+    encabezados = valores[0]
+    ancho = len(encabezados)
+    return [
+        dict(zip(encabezados, numericise_all(list(fila[:ancho]) + [""] * (ancho - len(fila)))))
+        for fila in valores[1:]
+    ]
+
+class ConflictoEscritura(Exception):
+    """Las celdas a escribir cambiaron desde que se leyeron (otro operador las modificó)"""
+    
+    def __init__(self, mensaje, actuales=None):
+        super().__init__(mensaje)
+        self.actuales = actuales
+
+class BackendSheets:
+    """Interfaz mínima que la capa de datos necesita del spreadsheet"""
+    
+    def cargar(self, hoja):
+        """Devuelve la hoja como lista de registros (igual que get_all_records)"""
+        raise NotImplementedError
+    
+    def cargar_varias(self, hojas):
+        """Devuelve {hoja: registros}; por defecto, una llamada por hoja"""
+        return {hoja: self.cargar(hoja) for hoja in hojas}
+    
+    def revision(self):
+        """Identificador que cambia cada vez que se modifica el spreadsheet"""
+        raise NotImplementedError
+    
+    def encabezados(self, hoja):
+        """Devuelve la primera fila de la hoja"""
+        raise NotImplementedError
+    
+    def limpiar(self, hoja):
+        """Borra todo el contenido de la hoja"""
+        raise NotImplementedError
+    
+    def escribir_rango(self, hoja, valores, fila=1):
+        """Escribe la matriz de valores a partir de la fila indicada (columna A)"""
+        raise NotImplementedError
+    
+    def agregar_filas(self, hoja, valores):
+        """Agrega filas al final de la tabla que empieza en A1; devuelve la fila de la primera"""
+        raise NotImplementedError
+    
+    def actualizar_celdas(self, hoja, celdas):
+        """Actualiza celdas sueltas [(fila, columna, valor)] en una sola llamada"""
+        raise NotImplementedError
+    
+    def borrar_filas(self, hoja, inicio, fin):
+        """Elimina las filas inicio..fin (inclusive); las siguientes suben"""
+        raise NotImplementedError
+    
+    def leer_celdas(self, hoja, celdas):
+        """Valores actuales de las celdas [(fila, columna, ...)] ("" si están vacías)"""
+        raise NotImplementedError
+    
+    def valores_columna(self, hoja, columna):
+        """Valores de la columna con ese encabezado, sin el encabezado"""
+        raise NotImplementedError
+    
+    def actualizar_celdas_si(self, hoja, celdas, esperados):
+        """Actualiza las celdas solo si `esperados` [(fila, columna, valor)] sigue igual; si no,
+        lanza ConflictoEscritura con los valores actuales. La API de Sheets no tiene escritura
+        condicional: por defecto se lee y se escribe enseguida (queda una ventana mínima)"""
+        actuales = self.leer_celdas(hoja, esperados)
+        if [_normalizar(a) for a in actuales] != [_normalizar(e) for _, _, e in esperados]:
+            raise ConflictoEscritura(f"{hoja}: las celdas cambiaron", actuales)
+        self.actualizar_celdas(hoja, celdas)
+    
+    def borrar_filas_si(self, hoja, inicio, fin, esperados):
+        """Elimina las filas solo si `esperados` [(fila, columna, valor)] sigue igual (como
+        actualizar_celdas_si: por defecto se lee y se borra enseguida)"""
+        actuales = self.leer_celdas(hoja, esperados)
+        if [_normalizar(a) for a in actuales] != [_normalizar(e) for _, _, e in esperados]:
+            raise ConflictoEscritura(f"{hoja}: las filas cambiaron", actuales)
+        self.borrar_filas(hoja, inicio, fin)
+    
+    def recortar(self, hoja, desde):
+        """Borra el contenido desde la fila indicada hasta el final de la hoja"""
+        raise NotImplementedError
+    
+    def crear_hoja(self, hoja, encabezados):
+        """Crea la hoja con esa fila de encabezados"""
+        raise NotImplementedError
+    
+    def titulos(self):
+        """Títulos de todas las hojas del spreadsheet"""
+        raise NotImplementedError
+
+class CacheHandles:
+    """Handles de spreadsheet y worksheets por (key del spreadsheet, título de hoja)
+    Evitan la búsqueda por nombre en Drive y la lectura de metadatos en cada llamada.
+    Cada handle queda atado al client que lo abrió: con otro client (init_connection lo
+    renueva cada 30 minutos) se vuelve a abrir el spreadsheet y se descartan sus worksheets."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claves = {}        # nombre del spreadsheet -> key
+        self.spreadsheets = {}  # key -> (client, Spreadsheet)
+        self.worksheets = {}    # (key, título) -> Worksheet
+    
+    def spreadsheet(self, client, nombre=SHEET_NAME):
+        with self.lock:
+            cliente, spreadsheet = self.spreadsheets.get(self.claves.get(nombre), (None, None))
+            if cliente is client:
+                return spreadsheet
+        spreadsheet = client.open(nombre)
+        with self.lock:
+            self.claves[nombre] = spreadsheet.id
+            if spreadsheet.id in self.spreadsheets:
+                self.worksheets = {k: v for k, v in self.worksheets.items() if k[0] != spreadsheet.id}
+            self.spreadsheets[spreadsheet.id] = (client, spreadsheet)
+        return spreadsheet
+    
+    def worksheet(self, client, titulo, nombre=SHEET_NAME):
+        spreadsheet = self.spreadsheet(client, nombre)
+        with self.lock:
+            handle = self.worksheets.get((spreadsheet.id, titulo))
+        if handle is not None:
+            return handle
+        # Una sola lectura de metadatos resuelve todas las hojas del spreadsheet
+        hojas = {ws.title: ws for ws in spreadsheet.worksheets()}
+        with self.lock:
+            # Si mientras tanto otro client reabrió el spreadsheet, sus handles no se pisan
+            if self.spreadsheets.get(spreadsheet.id, (None, None))[1] is spreadsheet:
+                for titulo_ws, ws in hojas.items():
+                    self.worksheets[(spreadsheet.id, titulo_ws)] = ws
+        if titulo not in hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return hojas[titulo]
+    
+    def invalidar(self, titulo=None, nombre=SHEET_NAME):
+        """Olvida los handles de la hoja (o de todo el spreadsheet) tras un borrado o renombre"""
+        with self.lock:
+            clave = self.claves.get(nombre)
+            if titulo is None:
+                self.spreadsheets.pop(clave, None)
+                self.worksheets = {k: v for k, v in self.worksheets.items() if k[0] != clave}
+            else:
+                self.worksheets.pop((clave, titulo), None)
+
+@st.cache_resource
+def _cache_handles():
+    """Cache de handles única por proceso: cada client de init_connection renueva los suyos"""
+    return CacheHandles()
+
+class BackendGspread(BackendSheets):
+    """Backend real sobre Google Sheets vía gspread"""
+    
+    def __init__(self, client, handles):
+        self.client = client
+        self.handles = handles
+    
+    def _con_hoja(self, hoja, operacion):
+        """Ejecuta la operación sobre el handle cacheado; si la hoja cambió, lo renueva y reintenta"""
+        try:
+            return operacion(self.handles.worksheet(self.client, hoja))
+        except (gspread.exceptions.WorksheetNotFound, gspread.exceptions.APIError) as e:
+            if isinstance(e, gspread.exceptions.APIError) and e.response.status_code not in (400, 404):
+                raise
+            self.handles.invalidar(hoja)
+            return operacion(self.handles.worksheet(self.client, hoja))
+    
+    def cargar(self, hoja):
+        return self._con_hoja(hoja, lambda ws: ws.get_all_records())
+    
+    def cargar_varias(self, hojas):
+        # Un único values:batchGet para todas las hojas
+        respuesta = self.handles.spreadsheet(self.client).values_batch_get(
+            [absolute_range_name(hoja) for hoja in hojas]
+        )
+        return {
+            hoja: _registros(rango.get("values", []))
+            for hoja, rango in zip(hojas, respuesta.get("valueRanges", []))
+        }
+    
+    def revision(self):
+        # Metadatos de Drive: mucho más barato que descargar cualquier hoja
+        spreadsheet = self.handles.spreadsheet(self.client)
+        http = getattr(self.client, "http_client", self.client)
+        respuesta = http.request(
+            "get", f"{DRIVE_FILES_API_V3_URL}/{spreadsheet.id}",
+            params={"fields": "version,modifiedTime", "supportsAllDrives": True}
+        )
+        datos = respuesta.json()
+        return str(datos.get("version") or datos.get("modifiedTime"))
+    
+    def encabezados(self, hoja):
+        return self._con_hoja(hoja, lambda ws: ws.row_values(1))
+    
+    def limpiar(self, hoja):
+        self._con_hoja(hoja, lambda ws: ws.clear())
+    
+    def escribir_rango(self, hoja, valores, fila=1):
+        self._con_hoja(hoja, lambda ws: ws.update(range_name=f"A{fila}", values=valores))
+    
+    def agregar_filas(self, hoja, valores):
+        respuesta = self._con_hoja(hoja, lambda ws: ws.append_rows(valores, table_range="A1"))
+        rango = respuesta["updates"]["updatedRange"]
+        return a1_to_rowcol(rango.split("!")[-1].split(":")[0])[0]
+    
+    def actualizar_celdas(self, hoja, celdas):
+        data = [
+            {"range": rowcol_to_a1(fila, columna), "values": [[valor]]}
+            for fila, columna, valor in celdas
+        ]
+        self._con_hoja(hoja, lambda ws: ws.batch_update(data))
+    
+    def borrar_filas(self, hoja, inicio, fin):
+        self._con_hoja(hoja, lambda ws: ws.delete_rows(inicio, fin))
+    
+    def leer_celdas(self, hoja, celdas):
+        rangos = [rowcol_to_a1(fila, columna) for fila, columna, *_ in celdas]
+        valores = self._con_hoja(hoja, lambda ws: ws.batch_get(rangos, value_render_option="UNFORMATTED_VALUE"))
+        return [v[0][0] if v and v[0] else "" for v in valores]
+    
+    def valores_columna(self, hoja, columna):
+        def _leer(ws):
+            encabezados = ws.row_values(1)
+            return ws.col_values(encabezados.index(columna) + 1)[1:] if columna in encabezados else []
+        return self._con_hoja(hoja, _leer)
+    
+    def recortar(self, hoja, desde):
+        def _recortar(ws):
+            ultima_columna = rowcol_to_a1(1, ws.col_count).rstrip("0123456789")
+            ws.batch_clear([f"A{desde}:{ultima_columna}"])
+        self._con_hoja(hoja, _recortar)
+    
+    def crear_hoja(self, hoja, encabezados):
+        ws = self.handles.spreadsheet(self.client).add_worksheet(title=hoja, rows=1000, cols=len(encabezados))
+        ws.update(range_name="A1", values=[list(encabezados)])
+        self.handles.invalidar(hoja)
+    
+    def titulos(self):
+        return [ws.title for ws in self.handles.spreadsheet(self.client).worksheets()]
+
+def _error_api(codigo, mensaje, estado):
+    """Arma un APIError de gspread igual al que produce la API real"""
+    respuesta = requests.Response()
+    respuesta.status_code = codigo
+    respuesta._content = json.dumps(
+        {"error": {"code": codigo, "message": mensaje, "status": estado}}
+    ).encode("utf-8")
+    return gspread.exceptions.APIError(respuesta)
+
+class BackendFalso(BackendSheets):
+    """Spreadsheet simulado en memoria (opcionalmente persistido en un JSON)
+    Imita la semántica de gspread e incluye latencia y errores 429 de cuota"""
+    
+    def __init__(self, ruta=None, latencia=0.0, prob_429=0.0, hojas=None):
+        self.ruta = ruta
+        self.latencia = latencia
+        self.prob_429 = prob_429
+        self.llamadas = 0
+        self.revision_actual = 0
+        self.lock = threading.Lock()
+        self.hojas = {h: [] for h in (hojas if hojas is not None else HOJAS_REPLICA)}
+        if ruta and os.path.exists(ruta):
+            with open(ruta, encoding="utf-8") as f:
+                self.hojas.update(json.load(f))
+    
+    def _simular_llamada(self, *hojas):
+        """Latencia, cuota y hojas inexistentes, como en la API real"""
+        with self.lock:
+            self.llamadas += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+        if self.prob_429 and random.random() < self.prob_429:
+            raise _error_api(429, "Quota exceeded for quota metric 'Requests'", "RESOURCE_EXHAUSTED")
+        faltantes = [h for h in hojas if h not in self.hojas]
+        if faltantes:
+            if len(hojas) > 1:
+                raise _error_api(400, f"Unable to parse range: {faltantes[0]}", "INVALID_ARGUMENT")
+            raise gspread.exceptions.WorksheetNotFound(faltantes[0])
+        return self.hojas[hojas[0]] if hojas else None
+    
+    def _persistir(self):
+        self.revision_actual += 1
+        if self.ruta:
+            temporal = f"{self.ruta}.tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(self.hojas, f, ensure_ascii=False, default=str)
+            os.replace(temporal, self.ruta)
+    
+    def cargar(self, hoja):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            return _registros(filas)
+    
+    def cargar_varias(self, hojas):
+        self._simular_llamada(*hojas)
+        with self.lock:
+            return {hoja: _registros(self.hojas[hoja]) for hoja in hojas}
+    
+    def revision(self):
+        self._simular_llamada()
+        with self.lock:
+            return str(self.revision_actual)
+    
+    def encabezados(self, hoja):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            return list(filas[0]) if filas else []
+    
+    def limpiar(self, hoja):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            filas.clear()
+            self._persistir()
+    
+    def escribir_rango(self, hoja, valores, fila=1):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            for i, valores_fila in enumerate(valores):
+                indice = fila - 1 + i
+                while len(filas) <= indice:
+                    filas.append([])
+                filas[indice] = list(valores_fila) + filas[indice][len(valores_fila):]
+            self._persistir()
+    
+    def agregar_filas(self, hoja, valores):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            while filas and not any(v != "" for v in filas[-1]):
+                filas.pop()
+            primera = len(filas) + 1
+            filas.extend(list(v) for v in valores)
+            self._persistir()
+            return primera
+    
+    def _escribir_celdas(self, filas, celdas):
+        for fila, columna, valor in celdas:
+            while len(filas) < fila:
+                filas.append([])
+            celdas_fila = filas[fila - 1]
+            celdas_fila.extend([""] * (columna - len(celdas_fila)))
+            celdas_fila[columna - 1] = valor
+        self._persistir()
+    
+    def _leer_celdas(self, filas, celdas):
+        return [
+            filas[f - 1][c - 1] if f <= len(filas) and c <= len(filas[f - 1]) else ""
+            for f, c, *_ in celdas
+        ]
+    
+    def actualizar_celdas(self, hoja, celdas):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            self._escribir_celdas(filas, celdas)
+    
+    def leer_celdas(self, hoja, celdas):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            return self._leer_celdas(filas, celdas)
+    
+    def valores_columna(self, hoja, columna):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            if not filas or columna not in filas[0]:
+                return []
+            indice = filas[0].index(columna)
+            return [f[indice] if indice < len(f) else "" for f in filas[1:]]
+    
+    def actualizar_celdas_si(self, hoja, celdas, esperados):
+        # Aquí la comparación y la escritura sí son atómicas
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            actuales = self._leer_celdas(filas, esperados)
+            if [_normalizar(a) for a in actuales] != [_normalizar(e) for _, _, e in esperados]:
+                raise ConflictoEscritura(f"{hoja}: las celdas cambiaron", actuales)
+            self._escribir_celdas(filas, celdas)
+    
+    def borrar_filas(self, hoja, inicio, fin):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            del filas[inicio - 1:fin]
+            self._persistir()
+    
+    def borrar_filas_si(self, hoja, inicio, fin, esperados):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            actuales = self._leer_celdas(filas, esperados)
+            if [_normalizar(a) for a in actuales] != [_normalizar(e) for _, _, e in esperados]:
+                raise ConflictoEscritura(f"{hoja}: las filas cambiaron", actuales)
+            del filas[inicio - 1:fin]
+            self._persistir()
+    
+    def recortar(self, hoja, desde):
+        filas = self._simular_llamada(hoja)
+        with self.lock:
+            del filas[desde - 1:]
+            self._persistir()
+    
+    def crear_hoja(self, hoja, encabezados):
+        self._simular_llamada()
+        with self.lock:
+            if hoja in self.hojas:
+                raise _error_api(400, f"A sheet with the name \"{hoja}\" already exists", "INVALID_ARGUMENT")
+            self.hojas[hoja] = [list(encabezados)]
+            self._persistir()
+    
+    def titulos(self):
+        self._simular_llamada()
+        with self.lock:
+            return list(self.hojas)
+
+@st.cache_resource
+def _backend_falso():
+    """Backend simulado único por proceso (no rota con la conexión)"""
+    return BackendFalso(
+        ruta=os.environ.get("TEXTIL_FAKE_PATH"),
+        latencia=float(os.environ.get("TEXTIL_FAKE_LATENCIA", "0")),
+        prob_429=float(os.environ.get("TEXTIL_FAKE_429", "0"))
+    )
+
+# =====================
+# PLANIFICADOR DE PEDIDOS (CUOTA DE LA API)
+# =====================
+CUOTA_POR_MINUTO = int(os.environ.get("TEXTIL_CUOTA_MINUTO", "60"))  # Pedidos por minuto por usuario
+REINTENTOS_API = 5  # Reintentos ante 429/5xx antes de propagar el error
+BACKOFF_BASE = 1.0  # Segundos de la primera espera; se duplica en cada reintento
+BACKOFF_MAXIMO = 32.0
+
+# Prioridades (menor = antes): lecturas de la UI, escrituras de la cola, sincronización
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_ESCRITURA = 1
+PRIORIDAD_FONDO = 2
+
+_hilo_actual = threading.local()
+
+def fijar_prioridad(prioridad):
+    """Prioridad de los pedidos que haga el hilo actual (los hilos de fondo la bajan)"""
+    _hilo_actual.prioridad = prioridad
+
+def prioridad_actual():
+    return getattr(_hilo_actual, "prioridad", PRIORIDAD_INTERACTIVA)
+
+class HojaNoDisponible(Exception):
+    """No se pudo descargar la hoja y no hay copia local para mostrar"""
+
+def _reintentable(error):
+    """429 (cuota), 5xx y cortes de red se reintentan; el resto de errores no"""
+    if isinstance(error, gspread.exceptions.APIError):
+        codigo = error.response.status_code
+        return codigo == 429 or codigo >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+class Planificador:
+    """Reparte la cuota de la API entre todas las sesiones y hilos del proceso
+    
+    - Token bucket de CUOTA_POR_MINUTO pedidos por minuto (con ráfaga del mismo tamaño)
+    - Los turnos se otorgan por prioridad y, dentro de ella, por orden de llegada
+    - Backoff exponencial con jitter ante 429/5xx; un 429 vacía el bucket para todos
+    - Lecturas idénticas en curso se comparten (una sola llamada a la API)
+    """
+    
+    def __init__(self, cuota_por_minuto):
+        self.capacidad = float(cuota_por_minuto)
+        self.tasa = cuota_por_minuto / 60.0
+        self.tokens = self.capacidad
+        self.actualizado = time.monotonic()
+        self.cond = threading.Condition()
+        self.turnos = []
+        self.orden = itertools.count()
+        self.en_curso = {}
+        self.stats = defaultdict(int)
+    
+    def _recargar(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+    
+    def _tomar_turno(self, prioridad):
+        """Bloquea hasta que sea el turno del pedido y haya un token disponible"""
+        with self.cond:
+            turno = (prioridad, next(self.orden))
+            heapq.heappush(self.turnos, turno)
+            while True:
+                self._recargar()
+                if self.turnos[0] == turno and self.tokens >= 1:
+                    heapq.heappop(self.turnos)
+                    self.tokens -= 1
+                    self.cond.notify_all()
+                    return
+                # Solo el primero de la fila sabe cuánto esperar; el resto espera a ser notificado
+                espera = (1 - self.tokens) / self.tasa if self.turnos[0] == turno else None
+                self.cond.wait(espera)
+    
+    def _con_reintentos(self, funcion, args, prioridad, idempotente, cuota):
+        for intento in range(REINTENTOS_API + 1):
+            if cuota:
+                self._tomar_turno(prioridad)
+            self.stats["llamadas"] += 1
+            try:
+                return funcion(*args)
+            except Exception as e:
+                # Un 429 nunca se ejecutó; otros errores solo se reintentan si repetir no duplica datos
+                es_429 = isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 429
+                if intento == REINTENTOS_API or not _reintentable(e) or not (idempotente or es_429):
+                    raise
+                if es_429:
+                    with self.cond:
+                        self.tokens = 0.0
+                espera = min(BACKOFF_MAXIMO, BACKOFF_BASE * 2 ** intento) * random.uniform(0.5, 1.5)
+                self.stats["reintentos"] += 1
+                print(f"⏳ {funcion.__name__}: {str(e)[:80]} - reintento en {espera:.1f}s")
+                time.sleep(espera)
+    
+    def ejecutar(self, funcion, *args, clave=None, idempotente=True, cuota=True):
+        """Ejecuta el pedido respetando la cuota; si `clave` coincide con otro en curso, comparte su resultado"""
+        prioridad = prioridad_actual()
+        if clave is None:
+            return self._con_reintentos(funcion, args, prioridad, idempotente, cuota)
+        
+        with self.cond:
+            compartido = self.en_curso.get(clave)
+            propio = compartido is None
+            if propio:
+                compartido = self.en_curso[clave] = {"listo": threading.Event()}
+        if not propio:
+            self.stats["compartidas"] += 1
+            compartido["listo"].wait()
+            if "error" in compartido:
+                raise compartido["error"]
+            return compartido["resultado"]
+        
+        try:
+            compartido["resultado"] = self._con_reintentos(funcion, args, prioridad, idempotente, cuota)
+            return compartido["resultado"]
+        except Exception as e:
+            compartido["error"] = e
+            raise
+        finally:
+            with self.cond:
+                del self.en_curso[clave]
+            compartido["listo"].set()
+
+@st.cache_resource
+def _planificador():
+    """Planificador único por proceso: la cuota es de la cuenta de servicio, no de la sesión"""
+    return Planificador(CUOTA_POR_MINUTO)
+
+class BackendPlanificado(BackendSheets):
+    """Envuelve un backend para que todos sus pedidos pasen por el planificador"""
+    
+    def __init__(self, base, planificador):
+        self.base = base
+        self.planificador = planificador
+    
+    def __getattr__(self, nombre):
+        # Atributos propios del backend envuelto (p. ej. contadores del backend falso)
+        return getattr(self.base, nombre)
+    
+    def cargar(self, hoja):
+        return self.planificador.ejecutar(self.base.cargar, hoja, clave=("cargar", hoja))
+    
+    def cargar_varias(self, hojas):
+        return self.planificador.ejecutar(self.base.cargar_varias, list(hojas), clave=("cargar_varias", tuple(hojas)))
+    
+    def revision(self):
+        # Va contra la API de Drive, que tiene su propia cuota
+        return self.planificador.ejecutar(self.base.revision, clave=("revision",), cuota=False)
+    
+    def encabezados(self, hoja):
+        return self.planificador.ejecutar(self.base.encabezados, hoja, clave=("encabezados", hoja))
+    
+    def limpiar(self, hoja):
+        return self.planificador.ejecutar(self.base.limpiar, hoja)
+    
+    def escribir_rango(self, hoja, valores, fila=1):
+        return self.planificador.ejecutar(self.base.escribir_rango, hoja, valores, fila)
+    
+    def agregar_filas(self, hoja, valores):
+        # Repetir un append que quizás se aplicó duplicaría filas: solo se reintenta ante 429
+        return self.planificador.ejecutar(self.base.agregar_filas, hoja, valores, idempotente=False)
+    
+    def actualizar_celdas(self, hoja, celdas):
+        return self.planificador.ejecutar(self.base.actualizar_celdas, hoja, celdas)
+    
+    def borrar_filas(self, hoja, inicio, fin):
+        # Igual que un append: repetirlo borraría otras filas
+        return self.planificador.ejecutar(self.base.borrar_filas, hoja, inicio, fin, idempotente=False)
+    
+    def borrar_filas_si(self, hoja, inicio, fin, esperados):
+        return self.planificador.ejecutar(self.base.borrar_filas_si, hoja, inicio, fin, esperados, idempotente=False)
+    
+    def recortar(self, hoja, desde):
+        return self.planificador.ejecutar(self.base.recortar, hoja, desde)
+    
+    def leer_celdas(self, hoja, celdas):
+        return self.planificador.ejecutar(self.base.leer_celdas, hoja, celdas)
+    
+    def valores_columna(self, hoja, columna):
+        return self.planificador.ejecutar(self.base.valores_columna, hoja, columna, clave=("valores_columna", hoja, columna))
+    
+    def actualizar_celdas_si(self, hoja, celdas, esperados):
+        # Si se aplicó y se repite, daría conflicto con el valor propio y se reaplicaría el delta
+        return self.planificador.ejecutar(self.base.actualizar_celdas_si, hoja, celdas, esperados, idempotente=False)
+    
+    def crear_hoja(self, hoja, encabezados):
+        # Repetirla fallaría con "ya existe"
+        return self.planificador.ejecutar(self.base.crear_hoja, hoja, encabezados, idempotente=False)
+    
+    def titulos(self):
+        return self.planificador.ejecutar(self.base.titulos, clave=("titulos",))
+
+@st.cache_resource(ttl=1800)  # 30 minutos para la conexión
+def init_connection():
+    """Conexión más robusta al backend de almacenamiento configurado"""
+    if BACKEND == "falso":
+        return BackendPlanificado(_backend_falso(), _planificador())
+    
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            scope = [
+                "https://spreadsheets.google.com/feeds",
+                "https://www.googleapis.com/auth/drive"
+            ]
+            creds = Credentials.from_service_account_info(
+                st.secrets["gcp_service_account"], 
+                scopes=scope
+            )
+            client = gspread.authorize(creds)
+            
+            # Test de conexión: deja el spreadsheet en la cache de handles
+            handles = _cache_handles()
+            handles.spreadsheet(client)
+            print(f"✅ Conexión exitosa a Google Sheets (intento {attempt + 1})")
+            return BackendPlanificado(BackendGspread(client, handles), _planificador())
+            
+        except Exception as e:
+            if attempt == max_retries - 1:
+                st.error(f"❌ Error de conexión después de {max_retries} intentos: {str(e)}")
+                return None
+            time.sleep(2)  # Esperar antes de reintentar
+
+backend = init_connection()
+
+# =====================
+# RÉPLICA LOCAL (SQLITE)
+# =====================
+REPLICA_PATH = os.environ.get("TEXTIL_REPLICA_PATH", "textil_replica.db")
+SYNC_INTERVALO = 300  # Segundos entre sincronizaciones en segundo plano
+REVISION_INTERVALO = 5  # Segundos mínimos entre consultas de la revisión del spreadsheet
+
+# Índices a crear en cada tabla que tenga estas columnas
+INDICES_REPLICA = [("ID",), ("ID Compra",), ("ID Corte",), ("Tipo de tela", "Color"), ("Fecha",)]
+
+def _q(nombre):
+    """Cita un identificador para SQLite (nombres de hoja y columnas con espacios)"""
+    return '"' + str(nombre).replace('"', '""') + '"'
+
+class Replica:
+    """Copia local en SQLite de las hojas; cada tabla guarda la fila real de la hoja en _fila"""
+    
+    def __init__(self, ruta):
+        self.conn = sqlite3.connect(ruta, check_same_thread=False)
+        self.lock = threading.RLock()
+        # Versión local por hoja: evita que una sincronización pise una escritura más nueva
+        self.versiones = defaultdict(int)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS _hojas "
+                "(hoja TEXT PRIMARY KEY, columnas TEXT, sincronizada REAL, revision TEXT)"
+            )
+            existentes = [c[1] for c in self.conn.execute("PRAGMA table_info(_hojas)")]
+            if "revision" not in existentes:
+                self.conn.execute("ALTER TABLE _hojas ADD COLUMN revision TEXT")
+            self.conn.commit()
+    
+    def columnas(self, hoja):
+        """Columnas replicadas de la hoja, o None si no está en la réplica"""
+        with self.lock:
+            fila = self.conn.execute("SELECT columnas FROM _hojas WHERE hoja = ?", (hoja,)).fetchone()
+        return json.loads(fila[0]) if fila else None
+    
+    def revision(self, hoja):
+        """Revisión del spreadsheet con la que se descargó la hoja"""
+        with self.lock:
+            fila = self.conn.execute("SELECT revision FROM _hojas WHERE hoja = ?", (hoja,)).fetchone()
+        return fila[0] if fila else None
+    
+    def leer(self, hoja, desde=0):
+        """Lee la hoja replicada (índice = fila de la hoja - 2, como get_all_records)
+        desde: solo las filas posteriores a esa fila de la réplica"""
+        with self.lock:
+            df = pd.read_sql_query(f"SELECT * FROM {_q(hoja)} WHERE _fila > ? ORDER BY _fila", self.conn, params=(desde,))
+        df.index = df.pop("_fila") - 2
+        df.index.name = None
+        return df
+    
+    def reemplazar(self, hoja, df, version=None, revision=None):
+        """Reemplaza la tabla completa; si se indica version, solo si no hubo escrituras locales"""
+        columnas = [str(c) for c in df.columns]
+        filas = [
+            [i + 2] + [_valor_celda(v) for v in fila]
+            for i, fila in enumerate(df.itertuples(index=False, name=None))
+        ]
+        with self.lock:
+            if version is not None and self.versiones[hoja] != version:
+                return False
+            tabla = _q(hoja)
+            self.conn.execute(f"DROP TABLE IF EXISTS {tabla}")
+            definicion = ", ".join(["_fila INTEGER PRIMARY KEY"] + [_q(c) for c in columnas])
+            self.conn.execute(f"CREATE TABLE {tabla} ({definicion})")
+            if filas:
+                marcas = ", ".join("?" * (len(columnas) + 1))
+                self.conn.executemany(f"INSERT INTO {tabla} VALUES ({marcas})", filas)
+            for indice in INDICES_REPLICA:
+                if all(c in columnas for c in indice):
+                    nombre = _q(f"ix_{hoja}_{'_'.join(indice)}")
+                    self.conn.execute(f"CREATE INDEX {nombre} ON {tabla} ({', '.join(_q(c) for c in indice)})")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO _hojas VALUES (?, ?, ?, ?)",
+                (hoja, json.dumps(columnas), time.time(), revision)
+            )
+            self.conn.commit()
+            self.versiones[hoja] += 1
+        return True
+    
+    def agregar(self, hoja, encabezados, valores):
+        """Replica un append de filas ya ordenadas según los encabezados de la hoja"""
+        with self.lock:
+            self.versiones[hoja] += 1
+            columnas = self.columnas(hoja)
+            if columnas is not None and len(encabezados) > len(columnas) and list(encabezados[:len(columnas)]) == columnas:
+                # Columnas nuevas al final (igual que en la hoja): se agregan sin volver a descargarla
+                for columna in encabezados[len(columnas):]:
+                    self.conn.execute(f"ALTER TABLE {_q(hoja)} ADD COLUMN {_q(columna)}")
+                self.conn.execute("UPDATE _hojas SET columnas = ? WHERE hoja = ?", (json.dumps(list(encabezados)), hoja))
+                columnas = list(encabezados)
+            if columnas != list(encabezados):
+                # Estructura distinta: se descarta y se vuelve a descargar al leer
+                self.descartar(hoja)
+                return
+            tabla = _q(hoja)
+            ultima = self.conn.execute(f"SELECT COALESCE(MAX(_fila), 1) FROM {tabla}").fetchone()[0]
+            marcas = ", ".join("?" * (len(encabezados) + 1))
+            self.conn.executemany(
+                f"INSERT INTO {tabla} VALUES ({marcas})",
+                [[ultima + i + 1] + list(fila) for i, fila in enumerate(valores)]
+            )
+            self.conn.commit()
+    
+    def actualizar(self, hoja, celdas):
+        """Replica la actualización de celdas [(fila, columna, valor)]"""
+        with self.lock:
+            self.versiones[hoja] += 1
+            columnas = self.columnas(hoja)
+            if columnas is None:
+                return
+            tabla = _q(hoja)
+            for fila, columna, valor in celdas:
+                self.conn.execute(
+                    f"UPDATE {tabla} SET {_q(columnas[columna - 1])} = ? WHERE _fila = ?",
+                    (_valor_celda(valor), int(fila))
+                )
+            self.conn.commit()
+    
+    def reasignar(self, hoja, columna, viejo, nuevo):
+        """Cambia un valor de la columna en todas las filas que lo tengan (IDs reasignados)"""
+        with self.lock:
+            if columna not in (self.columnas(hoja) or []):
+                return
+            self.versiones[hoja] += 1
+            self.conn.execute(f"UPDATE {_q(hoja)} SET {_q(columna)} = ? WHERE {_q(columna)} = ?", (nuevo, viejo))
+            self.conn.commit()
+    
+    def maximo(self, hoja, columna):
+        """Mayor valor numérico de la columna (0 si la hoja o la columna no están)"""
+        if columna not in (self.columnas(hoja) or []):
+            return 0
+        with self.lock:
+            valor = self.conn.execute(
+                f"SELECT MAX({_q(columna)}) FROM {_q(hoja)} WHERE typeof({_q(columna)}) IN ('integer', 'real')"
+            ).fetchone()[0]
+        return int(valor or 0)
+    
+    def leer_celdas(self, hoja, celdas):
+        """Valores actuales de las celdas [(fila, columna, ...)] ("" si no existen)"""
+        columnas = self.columnas(hoja)
+        valores = []
+        with self.lock:
+            for fila, columna, *_ in celdas:
+                resultado = None
+                if columnas is not None and columna <= len(columnas):
+                    resultado = self.conn.execute(
+                        f"SELECT {_q(columnas[columna - 1])} FROM {_q(hoja)} WHERE _fila = ?", (int(fila),)
+                    ).fetchone()
+                valores.append(resultado[0] if resultado and resultado[0] is not None else "")
+        return valores
+    
+    def marcar_vieja(self, hoja):
+        """Olvida la revisión de la hoja: se vuelve a descargar en cuanto no tenga escrituras en cola"""
+        with self.lock:
+            self.conn.execute("UPDATE _hojas SET revision = NULL WHERE hoja = ?", (hoja,))
+            self.conn.commit()
+    
+    def descartar(self, hoja=None):
+        """Quita una hoja (o todas) de la réplica para forzar su descarga"""
+        with self.lock:
+            hojas = [hoja] if hoja else [h for (h,) in self.conn.execute("SELECT hoja FROM _hojas")]
+            for h in hojas:
+                self.versiones[h] += 1
+                self.conn.execute(f"DROP TABLE IF EXISTS {_q(h)}")
+                self.conn.execute("DELETE FROM _hojas WHERE hoja = ?", (h,))
+            self.conn.commit()
+
+def _descargar_hoja(backend, hoja_nombre):
+    """Descarga una hoja completa desde el backend"""
+    data = backend.cargar(hoja_nombre)
+    df = pd.DataFrame(data)
+    
+    # Limpiar filas completamente vacías
+    return df.dropna(how='all')
+
+def _hojas_en_cola():
+    """Hojas replicadas con escrituras encoladas que Sheets todavía no tiene"""
+    return {h for h in init_cola().hojas_pendientes() if replica.columnas(h) is not None}
+
+def _refrescar_replica(replica, backend, hojas, revision=None):
+    """Descarga varias hojas en un solo pedido y las vuelca en la réplica"""
+    # No pisar las escrituras encoladas con datos de Sheets que todavía no las tienen
+    pendientes = _hojas_en_cola()
+    hojas = [h for h in hojas if h not in pendientes]
+    if not hojas:
+        return
+    versiones = {hoja: replica.versiones[hoja] for hoja in hojas}
+    for hoja, registros in backend.cargar_varias(hojas).items():
+        df = pd.DataFrame(registros).dropna(how='all')
+        replica.reemplazar(hoja, df, version=versiones[hoja], revision=revision)
+
+def _sincronizar_replica(replica):
+    """Hilo en segundo plano: mantiene la réplica al día con Google Sheets"""
+    fijar_prioridad(PRIORIDAD_FONDO)
+    ultimo_archivo = 0.0
+    while True:
+        time.sleep(SYNC_INTERVALO)
+        backend_sync = init_connection()
+        if not backend_sync:
+            continue
+        try:
+            # Solo se descargan las hojas cuya revisión quedó atrás
+            revision = backend_sync.revision()
+            viejas = [h for h in HOJAS_REPLICA if replica.revision(h) != revision]
+            if viejas:
+                _refrescar_replica(replica, backend_sync, viejas, revision)
+        except Exception as e:
+            # Si una hoja falla, falla el lote entero: seguir hoja por hoja
+            print(f"⚠️ Sincronización en lote fallida: {str(e)}")
+            for hoja in HOJAS_REPLICA:
+                try:
+                    _refrescar_replica(replica, backend_sync, [hoja])
+                except Exception as e:
+                    print(f"⚠️ Sincronización de {hoja} omitida: {str(e)}")
+        
+        # Los años cerrados pasan a sus hojas frías (se revisa a lo sumo cada ARCHIVO_INTERVALO)
+        if ARCHIVO_AUTOMATICO and time.time() - ultimo_archivo >= ARCHIVO_INTERVALO:
+            ultimo_archivo = time.time()
+            try:
+                if _hay_para_archivar():
+                    archivar_cerrados(backend_sync)
+            except Exception as e:
+                print(f"⚠️ Archivo histórico omitido: {str(e)}")
+
+@st.cache_resource
+def init_replica():
+    """Abre la réplica local y arranca su sincronización (una vez por proceso)"""
+    replica = Replica(REPLICA_PATH)
+    threading.Thread(target=_sincronizar_replica, args=(replica,), daemon=True, name="sync-replica").start()
+    return replica
+
+replica = init_replica()
+
+@st.cache_resource
+def _estado_revision():
+    """Última revisión conocida del spreadsheet, compartida por todas las sesiones"""
+    return {"valor": None, "consultada": 0.0, "lock": threading.Lock()}
+
+def revision_remota():
+    """Revisión actual del spreadsheet (se consulta a lo sumo cada REVISION_INTERVALO s)"""
+    estado = _estado_revision()
+    with estado["lock"]:
+        if backend and time.time() - estado["consultada"] >= REVISION_INTERVALO:
+            try:
+                estado["valor"] = backend.revision()
+            except Exception as e:
+                print(f"⚠️ No se pudo consultar la revisión: {str(e)}")
+            estado["consultada"] = time.time()
+        return estado["valor"]
+
+def _hoja_vigente(hoja_nombre, revision):
+    """La hoja está en la réplica y no cambió desde que se descargó (o tiene escrituras en cola)"""
+    if replica.columnas(hoja_nombre) is None:
+        return False
+    if hoja_nombre in _hojas_en_cola():
+        # La réplica ya tiene las escrituras encoladas; Sheets todavía no
+        return True
+    if es_particion_fria(hoja_nombre):
+        # Las particiones de años cerrados no cambian: no se vuelven a descargar por revisión
+        return True
+    return revision is None or replica.revision(hoja_nombre) == revision
+
+# =====================
+# SNAPSHOTS COLUMNARES (ARRANQUE EN FRÍO)
+# =====================
+SNAPSHOT_DIR = os.environ.get("TEXTIL_SNAPSHOT_DIR", "textil_snapshots")
+
+def _ruta_snapshot(hoja_nombre):
+    return os.path.join(SNAPSHOT_DIR, f"{hoja_nombre}.arrow")
+
+def _firma_esquema(hoja_nombre):
+    """Si cambia el esquema de la hoja, los snapshots anteriores dejan de valer"""
+    return json.dumps(ESQUEMA.get(hoja_base(hoja_nombre), {}), sort_keys=True)
+
+def guardar_snapshot(hoja_nombre, df, revision):
+    """Guarda la hoja ya tipada en formato Arrow IPC, marcada con la revisión de origen"""
+    if pa is None:
+        return
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tabla = pa.Table.from_pandas(df)
+        metadata = dict(tabla.schema.metadata or {})
+        metadata[b"revision"] = json.dumps(revision).encode("utf-8")
+        metadata[b"esquema"] = _firma_esquema(hoja_nombre).encode("utf-8")
+        tabla = tabla.replace_schema_metadata(metadata)
+        
+        # Escritura atómica: un arranque nunca ve un archivo a medio escribir
+        temporal = _ruta_snapshot(hoja_nombre) + ".tmp"
+        with pa.OSFile(temporal, "wb") as archivo:
+            with pa.ipc.new_file(archivo, tabla.schema) as escritor:
+                escritor.write_table(tabla)
+        os.replace(temporal, _ruta_snapshot(hoja_nombre))
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el snapshot de {hoja_nombre}: {str(e)}")
+
+def leer_snapshot(hoja_nombre):
+    """Lee el snapshot de la hoja: (DataFrame tipado, revisión) o (None, None)"""
+    if pa is None or not os.path.exists(_ruta_snapshot(hoja_nombre)):
+        return None, None
+    try:
+        with pa.memory_map(_ruta_snapshot(hoja_nombre), "r") as archivo:
+            tabla = pa.ipc.open_file(archivo).read_all()
+        metadata = tabla.schema.metadata or {}
+        if metadata.get(b"esquema", b"").decode("utf-8") != _firma_esquema(hoja_nombre):
+            return None, None
+        return tabla.to_pandas(), json.loads(metadata[b"revision"])
+    except Exception as e:
+        print(f"⚠️ Snapshot de {hoja_nombre} ilegible: {str(e)}")
+        return None, None
+
+@st.cache_resource
+def _cache_tipada():
+    """Hojas ya tipadas por versión local de la réplica: {hoja: (versión, DataFrame)}"""
+    return {}
+
+@st.cache_resource
+def _estado_arranque():
+    """Hojas servidas desde snapshot hasta la primera revalidación: {hoja: revisión}"""
+    return {"servidas": {}, "revalidado": False, "hilo": None, "lock": threading.Lock()}
+
+def _revalidar_snapshots(backend_sync, estado):
+    """Hilo en segundo plano: compara los snapshots servidos con la revisión actual"""
+    fijar_prioridad(PRIORIDAD_FONDO)
+    try:
+        revision = backend_sync.revision()
+        estado_revision = _estado_revision()
+        with estado_revision["lock"]:
+            estado_revision["valor"] = revision
+            estado_revision["consultada"] = time.time()
+        
+        viejas = [
+            h for h in estado["servidas"] if replica.revision(h) != revision and not es_particion_fria(h)
+        ]
+        if viejas:
+            _refrescar_replica(replica, backend_sync, viejas, revision)
+    except Exception as e:
+        print(f"⚠️ Revalidación de snapshots fallida: {str(e)}")
+    finally:
+        with estado["lock"]:
+            # Si el snapshot quedó distinto de la réplica, la próxima lectura va a la réplica
+            for hoja, revision_snapshot in estado["servidas"].items():
+                if es_particion_fria(hoja):
+                    continue
+                if replica.columnas(hoja) is not None and replica.revision(hoja) != revision_snapshot:
+                    with replica.lock:
+                        replica.versiones[hoja] += 1
+            estado["revalidado"] = True
+        print(f"🔄 Snapshots revalidados: {', '.join(estado['servidas']) or 'ninguno'}")
+
+def _desde_snapshot(hoja_nombre):
+    """En el arranque sirve la hoja desde su snapshot y revalida en segundo plano"""
+    estado = _estado_arranque()
+    with estado["lock"]:
+        if estado["revalidado"]:
+            return False
+        if hoja_nombre in estado["servidas"]:
+            return True
+        if hoja_nombre in _cache_tipada():
+            # Ya se cargó en este proceso: el snapshot es el que se acaba de escribir
+            return False
+        df, revision = leer_snapshot(hoja_nombre)
+        if df is None:
+            return False
+        _cache_tipada()[hoja_nombre] = (replica.versiones[hoja_nombre], df)
+        estado["servidas"][hoja_nombre] = revision
+        if estado["hilo"] is None and backend:
+            estado["hilo"] = threading.Thread(
+                target=_revalidar_snapshots, args=(backend, estado), daemon=True, name="revalidar-snapshots"
+            )
+            estado["hilo"].start()
+        return True
+
+def _hoja_tipada(hoja_nombre):
+    """Lee la hoja de la réplica con los tipos del esquema (se convierte una vez por versión)"""
+    cache = _cache_tipada()
+    version = replica.versiones[hoja_nombre]
+    guardada = cache.get(hoja_nombre)
+    if guardada is None or guardada[0] != version:
+        if replica.columnas(hoja_nombre) is None:
+            return pd.DataFrame()
+        guardada = (version, tipar_hoja(replica.leer(hoja_nombre), hoja_nombre))
+        cache[hoja_nombre] = guardada
+        guardar_snapshot(hoja_nombre, guardada[1], replica.revision(hoja_nombre))
+    return guardada[1].copy()
+
+def cargar_hoja(hoja_nombre):
+    """Carga una hoja tipada desde la réplica; la descarga solo si no está o si cambió
+    
+    Si la descarga falla se usa la copia local. Sin copia local se lanza HojaNoDisponible:
+    nunca se devuelve un DataFrame vacío que después pueda escribirse sobre la hoja.
+    """
+    if _desde_snapshot(hoja_nombre):
+        return _hoja_tipada(hoja_nombre)
+    
+    try:
+        revision = revision_remota()
+        if not _hoja_vigente(hoja_nombre, revision) and backend:
+            version = replica.versiones[hoja_nombre]
+            df = _descargar_hoja(backend, hoja_nombre)
+            replica.reemplazar(hoja_nombre, df, version=version, revision=revision)
+        
+    except gspread.exceptions.WorksheetNotFound:
+        # La hoja no existe en el spreadsheet: está vacía de verdad. Se replica vacía con sus
+        # encabezados para no volver a buscarla hasta que cambie la revisión (y para que los
+        # appends encolados se vean antes de que se cree)
+        if hoja_base(hoja_nombre) in COLUMNAS:
+            columnas = COLUMNAS[hoja_base(hoja_nombre)]
+            replica.reemplazar(hoja_nombre, pd.DataFrame(columns=columnas), version=version, revision=revision)
+            return _hoja_tipada(hoja_nombre)
+        return pd.DataFrame()
+    except Exception as e:
+        if replica.columnas(hoja_nombre) is None:
+            raise HojaNoDisponible(f"No se pudo cargar {hoja_nombre}: {str(e)}") from e
+        print(f"⚠️ Error al cargar {hoja_nombre}, se usa la copia local: {str(e)}")
+    
+    return _hoja_tipada(hoja_nombre)
+
+def precargar_hojas(hojas):
+    """Trae en un solo pedido todas las hojas indicadas que falten o hayan cambiado"""
+    hojas = [h for h in hojas if not _desde_snapshot(h)]
+    if not hojas:
+        return
+    revision = revision_remota()
+    faltantes = [h for h in hojas if not _hoja_vigente(h, revision)]
+    if not faltantes or not backend:
+        return
+    try:
+        _refrescar_replica(replica, backend, faltantes, revision)
+    except Exception as e:
+        # Las hojas que sigan faltando se cargan una por una en cargar_hoja
+        print(f"⚠️ Carga en lote omitida ({', '.join(faltantes)}): {str(e)}")
+
+FILAS_POR_LOTE = 5000  # Máximo de filas por llamada en escrituras grandes
+
+def _matriz_hoja(df):
+    """Arma la matriz de valores de la hoja: encabezados + filas"""
+    valores = [[str(col) for col in df.columns]]
+    valores.extend(
+        [_valor_celda(v) for v in fila] for fila in df.itertuples(index=False, name=None)
+    )
+    return valores
+
+def escribir_rango(hoja_nombre, valores):
+    """Escribe la matriz en un único rango (o en pocos lotes si es muy grande)"""
+    stats = {"llamadas": 0, "bytes": 0, "filas": len(valores)}
+    for inicio in range(0, len(valores), FILAS_POR_LOTE):
+        lote = valores[inicio:inicio + FILAS_POR_LOTE]
+        backend.escribir_rango(hoja_nombre, lote, fila=inicio + 1)
+        stats["llamadas"] += 1
+        stats["bytes"] += len(json.dumps(lote, default=str).encode("utf-8"))
+    return stats
+
+def guardar_hoja(df, hoja_nombre):
+    """Guarda DataFrame en Google Sheet (devuelve estadísticas de escritura o False)"""
+    try:
+        if not backend:
+            return False
+        
+        if len(df.columns) == 0:
+            backend.limpiar(hoja_nombre)
+            stats = {"llamadas": 1, "bytes": 0, "filas": 0}
+        else:
+            # Primero se sobrescribe y después se borra lo que sobra: si algo falla a mitad
+            # de camino la hoja nunca queda vacía (como pasaba limpiando antes de escribir)
+            valores = _matriz_hoja(df)
+            stats = escribir_rango(hoja_nombre, valores)
+            backend.recortar(hoja_nombre, len(valores) + 1)
+            stats["llamadas"] += 1
+        
+        replica.reemplazar(hoja_nombre, df)
+        print(f"📤 {hoja_nombre}: {stats['filas']} filas en {stats['llamadas']} llamadas ({stats['bytes'] / 1024:.1f} KB)")
+        return stats
+        
+    except Exception as e:
+        st.error(f"❌ Error al guardar {hoja_nombre}: {str(e)}")
+        return False
+
+def _columnas_nuevas(hoja_nombre, encabezados, registros):
+    """Columnas del esquema que traen los registros y la hoja todavía no tiene"""
+    presentes = set().union(*registros) if registros else set()
+    return [c for c in COLUMNAS.get(hoja_base(hoja_nombre), []) if c in presentes and c not in encabezados]
+
+def agregar_filas(hoja_nombre, registros, backend_destino=None):
+    """Agrega registros al final de la hoja sin reescribirla (escritura delta)"""
+    backend_destino = backend_destino or backend
+    # Respetar el orden de columnas de la hoja; si está vacía, crear encabezados
+    try:
+        encabezados = backend_destino.encabezados(hoja_nombre)
+    except gspread.exceptions.WorksheetNotFound:
+        # Hojas nuevas (p. ej. Movimientos en un spreadsheet anterior): se crean al primer append
+        encabezados = COLUMNAS[hoja_base(hoja_nombre)]
+        backend_destino.crear_hoja(hoja_nombre, encabezados)
+        print(f"🆕 Hoja {hoja_nombre} creada")
+    valores = []
+    if not encabezados:
+        encabezados = COLUMNAS[hoja_base(hoja_nombre)]
+        valores.append(encabezados)
+    nuevas = _columnas_nuevas(hoja_nombre, encabezados, registros)
+    if nuevas:
+        # Columnas que el esquema sumó después de crear la hoja: van al final del encabezado
+        backend_destino.actualizar_celdas(
+            hoja_nombre, [(1, len(encabezados) + i + 1, columna) for i, columna in enumerate(nuevas)]
+        )
+        encabezados = list(encabezados) + nuevas
+        print(f"🆕 {hoja_nombre}: columnas agregadas ({', '.join(nuevas)})")
+    valores.extend([_valor_celda(r.get(col, "")) for col in encabezados] for r in registros)
+    
+    fila = backend_destino.agregar_filas(hoja_nombre, valores)
+    stats = {"llamadas": 2, "bytes": len(json.dumps(valores, default=str).encode("utf-8")), "filas": len(registros)}
+    # Fila de la hoja donde quedó el primer registro (después de los encabezados, si se crearon)
+    stats["primera_fila"] = fila + len(valores) - len(registros) if fila else None
+    print(f"➕ {hoja_nombre}: {stats['filas']} filas agregadas ({stats['bytes'] / 1024:.1f} KB)")
+    return stats
+
+def actualizar_celdas(hoja_nombre, celdas, backend_destino=None):
+    """Actualiza solo las celdas indicadas [(fila, columna, valor)] en una llamada"""
+    backend_destino = backend_destino or backend
+    celdas = [(fila, columna, _valor_celda(valor)) for fila, columna, valor in celdas]
+    backend_destino.actualizar_celdas(hoja_nombre, celdas)
+    stats = {"llamadas": 1, "bytes": len(json.dumps(celdas, default=str).encode("utf-8")), "filas": len(celdas)}
+    print(f"✏️ {hoja_nombre}: {stats['filas']} celdas actualizadas ({stats['bytes'] / 1024:.1f} KB)")
+    return stats
+
+class MapaStock:
+    """Stock indexado por (tela, color): cada línea de una compra o un corte se ubica con un
+    diccionario en lugar de una máscara sobre toda la hoja. Se arma desde la hoja y solo
+    vuelve al formato de la hoja como mutaciones (celdas y filas nuevas)."""
+    
+    def __init__(self, df_stock):
+        columnas = list(df_stock.columns) if "Rollos" in df_stock.columns else COLUMNAS["Stock"]
+        self.columna_rollos = columnas.index("Rollos") + 1
+        self.filas = {}   # (tela, color) -> fila de la hoja (la primera, si está repetida)
+        self.rollos = {}  # (tela, color) -> rollos de esa fila
+        self.totales = defaultdict(int)  # (tela, color) -> rollos sumando filas repetidas
+        if df_stock.empty:
+            return
+        for indice, tela, color, rollos in zip(
+            df_stock.index, df_stock["Tipo de tela"], df_stock["Color"], df_stock["Rollos"]
+        ):
+            clave = (tela, color)
+            self.totales[clave] += int(rollos)
+            if clave not in self.filas:
+                self.filas[clave] = int(indice) + 2
+                self.rollos[clave] = int(rollos)
+    
+    def disponible(self, tela, color):
+        return self.totales.get((tela, color), 0)
+    
+    def mutaciones(self, tipo_tela, rollos_por_color):
+        """Mutaciones que aplican de una vez todos los deltas {color: rollos} de la tela
+        Las celdas llevan el delta y la clave de su fila para reaplicarse si otro operador
+        cambió la hoja; los colores que no están se agregan en un solo append, que se fusiona
+        con la fila de otro operador si agregó el mismo color a la vez"""
+        existentes = [(color, r) for color, r in rollos_por_color.items() if (tipo_tela, color) in self.filas]
+        nuevos = [(color, r) for color, r in rollos_por_color.items() if (tipo_tela, color) not in self.filas]
+        mutaciones = []
+        if existentes:
+            mutaciones.append({
+                "tipo": "celdas",
+                "hoja": "Stock",
+                "celdas": [
+                    (self.filas[(tipo_tela, color)], self.columna_rollos, self.rollos[(tipo_tela, color)] + r)
+                    for color, r in existentes
+                ],
+                "deltas": [r for _, r in existentes],
+                "claves": [{"Tipo de tela": tipo_tela, "Color": color} for color, _ in existentes]
+            })
+        if nuevos:
+            mutaciones.append({
+                "tipo": "agregar",
+                "hoja": "Stock",
+                "registros": [{"Tipo de tela": tipo_tela, "Color": color, "Rollos": r} for color, r in nuevos],
+                "clave_unica": ["Tipo de tela", "Color"],
+                "suma": "Rollos"
+            })
+        return mutaciones
+
+@st.cache_resource
+def _cache_mapa_stock():
+    """Último MapaStock armado: {"Stock": (versión de Stock en la réplica, MapaStock)}"""
+    return {}
+
+def mapa_stock():
+    """MapaStock de la versión vigente de Stock (se indexa una sola vez por versión)
+    Nunca se modifica: las escrituras cambian la versión y el próximo pedido lo rearma"""
+    cache = _cache_mapa_stock()
+    precargar_hojas(["Stock"])
+    version = replica.versiones["Stock"]
+    guardado = cache.get("Stock")
+    if guardado is None or guardado[0] != version:
+        guardado = (version, MapaStock(cargar_hoja("Stock")))
+        cache["Stock"] = guardado
+    return guardado[1]
+
+# =====================
+# COLA DE ESCRITURA (WRITE-BEHIND) Y DIARIO DE TRANSACCIONES
+# =====================
+COLA_REINTENTOS = 5  # Intentos antes de marcar una operación como fallida
+COLA_ESPERA = 2  # Segundos de espera base entre reintentos (se duplica en cada intento)
+
+class ColaEscritura:
+    """Diario (write-ahead journal) de las transacciones pendientes de escribir en Sheets
+    
+    Vive en la tabla _cola de la réplica. Cada transacción es una lista de mutaciones
+    que se aplican en orden:
+      {"tipo": "id", "hoja": ..., "columna": ..., "valor": ..., "referencias": [[hoja, columna]], "revision": ...}
+      {"tipo": "agregar", "hoja": ..., "registros": [{columna: valor}], "clave_unica": [columna], "suma": columna}
+      {"tipo": "celdas", "hoja": ..., "celdas": [[fila, columna, valor]], "antes": [valor],
+       "deltas": [número], "claves": [{columna: valor}]}
+      {"tipo": "borrar", "hoja": ..., "registros": [{columna: valor}], "fila": ..., "clave_unica": [columna]}
+    
+    Control de concurrencia optimista: "id" verifica que el ID asignado localmente no lo
+    haya usado otro operador (si lo usó, se reasigna en toda la transacción); "celdas"
+    solo escribe si las celdas siguen con el valor "antes" y la fila con su "claves";
+    si no, se reubica la fila y se reaplica el delta sobre el valor actual. Un "agregar"
+    con clave_unica que choca con una fila que otro operador agregó a la vez se fusiona:
+    se agregan a la transacción un "borrar" de la fila propia y las "celdas" que suman su
+    valor a la primera (ver _fusionar_repetidas).
+    
+    Por cada transacción se registra qué mutación se empezó (iniciada), cuántas quedaron
+    confirmadas (aplicadas) y su resultado (fila donde quedó cada append). Con eso, al
+    arrancar o reintentar, se sigue desde donde quedó sin duplicar filas, o se deshace.
+    Estados: pendiente -> (se borra al completar) | fallida -> pendiente o deshacer.
+    """
+    
+    def __init__(self, replica):
+        self.replica = replica
+        self.hay_trabajo = threading.Event()
+        with replica.lock:
+            replica.conn.execute(
+                "CREATE TABLE IF NOT EXISTS _cola ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, descripcion TEXT, hojas TEXT, mutaciones TEXT, "
+                "aplicadas INTEGER DEFAULT 0, intentos INTEGER DEFAULT 0, "
+                "estado TEXT DEFAULT 'pendiente', error TEXT, creada REAL)"
+            )
+            existentes = [c[1] for c in replica.conn.execute("PRAGMA table_info(_cola)")]
+            if "iniciada" not in existentes:
+                replica.conn.execute("ALTER TABLE _cola ADD COLUMN iniciada INTEGER DEFAULT -1")
+                replica.conn.execute("ALTER TABLE _cola ADD COLUMN resultados TEXT DEFAULT '{}'")
+            replica.conn.commit()
+            incompletas = replica.conn.execute(
+                "SELECT COUNT(*) FROM _cola WHERE aplicadas > 0 OR iniciada >= 0"
+            ).fetchone()[0]
+        if incompletas:
+            print(f"♻️ {incompletas} transacción(es) incompleta(s) de la ejecución anterior: se retoman")
+        # Lo que haya quedado de una ejecución anterior se drena al arrancar
+        self.hay_trabajo.set()
+    
+    def encolar(self, descripcion, mutaciones):
+        """Guarda la transacción en el diario y la refleja en la réplica; la escritura remota queda pendiente"""
+        for m in mutaciones:
+            if m["tipo"] == "agregar":
+                m["registros"] = [{c: _valor_celda(v) for c, v in r.items()} for r in m["registros"]]
+            elif m["tipo"] == "celdas":
+                m["celdas"] = [[int(f), int(c), _valor_celda(v)] for f, c, v in m["celdas"]]
+                m["deltas"] = [_valor_celda(d) for d in m.get("deltas", [])] or None
+                m["claves"] = [{c: _valor_celda(v) for c, v in k.items()} for k in m.get("claves", [])] or None
+            else:
+                m["valor"] = _valor_celda(m["valor"])
+        hojas = sorted({m["hoja"] for m in mutaciones})
+        with self.replica.lock:
+            # Valores previos de las celdas: permiten deshacer la transacción
+            for m in mutaciones:
+                if m["tipo"] == "celdas":
+                    m["antes"] = self.replica.leer_celdas(m["hoja"], m["celdas"])
+            # Primero el diario (durable) y después la réplica: nunca se muestra algo que no se va a escribir
+            self.replica.conn.execute(
+                "INSERT INTO _cola (descripcion, hojas, mutaciones, creada) VALUES (?, ?, ?, ?)",
+                (descripcion, json.dumps(hojas), json.dumps(mutaciones), time.time())
+            )
+            self.replica.conn.commit()
+            for m in mutaciones:
+                if m["tipo"] == "agregar":
+                    encabezados = self.replica.columnas(m["hoja"]) or COLUMNAS[m["hoja"]]
+                    encabezados = encabezados + _columnas_nuevas(m["hoja"], encabezados, m["registros"])
+                    valores = [[r.get(c, "") for c in encabezados] for r in m["registros"]]
+                    self.replica.agregar(m["hoja"], encabezados, valores)
+                elif m["tipo"] == "celdas":
+                    self.replica.actualizar(m["hoja"], m["celdas"])
+        self.hay_trabajo.set()
+        print(f"📝 Encolada: {descripcion}")
+    
+    def siguiente(self):
+        """Transacción más antigua a procesar: (id, descripción, estado, mutaciones, aplicadas, iniciada, resultados)"""
+        with self.replica.lock:
+            fila = self.replica.conn.execute(
+                "SELECT id, descripcion, estado, mutaciones, aplicadas, iniciada, resultados FROM _cola "
+                "WHERE estado IN ('pendiente', 'deshacer') ORDER BY id LIMIT 1"
+            ).fetchone()
+        if fila is None:
+            return None
+        return fila[:3] + (json.loads(fila[3]), fila[4], fila[5], json.loads(fila[6] or "{}"))
+    
+    def iniciar(self, op_id, indice):
+        """Anota en el diario que la mutación está por aplicarse (antes de llamar a la API)"""
+        with self.replica.lock:
+            self.replica.conn.execute("UPDATE _cola SET iniciada = ? WHERE id = ?", (indice, op_id))
+            self.replica.conn.commit()
+    
+    def avanzar(self, op_id, aplicadas, resultados):
+        """Registra cuántas mutaciones de la transacción ya están en Sheets y dónde quedaron"""
+        with self.replica.lock:
+            self.replica.conn.execute(
+                "UPDATE _cola SET aplicadas = ?, iniciada = -1, resultados = ? WHERE id = ?",
+                (aplicadas, json.dumps(resultados), op_id)
+            )
+            self.replica.conn.commit()
+    
+    def reescribir(self, op_id, mutaciones):
+        """Guarda las mutaciones corregidas (p. ej. con un ID reasignado)"""
+        with self.replica.lock:
+            self.replica.conn.execute("UPDATE _cola SET mutaciones = ? WHERE id = ?", (json.dumps(mutaciones), op_id))
+            self.replica.conn.commit()
+    
+    def completar(self, op_id):
+        with self.replica.lock:
+            self.replica.conn.execute("DELETE FROM _cola WHERE id = ?", (op_id,))
+            self.replica.conn.commit()
+    
+    def fallar(self, op_id, error):
+        """Cuenta un intento fallido; devuelve la cantidad de intentos
+        Al quedar fallida, sus hojas se vuelven a descargar: la réplica muestra lo que hay en Sheets"""
+        with self.replica.lock:
+            self.replica.conn.execute(
+                "UPDATE _cola SET intentos = intentos + 1, error = ?, "
+                "estado = CASE WHEN intentos + 1 >= ? THEN 'fallida' ELSE estado END WHERE id = ?",
+                (error, COLA_REINTENTOS, op_id)
+            )
+            self.replica.conn.commit()
+            intentos, estado, hojas = self.replica.conn.execute(
+                "SELECT intentos, estado, hojas FROM _cola WHERE id = ?", (op_id,)
+            ).fetchone()
+            if estado == "fallida":
+                for hoja in json.loads(hojas):
+                    self.replica.marcar_vieja(hoja)
+            return intentos
+    
+    def reintentar_fallidas(self):
+        with self.replica.lock:
+            self.replica.conn.execute("UPDATE _cola SET estado = 'pendiente', intentos = 0 WHERE estado = 'fallida'")
+            self.replica.conn.commit()
+        self.hay_trabajo.set()
+    
+    def deshacer(self, op_id):
+        """Pide deshacer una transacción fallida (lo hace el hilo de la cola)"""
+        with self.replica.lock:
+            self.replica.conn.execute(
+                "UPDATE _cola SET estado = 'deshacer', intentos = 0 WHERE id = ? AND estado = 'fallida'", (op_id,)
+            )
+            self.replica.conn.commit()
+        self.hay_trabajo.set()
+    
+    def resumen(self):
+        """Cantidad de transacciones por estado: {"pendiente": n, "fallida": m, ...}"""
+        with self.replica.lock:
+            filas = self.replica.conn.execute("SELECT estado, COUNT(*) FROM _cola GROUP BY estado").fetchall()
+        return dict(filas)
+    
+    def fallidas(self):
+        with self.replica.lock:
+            return self.replica.conn.execute(
+                "SELECT id, descripcion, error FROM _cola WHERE estado = 'fallida' ORDER BY id"
+            ).fetchall()
+    
+    def hojas_pendientes(self, excepto=None, con_fallidas=False):
+        """Hojas con escrituras en curso: no se re-descargan hasta drenar la cola
+        
+        Las transacciones fallidas no cuentan: esperan una decisión del usuario y no deben
+        congelar el refresco. Sí cuentan con con_fallidas (archivo, checkpoints), porque
+        todavía se pueden reintentar o deshacer.
+        excepto: id de una transacción cuyas hojas no se cuentan"""
+        estados = ("pendiente", "deshacer", "fallida") if con_fallidas else ("pendiente", "deshacer")
+        with self.replica.lock:
+            filas = self.replica.conn.execute(
+                f"SELECT hojas FROM _cola WHERE id IS NOT ? AND estado IN ({', '.join('?' * len(estados))})",
+                (excepto, *estados)
+            ).fetchall()
+        return {hoja for (hojas,) in filas for hoja in json.loads(hojas)}
+
+def _ubicar_agregado(backend_destino, mutacion, fila_esperada=None, registros_hoja=None):
+    """Busca en la hoja las filas de un append; devuelve la fila de la primera o None
+    registros_hoja: la hoja ya cargada, para no volver a pedirla"""
+    registros = mutacion["registros"]
+    if not registros:
+        return None
+    if registros_hoja is None:
+        registros_hoja = backend_destino.cargar(mutacion["hoja"])
+    columnas = sorted(registros[0])
+    esperadas = [tuple(_normalizar(r.get(c, "")) for c in columnas) for r in registros]
+    remotas = [tuple(_normalizar(fila.get(c, "")) for c in columnas) for fila in registros_hoja]
+    n = len(esperadas)
+    candidatas = range(len(remotas) - n, -1, -1)  # Desde el final: lo más probable
+    if fila_esperada is not None:
+        candidatas = itertools.chain([fila_esperada - 2], candidatas)
+    for inicio in candidatas:
+        if 0 <= inicio and remotas[inicio:inicio + n] == esperadas:
+            return inicio + 2
+    return None
+
+CONFLICTO_REINTENTOS = 3  # Veces que se reaplica un delta si la hoja sigue cambiando
+
+def _numero(valor):
+    """Valor numérico de una celda (vacía = 0), entero si no tiene decimales"""
+    numero = _normalizar(valor)
+    numero = numero if isinstance(numero, float) else 0.0
+    return int(numero) if numero.is_integer() else numero
+
+def _verificar_id(backend_destino, mutacion):
+    """ID definitivo: el asignado localmente, o el siguiente libre si otro operador lo usó"""
+    if mutacion.get("revision") and backend_destino.revision() == mutacion["revision"]:
+        return mutacion["valor"]  # Nadie escribió desde que se leyó la hoja
+    existentes = [_normalizar(v) for v in backend_destino.valores_columna(mutacion["hoja"], mutacion["columna"])]
+    if _normalizar(mutacion["valor"]) not in existentes:
+        return mutacion["valor"]
+    return int(max((v for v in existentes if isinstance(v, float)), default=0)) + 1
+
+def _reasignar_id(mutaciones, mutacion_id, nuevo, replica_local):
+    """Cambia el ID en todos los registros de la transacción que lo usan y en la réplica"""
+    viejo = mutacion_id["valor"]
+    columnas = [(mutacion_id["hoja"], mutacion_id["columna"])] + [tuple(r) for r in mutacion_id["referencias"]]
+    for m in mutaciones:
+        if m["tipo"] != "agregar":
+            continue
+        for hoja, columna in columnas:
+            if m["hoja"] == hoja:
+                for registro in m["registros"]:
+                    if _normalizar(registro.get(columna)) == _normalizar(viejo):
+                        registro[columna] = nuevo
+    # En la réplica, las filas con el ID viejo solo pueden ser las de esta transacción:
+    # las hojas con escrituras pendientes no se vuelven a descargar
+    for hoja, columna in columnas:
+        replica_local.reasignar(hoja, columna, viejo, nuevo)
+    mutacion_id["valor"] = nuevo
+
+def _aplicar_celdas(backend_destino, mutacion, quizas_aplicada=False):
+    """Escribe celdas con control de concurrencia optimista (ver ColaEscritura)
+    quizas_aplicada: un intento anterior se cortó y pudo haber escrito las celdas"""
+    hoja = mutacion["hoja"]
+    if mutacion.get("antes") is None:
+        return actualizar_celdas(hoja, mutacion["celdas"], backend_destino)
+    celdas = [list(c) for c in mutacion["celdas"]]
+    antes = list(mutacion["antes"])
+    claves = mutacion.get("claves") or [{} for _ in celdas]
+    deltas = mutacion.get("deltas")
+    encabezados = backend_destino.encabezados(hoja) if any(claves) else []
+    
+    for intento in range(CONFLICTO_REINTENTOS + 1):
+        esperados = [(f, c, a) for (f, c, _), a in zip(celdas, antes)]
+        for (fila, _, _), clave in zip(celdas, claves):
+            esperados.extend((fila, encabezados.index(col) + 1, val) for col, val in clave.items())
+        try:
+            backend_destino.actualizar_celdas_si(hoja, celdas, esperados)
+            print(f"✏️ {hoja}: {len(celdas)} celdas actualizadas" + (f" (tras {intento} conflicto/s)" if intento else ""))
+            return
+        except ConflictoEscritura as conflicto:
+            actuales = conflicto.actuales
+        
+        n = len(celdas)
+        claves_ok = all(_normalizar(a) == _normalizar(e[2]) for a, e in zip(actuales[n:], esperados[n:]))
+        if quizas_aplicada and intento == 0 and claves_ok and all(
+            _normalizar(a) == _normalizar(v) for a, (_, _, v) in zip(actuales[:n], celdas)
+        ):
+            return  # Ya estaba aplicada (el intento anterior llegó a escribir)
+        if deltas is None:
+            raise ConflictoEscritura(f"Conflicto en {hoja}: otro operador cambió las celdas {[c[:2] for c in celdas]}")
+        
+        if claves_ok:
+            valores = actuales[:n]
+        else:
+            # Las filas se movieron: se ubican por su clave
+            registros = backend_destino.cargar(hoja)
+            valores = []
+            for celda, clave in zip(celdas, claves):
+                ubicadas = [
+                    i for i, r in enumerate(registros)
+                    if all(_normalizar(r.get(col, "")) == _normalizar(val) for col, val in clave.items())
+                ]
+                if not ubicadas:
+                    raise ConflictoEscritura(f"Conflicto en {hoja}: ya no existe la fila {clave}")
+                celda[0] = ubicadas[0] + 2
+                valores.append(registros[ubicadas[0]].get(encabezados[celda[1] - 1], ""))
+        
+        # Reaplicar el delta sobre el valor actual
+        antes = valores
+        celdas = [[f, c, _numero(actual) + delta] for (f, c, _), actual, delta in zip(celdas, valores, deltas)]
+        print(f"🔀 Conflicto en {hoja}: se reaplica el delta sobre los valores actuales")
+    
+    raise ConflictoEscritura(f"Conflicto en {hoja}: la hoja siguió cambiando después de {CONFLICTO_REINTENTOS} reintentos")
+
+def _confirmar_id(backend_destino, mutaciones, mutacion_id, mutacion, fila, replica_local):
+    """Después del append (mutacion, que quedó en fila): si otro operador agregó el mismo ID
+    a la vez, se queda con él la fila que quedó primero y esta toma el siguiente libre
+    
+    Una fila reasignada cede ante cualquier otra con su nuevo ID, aunque esté más abajo:
+    esa otra pudo haberse confirmado antes de que esta cambiara su ID. Las filas que chocan
+    toman libres distintos según su orden, para no volver a chocar entre ellas. Si la fila
+    ya no está donde quedó (otra sesión borró o archivó filas), se la vuelve a ubicar."""
+    if fila is None:
+        return
+    hoja, columna = mutacion_id["hoja"], mutacion_id["columna"]
+    reasignada = False
+    while True:
+        valores = [_normalizar(v) for v in backend_destino.valores_columna(hoja, columna)]
+        propio = _normalizar(mutacion_id["valor"])
+        filas_propias = [i + 2 for i, v in enumerate(valores) if v == propio]
+        if fila not in filas_propias:
+            fila = _ubicar_agregado(backend_destino, mutacion, fila)
+            if fila is None:
+                print(f"⚠️ {hoja}: la fila con el ID {mutacion_id['valor']} ya no está en la hoja, no se confirma el ID")
+                return
+            continue
+        if filas_propias == [fila] or not reasignada and filas_propias[0] >= fila:
+            return
+        orden = filas_propias.index(fila)
+        nuevo = int(max((v for v in valores if isinstance(v, float)), default=0)) + 1 + orden
+        print(f"🔀 {hoja}: el ID {mutacion_id['valor']} se agregó a la vez en otra sesión, se reasigna a {nuevo}")
+        col = backend_destino.encabezados(hoja).index(columna) + 1
+        backend_destino.actualizar_celdas(hoja, [(fila, col, nuevo)])
+        _reasignar_id(mutaciones, mutacion_id, nuevo, replica_local)
+        reasignada = True
+
+def _clave_unica(registro, columnas):
+    return tuple(_normalizar(registro.get(c, "")) for c in columnas)
+
+def _fusionar_repetidas(backend_destino, mutacion, fila):
+    """Después de un append con clave_unica (fila: donde quedó): si otro operador agregó la
+    misma clave a la vez, la fila que quedó primero se queda con todo. Devuelve las mutaciones
+    que completan la fusión: un "borrar" por cada fila propia repetida y unas "celdas" que
+    suman su valor (columna "suma") a la primera fila de su clave, en ese orden (mientras
+    tanto el stock queda de menos, nunca de más)"""
+    if fila is None:
+        return []
+    hoja, columnas = mutacion["hoja"], mutacion["clave_unica"]
+    registros_hoja = backend_destino.cargar(hoja)
+    fila = _ubicar_agregado(backend_destino, mutacion, fila, registros_hoja)
+    if fila is None:
+        return []
+    primeras = {}
+    for i, registro in enumerate(registros_hoja):
+        primeras.setdefault(_clave_unica(registro, columnas), i)
+    
+    repetidas = [
+        (fila + k, registro, primeras[_clave_unica(registro, columnas)])
+        for k, registro in enumerate(mutacion["registros"])
+        if primeras[_clave_unica(registro, columnas)] < fila - 2 + k
+    ]
+    if not repetidas:
+        return []
+    print(f"🔀 {hoja}: {len(repetidas)} fila/s se agregaron a la vez en otra sesión, se fusionan con la primera")
+    columna = backend_destino.encabezados(hoja).index(mutacion["suma"]) + 1
+    borrados = [
+        {"tipo": "borrar", "hoja": hoja, "registros": [registro], "fila": propia, "clave_unica": columnas}
+        for propia, registro, _ in repetidas
+    ]
+    antes = [registros_hoja[primera].get(mutacion["suma"], "") for _, _, primera in repetidas]
+    deltas = [_numero(registro.get(mutacion["suma"])) for _, registro, _ in repetidas]
+    suma = {
+        "tipo": "celdas",
+        "hoja": hoja,
+        "celdas": [[primera + 2, columna, _numero(a) + d] for (_, _, primera), a, d in zip(repetidas, antes, deltas)],
+        "antes": antes,
+        "deltas": deltas,
+        "claves": [{c: registro.get(c, "") for c in columnas} for _, registro, _ in repetidas]
+    }
+    return borrados + [suma]
+
+def _ubicar_repetida(backend_destino, mutacion):
+    """Fila de un "borrar": la del registro, siempre que no sea la primera de su clave"""
+    registro, columnas = mutacion["registros"][0], mutacion["clave_unica"]
+    registros_hoja = backend_destino.cargar(mutacion["hoja"])
+    primera = next(
+        (i for i, r in enumerate(registros_hoja) if _clave_unica(r, columnas) == _clave_unica(registro, columnas)), None
+    )
+    fila = _ubicar_agregado(backend_destino, mutacion, mutacion.get("fila"), registros_hoja)
+    if fila is None or fila - 2 <= primera:
+        return None
+    return fila
+
+def _borrar_repetida(backend_destino, mutacion):
+    """Borra la fila de un "borrar" si sigue con su contenido; si otras filas se movieron,
+    se vuelve a ubicar. Si ya no está, el borrado ya se aplicó"""
+    hoja, registro = mutacion["hoja"], mutacion["registros"][0]
+    encabezados = backend_destino.encabezados(hoja)
+    for intento in range(CONFLICTO_REINTENTOS + 1):
+        fila = _ubicar_repetida(backend_destino, mutacion)
+        if fila is None:
+            print(f"♻️ {hoja}: la fila repetida ya estaba borrada")
+            return
+        esperados = [(fila, encabezados.index(c) + 1, v) for c, v in registro.items()]
+        try:
+            backend_destino.borrar_filas_si(hoja, fila, fila, esperados)
+            print(f"🗑️ {hoja}: fila repetida {fila} eliminada")
+            return
+        except ConflictoEscritura:
+            continue
+    raise ConflictoEscritura(f"Conflicto en {hoja}: la hoja siguió cambiando después de {CONFLICTO_REINTENTOS} reintentos")
+
+def _escribir_mutacion(backend_destino, mutacion, quizas_aplicada=False):
+    """Aplica una mutación del diario en Google Sheets; devuelve la fila inicial de un append"""
+    if mutacion["tipo"] == "agregar":
+        return agregar_filas(mutacion["hoja"], mutacion["registros"], backend_destino)["primera_fila"]
+    if mutacion["tipo"] == "borrar":
+        _borrar_repetida(backend_destino, mutacion)
+        return None
+    _aplicar_celdas(backend_destino, mutacion, quizas_aplicada)
+    return None
+
+def _compensar_mutacion(backend_destino, mutacion, fila_registrada=None):
+    """Deshace en Google Sheets una mutación ya aplicada"""
+    if mutacion["tipo"] == "agregar":
+        # Se verifica por contenido: otras operaciones pudieron mover las filas
+        fila = _ubicar_agregado(backend_destino, mutacion, fila_registrada)
+        if fila is not None:
+            backend_destino.borrar_filas(mutacion["hoja"], fila, fila + len(mutacion["registros"]) - 1)
+            print(f"↩️ {mutacion['hoja']}: {len(mutacion['registros'])} filas eliminadas")
+    elif mutacion["tipo"] == "borrar":
+        # Se vuelve a agregar la fila repetida (si todavía está, el borrado no llegó)
+        if _ubicar_repetida(backend_destino, mutacion) is None:
+            agregar_filas(mutacion["hoja"], mutacion["registros"], backend_destino)
+            print(f"↩️ {mutacion['hoja']}: fila repetida restaurada")
+    elif mutacion["tipo"] == "celdas":
+        # La inversa: volver al valor anterior, o restar el delta si la celda cambió después
+        inversa = dict(mutacion)
+        inversa["celdas"] = [[f, c, antes] for (f, c, _), antes in zip(mutacion["celdas"], mutacion["antes"])]
+        inversa["antes"] = [v for _, _, v in mutacion["celdas"]]
+        if mutacion.get("deltas"):
+            inversa["deltas"] = [-d for d in mutacion["deltas"]]
+        _aplicar_celdas(backend_destino, inversa)
+
+def _aplicar_transaccion(cola, backend_cola, op_id, mutaciones, aplicadas, iniciada, resultados):
+    """Sigue la transacción desde la primera mutación sin confirmar (roll-forward)
+    La lista puede crecer mientras se aplica: la fusión de filas repetidas agrega mutaciones"""
+    i = aplicadas
+    while i < len(mutaciones):
+        mutacion = mutaciones[i]
+        if mutacion["tipo"] == "id":
+            nuevo = _verificar_id(backend_cola, mutacion)
+            if _normalizar(nuevo) != _normalizar(mutacion["valor"]):
+                print(f"🔀 {mutacion['hoja']}: el ID {mutacion['valor']} ya lo usó otro operador, se reasigna a {nuevo}")
+                _reasignar_id(mutaciones, mutacion, nuevo, cola.replica)
+                cola.reescribir(op_id, mutaciones)
+            cola.avanzar(op_id, i + 1, resultados)
+            i += 1
+            continue
+        fila = None
+        if i == iniciada and mutacion["tipo"] == "agregar":
+            # Se cortó entre la llamada y su confirmación: el append puede haber llegado
+            fila = _ubicar_agregado(backend_cola, mutacion)
+            if fila is not None:
+                print(f"♻️ {mutacion['hoja']}: el append ya estaba aplicado (fila {fila})")
+        if fila is None:
+            cola.iniciar(op_id, i)
+            fila = _escribir_mutacion(backend_cola, mutacion, quizas_aplicada=(i == iniciada))
+        resultados[str(i)] = fila
+        
+        # El registro que lleva el ID: confirmar que nadie agregó el mismo a la vez
+        mutacion_id = mutaciones[0] if mutaciones[0]["tipo"] == "id" else None
+        if mutacion_id and mutacion["tipo"] == "agregar" and mutacion["hoja"] == mutacion_id["hoja"]:
+            valor_previo = mutacion_id["valor"]
+            _confirmar_id(backend_cola, mutaciones, mutacion_id, mutacion, fila, cola.replica)
+            if mutacion_id["valor"] != valor_previo:
+                cola.reescribir(op_id, mutaciones)
+        
+        # Filas con clave única (Stock): si otro operador agregó la misma a la vez, se fusionan.
+        # Las mutaciones de la fusión quedan en el diario antes de confirmar el append
+        if mutacion["tipo"] == "agregar" and mutacion.get("clave_unica") and not mutacion.get("fusionada"):
+            fusion = _fusionar_repetidas(backend_cola, mutacion, fila)
+            if fusion:
+                mutacion["fusionada"] = True
+                mutaciones[i + 1:i + 1] = fusion
+                cola.reescribir(op_id, mutaciones)
+        cola.avanzar(op_id, i + 1, resultados)
+        i += 1
+
+def _deshacer_transaccion(cola, backend_cola, op_id, mutaciones, aplicadas, resultados):
+    """Compensa en orden inverso las mutaciones aplicadas y descarta las hojas de la réplica"""
+    for i in range(aplicadas - 1, -1, -1):
+        _compensar_mutacion(backend_cola, mutaciones[i], resultados.get(str(i)))
+        cola.avanzar(op_id, i, resultados)
+    # La réplica tiene la transacción completa: se vuelve a descargar lo que hay en Sheets.
+    # Las hojas con otras transacciones en cola se conservan (al descartarlas, esas escrituras
+    # desaparecerían de la vista local hasta drenarse): se descargan cuando la cola las libere
+    otras = cola.hojas_pendientes(excepto=op_id)
+    for hoja in {m["hoja"] for m in mutaciones}:
+        if hoja in otras:
+            cola.replica.marcar_vieja(hoja)
+        else:
+            cola.replica.descartar(hoja)
+
+def _drenar_cola(cola):
+    """Hilo en segundo plano: escribe en Sheets las transacciones del diario, en orden"""
+    fijar_prioridad(PRIORIDAD_ESCRITURA)
+    while True:
+        cola.hay_trabajo.wait(SYNC_INTERVALO)
+        cola.hay_trabajo.clear()
+        while True:
+            operacion = cola.siguiente()
+            if operacion is None:
+                break
+            op_id, descripcion, estado, mutaciones, aplicadas, iniciada, resultados = operacion
+            try:
+                backend_cola = init_connection()
+                if not backend_cola:
+                    raise ConnectionError("sin conexión a Google Sheets")
+                if estado == "deshacer":
+                    # Sin registro de que se empezó, la mutación en curso no llegó: no hay que compensarla
+                    _deshacer_transaccion(
+                        cola, backend_cola, op_id, mutaciones, aplicadas + (1 if iniciada == aplicadas else 0), resultados
+                    )
+                    cola.completar(op_id)
+                    print(f"↩️ Deshecha: {descripcion}")
+                else:
+                    _aplicar_transaccion(cola, backend_cola, op_id, mutaciones, aplicadas, iniciada, resultados)
+                    cola.completar(op_id)
+                    print(f"✅ Sincronizada: {descripcion}")
+            except Exception as e:
+                intentos = cola.fallar(op_id, str(e))
+                print(f"⚠️ {descripcion}: intento {intentos} fallido ({str(e)})")
+                time.sleep(COLA_ESPERA * 2 ** (intentos - 1))
+
+@st.cache_resource
+def init_cola():
+    """Abre el diario de escrituras, retoma lo incompleto y arranca el hilo que lo drena (una vez por proceso)"""
+    cola = ColaEscritura(replica)
+    threading.Thread(target=_drenar_cola, args=(cola,), daemon=True, name="cola-escritura").start()
+    return cola
+
+cola = init_cola()
+
+# =====================
+# SECUENCIAS DE IDS
+# =====================
+BLOQUE_IDS = 10  # IDs que se reservan de una vez en la tabla de secuencias
+
+class SecuenciaIds:
+    """IDs monotónicos por hoja sin leer la hoja (tabla _secuencias de la réplica)
+    
+    Cada proceso reserva bloques de BLOQUE_IDS con un UPDATE atómico y los reparte desde
+    memoria; un ID nunca se reutiliza aunque se borren filas. El siguiente ID nunca es menor
+    que el máximo de la réplica, así que los IDs que llegan de otros operadores se respetan.
+    """
+    
+    def __init__(self, replica, bloque=BLOQUE_IDS):
+        self.replica = replica
+        self.bloque = bloque
+        self.bloques = {}  # hoja -> (siguiente, último reservado)
+        # Lock propio: reservar puede leer Sheets y eso no debe frenar las lecturas de la réplica
+        self.lock = threading.Lock()
+        with replica.lock:
+            replica.conn.execute("CREATE TABLE IF NOT EXISTS _secuencias (hoja TEXT PRIMARY KEY, ultimo INTEGER)")
+            replica.conn.commit()
+    
+    def _semilla(self, hoja, columna):
+        """Mayor ID existente: de la réplica (o, si no está, solo de esa columna en Sheets) y de
+        las particiones frías, por si la hoja caliente quedó vacía al archivar"""
+        maximo = self.replica.maximo(hoja, columna)
+        remotas = [hoja] if self.replica.columnas(hoja) is None else []
+        if hoja in HOJAS_ARCHIVO:
+            remotas.extend(particiones(hoja).values())
+        for remota in remotas if backend else []:
+            try:
+                numeros = [v for v in map(_normalizar, backend.valores_columna(remota, columna)) if isinstance(v, float)]
+                maximo = max([maximo] + [int(v) for v in numeros])
+            except Exception as e:
+                print(f"⚠️ No se pudo leer la columna {columna} de {remota}: {str(e)}")
+        return maximo
+    
+    def _reservar(self, hoja, columna, piso):
+        """Reserva un bloque nuevo que empieza en piso o después: (primero, último)
+        La semilla (puede leer Sheets) se calcula antes de tomar el lock de la réplica"""
+        with self.replica.lock:
+            sembrada = self.replica.conn.execute("SELECT 1 FROM _secuencias WHERE hoja = ?", (hoja,)).fetchone()
+        semilla = None if sembrada else self._semilla(hoja, columna)
+        with self.replica.lock:
+            if semilla is not None:
+                self.replica.conn.execute("INSERT OR IGNORE INTO _secuencias VALUES (?, ?)", (hoja, semilla))
+            ultimo = self.replica.conn.execute(
+                "UPDATE _secuencias SET ultimo = MAX(ultimo + 1, ?) + ? - 1 WHERE hoja = ? RETURNING ultimo",
+                (piso, self.bloque, hoja)
+            ).fetchone()[0]
+            self.replica.conn.commit()
+        return ultimo - self.bloque + 1, ultimo
+    
+    def siguiente(self, hoja, columna="ID"):
+        with self.lock:
+            piso = self.replica.maximo(hoja, columna) + 1
+            siguiente, ultimo = self.bloques.get(hoja, (0, -1))
+            siguiente = max(siguiente, piso)
+            if siguiente > ultimo:
+                siguiente, ultimo = self._reservar(hoja, columna, piso)
+            self.bloques[hoja] = (siguiente + 1, ultimo)
+            return siguiente
+
+@st.cache_resource
+def init_secuencias():
+    return SecuenciaIds(replica)
+
+secuencias = init_secuencias()
+
+# =====================
+# ARCHIVO HISTÓRICO (PARTICIONES POR AÑO)
+# =====================
+ARCHIVO_AUTOMATICO = os.environ.get("TEXTIL_ARCHIVO_AUTOMATICO", "1") == "1"
+ARCHIVO_GRACIA_DIAS = 60  # Al empezar el año, el anterior sigue abierto este tiempo (cargas atrasadas)
+ARCHIVO_INTERVALO = 3600  # Segundos entre revisiones del archivo y entre listados de hojas frías
+
+def _ultimo_anio_archivable():
+    return (date.today() - timedelta(days=ARCHIVO_GRACIA_DIAS)).year - 1
+
+def _ids_a_archivar(cabecera, df_cabecera, df_talleres=None):
+    """{año: IDs} de la cabecera con fecha en años cerrados
+    Un corte solo se archiva cuando su taller lo entregó completo: hasta entonces el tablero lo usa"""
+    if df_cabecera.empty or "Fecha" not in df_cabecera.columns:
+        return {}
+    df = df_cabecera[df_cabecera["Fecha"].dt.year <= _ultimo_anio_archivable()]
+    if cabecera == "Cortes":
+        if df_talleres is None or df_talleres.empty:
+            return {}
+        df = df[df["ID"].isin(df_talleres.loc[df_talleres["Estado"] == "ENTREGADO", "ID Corte"])]
+    return {int(anio): set(grupo["ID"]) for anio, grupo in df.groupby(df["Fecha"].dt.year)}
+
+def _rangos(filas):
+    """Filas agrupadas en rangos contiguos (inicio, fin), de abajo hacia arriba"""
+    rangos = []
+    for fila in sorted(filas):
+        if rangos and rangos[-1][1] == fila - 1:
+            rangos[-1][1] = fila
+        else:
+            rangos.append([fila, fila])
+    return [tuple(r) for r in reversed(rangos)]
+
+def _archivar_hoja(backend_destino, hoja, columna, anio_por_id, registros, titulos):
+    """Copia a la hoja fría de cada año las filas cuyo ID se archiva y las borra de la caliente
+    
+    Se puede repetir si se corta: solo se copian los IDs que la fría todavía no tiene, y cada
+    rango se borra después de comprobar que sus extremos siguen teniendo los IDs esperados.
+    """
+    filas = defaultdict(list)  # año -> filas de la hoja caliente (la 2 es la primera de datos)
+    for fila, registro in enumerate(registros, start=2):
+        anio = anio_por_id.get(_normalizar(registro.get(columna, "")))
+        if anio is not None:
+            filas[anio].append(fila)
+    if not filas:
+        return 0
+    
+    encabezados = list(registros[0])
+    for anio, filas_anio in sorted(filas.items()):
+        fria = f"{hoja}_{anio}"
+        if fria in titulos:
+            copiados = set(map(_normalizar, backend_destino.valores_columna(fria, columna)))
+        else:
+            # Con los encabezados de la caliente (puede tener columnas que el esquema no conoce)
+            backend_destino.crear_hoja(fria, encabezados)
+            titulos.add(fria)
+            print(f"🆕 Hoja {fria} creada")
+            copiados = set()
+        nuevos = [registros[f - 2] for f in filas_anio if _normalizar(registros[f - 2][columna]) not in copiados]
+        if nuevos:
+            agregar_filas(fria, nuevos, backend_destino)
+    
+    indice = encabezados.index(columna) + 1
+    for inicio, fin in _rangos(f for filas_anio in filas.values() for f in filas_anio):
+        esperados = [_normalizar(registros[f - 2][columna]) for f in (inicio, fin)]
+        actuales = backend_destino.leer_celdas(hoja, [(inicio, indice), (fin, indice)])
+        if [_normalizar(v) for v in actuales] != esperados:
+            raise ConflictoEscritura(f"{hoja}: las filas {inicio}-{fin} cambiaron, se archiva en la próxima revisión", actuales)
+        backend_destino.borrar_filas(hoja, inicio, fin)
+    total = sum(len(f) for f in filas.values())
+    print(f"🗄️ {hoja}: {total} filas archivadas ({', '.join(map(str, sorted(filas)))})")
+    return total
+
+def archivar_cerrados(backend_destino):
+    """Pasa los años cerrados de Compras y Cortes (con las hojas que dependen de ellos por ID)
+    a sus hojas frías; devuelve {hoja: filas archivadas}"""
+    archivadas = {}
+    pendientes = cola.hojas_pendientes(con_fallidas=True)
+    titulos = set(backend_destino.titulos())
+    for cabecera, hijas in HOJAS_ARCHIVO.items():
+        familia = [h for h in [cabecera, *hijas] if h in titulos]
+        if cabecera not in titulos:
+            continue
+        if pendientes.intersection(familia):
+            print(f"⏳ Archivo de {cabecera} postergado: hay escrituras en cola")
+            continue
+        datos = backend_destino.cargar_varias(familia + (["Talleres"] if cabecera == "Cortes" and "Talleres" in titulos else []))
+        df_talleres = tipar_hoja(pd.DataFrame(datos["Talleres"]), "Talleres") if "Talleres" in datos else None
+        ids = _ids_a_archivar(cabecera, tipar_hoja(pd.DataFrame(datos[cabecera]).dropna(how="all"), cabecera), df_talleres)
+        if not ids:
+            continue
+        anio_por_id = {_normalizar(i): anio for anio, lista in ids.items() for i in lista}
+        
+        # La cabecera va al final: si se corta a mitad, al repetir sus IDs siguen en la caliente
+        try:
+            for hoja, columna in [*((h, hijas[h]) for h in familia if h != cabecera), (cabecera, "ID")]:
+                archivadas[hoja] = _archivar_hoja(backend_destino, hoja, columna, anio_por_id, datos[hoja], titulos)
+        finally:
+            for hoja in familia:
+                replica.descartar(hoja)
+            with _estado_particiones()["lock"]:
+                _estado_particiones()["titulos"] = None
+    return archivadas
+
+def _hay_para_archivar():
+    """Según la réplica local, alguna hoja caliente tiene años cerrados"""
+    for cabecera in HOJAS_ARCHIVO:
+        if replica.columnas(cabecera) is None:
+            continue
+        df_talleres = _hoja_tipada("Talleres") if cabecera == "Cortes" else None
+        if _ids_a_archivar(cabecera, _hoja_tipada(cabecera), df_talleres):
+            return True
+    return False
+
+@st.cache_resource
+def _estado_particiones():
+    """Títulos de las hojas del spreadsheet (para ubicar las frías), compartidos por las sesiones"""
+    return {"titulos": None, "consultada": 0.0, "lock": threading.Lock()}
+
+def particiones(hoja_nombre):
+    """Hojas frías de la hoja: {año: título}"""
+    estado = _estado_particiones()
+    with estado["lock"]:
+        if backend and (estado["titulos"] is None or time.time() - estado["consultada"] >= ARCHIVO_INTERVALO):
+            try:
+                estado["titulos"] = backend.titulos()
+            except Exception as e:
+                print(f"⚠️ No se pudieron listar las hojas: {str(e)}")
+            estado["consultada"] = time.time()
+        titulos = estado["titulos"] or []
+    return {
+        int(titulo.rpartition("_")[2]): titulo
+        for titulo in titulos if titulo != hoja_nombre and hoja_base(titulo) == hoja_nombre
+    }
+
+def cargar_historico(hoja_nombre, anios=None):
+    """La hoja caliente más sus particiones frías (todas, o las de esos años)
+    Las frías se descargan una sola vez: después se leen de la réplica"""
+    frias = [titulo for anio, titulo in sorted(particiones(hoja_nombre).items()) if anios is None or anio in anios]
+    precargar_hojas(frias + [hoja_nombre])
+    partes = [df for df in map(cargar_hoja, frias + [hoja_nombre]) if not df.empty]
+    if len(partes) < 2:
+        return partes[0] if partes else pd.DataFrame()
+    df = pd.concat(partes, ignore_index=True)
+    # concat pierde las categorías si no coinciden entre años
+    for columna, tipo in ESQUEMA.get(hoja_nombre, {}).items():
+        if tipo == "categoria" and columna in df.columns:
+            df[columna] = df[columna].astype("category")
+    return df
+
+# =====================
+# LIBRO DE MOVIMIENTOS (INVENTARIO)
+# =====================
+# Valor de la columna Tipo del libro -> etiqueta en pantalla
+TIPOS_MOVIMIENTO = {"compra": "Compra", "corte": "Corte", "devolucion": "Devolución", "ajuste": "Ajuste"}
+TIPOS_MOVIMIENTO_MANUALES = ["devolucion", "ajuste"]  # Compras y cortes los registra su propio formulario
+CHECKPOINT_MOVIMIENTOS = 500  # Filas nuevas del libro tras las que se rehace el último checkpoint
+
+def _mutaciones_inventario(mapa, fecha, tipo, tipo_tela, rollos_por_color, referencia=None, costo=None):
+    """Mutaciones de un movimiento de inventario {color: rollos con signo}
+    
+    El libro Movimientos es la fuente: recibe una fila por color. Stock es la vista
+    materializada: cada movimiento solo suma su delta a la celda de (tela, color), o agrega
+    la fila si no existe. No se recorta en 0: un stock negativo queda a la vista.
+    costo: USD por rollo de una compra (lo usa la valorización del stock).
+    """
+    rollos_por_color = {color: rollos for color, rollos in rollos_por_color.items() if rollos}
+    extra = {"Costo rollo": costo} if costo is not None else {}
+    movimientos = [
+        {"Fecha": str(fecha), "Tipo": tipo, **(referencia or {}), "Tipo de tela": tipo_tela, "Color": color, "Rollos": rollos, **extra}
+        for color, rollos in rollos_por_color.items()
+    ]
+    mutaciones = [{"tipo": "agregar", "hoja": "Movimientos", "registros": movimientos}] if movimientos else []
+    return mutaciones + mapa.mutaciones(tipo_tela, rollos_por_color)
+
+def _huella_estable(*valores):
+    """Hash del contenido de una fila igual en todos los procesos (los checkpoints lo guardan
+    en la réplica): un número entero da lo mismo como int o como float, igual que en hash()"""
+    valores = tuple(int(v) if isinstance(v, float) and v.is_integer() else v for v in valores)
+    return zlib.crc32(repr(valores).encode("utf-8"))
+
+class LibroStock:
+    """Stock a cualquier fecha desde el libro Movimientos de la réplica, sin recorrerlo entero
+    
+    Checkpoints (tabla _checkpoints_stock): saldo por (tela, color) al cierre de cada mes,
+    sumando las filas del libro 1..hasta. El stock al día f es el último checkpoint con
+    fecha <= f, más las filas ya incluidas con fecha entre el checkpoint y f (índice por
+    Fecha), más las filas posteriores a hasta con fecha <= f (cargas con fecha atrasada).
+    
+    El libro solo crece. Si en Sheets se borra o edita una fila ya incluida en un
+    checkpoint, el control del último deja de coincidir y se rehacen todos.
+    """
+    COLUMNAS_CONTROL = ("Fecha", "Tipo", "Tipo de tela", "Color", "Rollos")
+    
+    def __init__(self, replica):
+        self.replica = replica
+        self.controlada = None  # Revisión del libro con la que se controlaron los checkpoints
+        with replica.lock:
+            replica.conn.create_function("huella_estable", -1, _huella_estable, deterministic=True)
+            replica.conn.execute(
+                "CREATE TABLE IF NOT EXISTS _checkpoints_stock "
+                "(fecha TEXT PRIMARY KEY, hasta INTEGER, control TEXT, saldos TEXT)"
+            )
+            replica.conn.commit()
+    
+    def disponible(self):
+        columnas = self.replica.columnas("Movimientos") or []
+        return all(c in columnas for c in ("Fecha", "Tipo de tela", "Color", "Rollos"))
+    
+    def _sumar(self, condicion, parametros=()):
+        """Rollos por (tela, color) de las filas del libro que cumplen la condición"""
+        with self.replica.lock:
+            filas = self.replica.conn.execute(
+                f'SELECT "Tipo de tela", "Color", TOTAL("Rollos") FROM "Movimientos" WHERE {condicion} GROUP BY 1, 2',
+                parametros
+            ).fetchall()
+        return {(tela, color): int(rollos) for tela, color, rollos in filas}
+    
+    def _control(self, hasta):
+        """Huella de las filas 1..hasta: cambia si se borra, se mueve o se edita alguna"""
+        presentes = self.replica.columnas("Movimientos") or []
+        columnas = ", ".join(_q(c) for c in self.COLUMNAS_CONTROL if c in presentes)
+        with self.replica.lock:
+            fila = self.replica.conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(huella_estable(_fila, {columnas})), 0) '
+                'FROM "Movimientos" WHERE _fila <= ?', (hasta,)
+            ).fetchone()
+        return json.dumps(fila)
+    
+    def _checkpoints(self):
+        with self.replica.lock:
+            return self.replica.conn.execute(
+                "SELECT fecha, hasta, control, saldos FROM _checkpoints_stock ORDER BY fecha"
+            ).fetchall()
+    
+    def _ultimo(self, fecha):
+        """Último checkpoint con fecha <= fecha: (fecha, hasta, saldos) o None"""
+        with self.replica.lock:
+            fila = self.replica.conn.execute(
+                "SELECT fecha, hasta, saldos FROM _checkpoints_stock WHERE fecha <= ? ORDER BY fecha DESC LIMIT 1",
+                (fecha,)
+            ).fetchone()
+        if fila is None:
+            return None
+        return fila[0], fila[1], {(tela, color): rollos for tela, color, rollos in json.loads(fila[2])}
+    
+    def _saldo(self, fecha, base=None):
+        """Rollos por (tela, color) al cierre de fecha, partiendo del checkpoint base"""
+        if base is None:
+            return self._sumar('"Fecha" <= ?', (fecha,))
+        fecha_base, hasta, saldos = base
+        total = defaultdict(int, saldos)
+        for parcial in (
+            self._sumar('_fila <= ? AND "Fecha" > ? AND "Fecha" <= ?', (hasta, fecha_base, fecha)),
+            self._sumar('_fila > ? AND "Fecha" <= ?', (hasta, fecha)),
+        ):
+            for clave, rollos in parcial.items():
+                total[clave] += rollos
+        return dict(total)
+    
+    def actualizar_checkpoints(self):
+        """Controla los checkpoints y agrega los de los meses cerrados desde el último
+        (no con escrituras del libro en cola: podrían deshacerse)"""
+        if not self.disponible() or "Movimientos" in init_cola().hojas_pendientes(con_fallidas=True):
+            return
+        with self.replica.lock:
+            hasta, primera = self.replica.conn.execute(
+                'SELECT COALESCE(MAX(_fila), 1), MIN("Fecha") FROM "Movimientos" WHERE "Fecha" <> \'\''
+            ).fetchone()
+        checkpoints = self._checkpoints()
+        revision = self.replica.revision("Movimientos")
+        if checkpoints and self.controlada != revision:
+            _, hasta_ultimo, control, _ = checkpoints[-1]
+            if hasta_ultimo > hasta or control != self._control(hasta_ultimo):
+                print("⚠️ El libro de movimientos cambió en Sheets: se rehacen los checkpoints de stock")
+                with self.replica.lock:
+                    self.replica.conn.execute("DELETE FROM _checkpoints_stock")
+                    self.replica.conn.commit()
+                checkpoints = []
+        self.controlada = revision
+        if primera is None:
+            return
+        
+        base = self._ultimo(checkpoints[-1][0]) if checkpoints else None
+        meses = pd.period_range(pd.Period(str(primera)[:7], "M"), pd.Period(date.today(), "M") - 1, freq="M")
+        cierres = [str(mes.end_time.date()) for mes in meses]
+        cierres = [c for c in cierres if base is None or c > base[0]]
+        if not cierres and base and hasta - base[1] >= CHECKPOINT_MOVIMIENTOS:
+            cierres = [base[0]]  # Sin meses nuevos: se rehace el último con las filas agregadas
+        if not cierres:
+            return
+        
+        control = self._control(hasta)
+        for cierre in cierres:
+            saldos = self._saldo(cierre, base)
+            with self.replica.lock:
+                self.replica.conn.execute(
+                    "INSERT OR REPLACE INTO _checkpoints_stock VALUES (?, ?, ?, ?)",
+                    (cierre, hasta, control, json.dumps([[t, c, r] for (t, c), r in saldos.items() if r]))
+                )
+                self.replica.conn.commit()
+            base = (cierre, hasta, saldos)
+        print(f"📒 Checkpoints de stock: {len(cierres)} nuevo/s (hasta {cierres[-1]})")
+    
+    def stock_al(self, fecha=None):
+        """Rollos por (tela, color) al cierre de fecha (sin fecha: todo el libro)"""
+        if not self.disponible():
+            return {}
+        self.actualizar_checkpoints()
+        fecha = str(pd.Timestamp(fecha).date()) if fecha is not None else "9999-12-31"
+        return self._saldo(fecha, self._ultimo(fecha))
+
+@st.cache_resource
+def init_libro():
+    return LibroStock(replica)
+
+libro = init_libro()
+
+def _costo_por_rollo(df_compras):
+    """USD por rollo de cada compra: Valor total / Total rollos (o el precio promedio cargado)"""
+    costo = df_compras["Valor total"] / df_compras["Total rollos"].where(df_compras["Total rollos"] > 0)
+    return costo.fillna(df_compras["Precio promedio rollo"])
+
+def movimientos_historicos():
+    """Filas del libro que reconstruyen el historial: compras y cortes que todavía no están
+    en el libro, más un ajuste con fecha de hoy por la diferencia con la hoja Stock"""
+    df_mov = cargar_hoja("Movimientos")
+    registradas = {
+        tipo: set(df_mov.loc[df_mov["Tipo"] == tipo, columna]) if not df_mov.empty else set()
+        for tipo, columna in (("compra", "ID Compra"), ("corte", "ID Corte"))
+    }
+    partes = []
+    for tipo, cabecera, detalle, columna, signo in (
+        ("compra", "Compras", "Detalle_Compras", "ID Compra", 1),
+        ("corte", "Cortes", "Detalle_Cortes", "ID Corte", -1),
+    ):
+        # Incluye los años archivados: el libro tiene que reconstruir todo el historial
+        df_cab = cargar_historico(cabecera)
+        df_det = cargar_historico(detalle)
+        if df_cab.empty or df_det.empty:
+            continue
+        cab = df_cab[["ID", "Fecha"]]
+        if tipo == "compra":
+            cab = cab.assign(**{"Costo rollo": _costo_por_rollo(df_cab)})
+        df = df_det[~df_det[columna].isin(registradas[tipo])].merge(cab, left_on=columna, right_on="ID", how="left")
+        df = df[df["Rollos"] != 0]
+        partes.append(pd.DataFrame({
+            "Fecha": df["Fecha"].fillna(pd.Timestamp(date.today())).dt.strftime("%Y-%m-%d"),
+            "Tipo": tipo,
+            columna: df[columna],
+            "Tipo de tela": df["Tipo de tela"],
+            "Color": df["Color"],
+            "Rollos": df["Rollos"] * signo,
+            **({"Costo rollo": df["Costo rollo"].round(2)} if tipo == "compra" else {}),
+        }))
+    
+    nuevos = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=COLUMNAS["Movimientos"])
+    claves = ["Tipo de tela", "Color"]
+    en_libro = pd.concat([df_mov[claves + ["Rollos"]] if not df_mov.empty else None, nuevos[claves + ["Rollos"]]])
+    en_libro = en_libro.groupby(claves)["Rollos"].sum()
+    df_stock = cargar_hoja("Stock")
+    en_stock = df_stock.groupby(claves)["Rollos"].sum() if not df_stock.empty else pd.Series(dtype="int64")
+    diferencia = en_stock.sub(en_libro, fill_value=0)
+    diferencia = diferencia[diferencia != 0]
+    ajustes = pd.DataFrame({
+        "Fecha": str(date.today()),
+        "Tipo": "ajuste",
+        "Tipo de tela": diferencia.index.get_level_values(0),
+        "Color": diferencia.index.get_level_values(1),
+        "Rollos": diferencia.astype("int64").values,
+    })
+    registros = pd.concat([nuevos, ajustes], ignore_index=True).sort_values("Fecha", kind="stable")
+    for columna in ("ID Compra", "ID Corte"):
+        if columna in registros.columns:
+            registros[columna] = registros[columna].astype("Int64")
+    return [
+        {c: v for c, v in r.items() if not pd.isna(v)}
+        for r in registros.to_dict("records")
+    ]
+
+# =====================
+# AGREGADOS DE COMPRAS
+# =====================
+DIMENSIONES_COMPRAS = ["Proveedor", "Tipo de tela", "Mes"]
+MEDIDAS_COMPRAS = ["Compras", "Metros", "Rollos", "USD"]
+
+def _agregar_compras(df):
+    """Totales por dimensión de un bloque de compras ya tipadas: {dimensión: DataFrame}"""
+    base = pd.DataFrame({
+        "Proveedor": df["Proveedor"].astype(str),
+        "Tipo de tela": df["Tipo de tela"].astype(str),
+        # Mes como número (AAAAMM): strftime por fila costaba más que todo el resto
+        "Mes": (df["Fecha"].dt.year * 100 + df["Fecha"].dt.month).fillna(0).astype("int64"),
+        "Compras": 1,
+        "Metros": df["Total metros"].fillna(0),
+        "Rollos": df["Total rollos"],
+        "USD": df["Valor total"].fillna(0),
+    })
+    totales = {dimension: base.groupby(dimension)[MEDIDAS_COMPRAS].sum() for dimension in DIMENSIONES_COMPRAS}
+    totales["Mes"].index = [f"{m // 100}-{m % 100:02d}" if m else "" for m in totales["Mes"].index]
+    totales["Mes"].index.name = "Mes"
+    return totales
+
+def _sumar_agregados(a, b):
+    return {dimension: a[dimension].add(b[dimension], fill_value=0) for dimension in DIMENSIONES_COMPRAS}
+
+def _huella_fila(*valores):
+    """Hash del contenido de una fila de la réplica (estable dentro del proceso), acotado a
+    40 bits para que SQLite pueda sumar los de toda la hoja sin desbordar"""
+    return hash(valores) & 0xFFFFFFFFFF
+
+class AcumuladorReplica:
+    """Resultado sobre una hoja de solo agregar de la réplica, al día sin recorrerla en cada carga
+    
+    Por hoja se recuerda hasta qué fila de la réplica se acumuló: como las filas solo se
+    agregan al final, con cada escritura se procesan únicamente las posteriores. Si la hoja
+    se volvió a descargar y el control de las filas ya acumuladas no coincide (se editó o se
+    borró algo en Sheets, o se deshizo una escritura), se rehace desde cero. El control es la
+    suma de un hash de cada fila con todas las columnas que se usan: cualquier cambio de
+    contenido lo mueve, aunque el texto tenga el mismo largo.
+    
+    Cada subclase define COLUMNAS (las que necesita), OPCIONALES (las que usa si la hoja las
+    tiene), _inicial() y _acumular(resultado, nuevas).
+    """
+    COLUMNAS = ()
+    OPCIONALES = ()
+    DESCRIPCION = "los acumulados"
+    
+    def __init__(self, replica):
+        self.replica = replica
+        self.lock = threading.Lock()
+        self.estados = {}  # hoja -> {"version", "descarga", "hasta", "control", "resultado"}
+        with replica.lock:
+            replica.conn.create_function("huella_fila", -1, _huella_fila, deterministic=True)
+    
+    def _control(self, hoja, desde, hasta):
+        """Huella de las filas desde+1..hasta de la réplica (se puede sumar por tramos)"""
+        presentes = self.replica.columnas(hoja) or []
+        columnas = ", ".join(_q(c) for c in (*self.COLUMNAS, *self.OPCIONALES) if c in presentes)
+        with self.replica.lock:
+            fila = self.replica.conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(huella_fila(_fila, {columnas})), 0) "
+                f"FROM {_q(hoja)} WHERE _fila > ? AND _fila <= ?",
+                (desde, hasta)
+            ).fetchone()
+        return list(fila)
+    
+    def _descarga(self, hoja):
+        """Cuándo se descargó la hoja (cambia en cada descarga, no con las escrituras locales)"""
+        with self.replica.lock:
+            fila = self.replica.conn.execute("SELECT sincronizada FROM _hojas WHERE hoja = ?", (hoja,)).fetchone()
+        return fila[0] if fila else None
+    
+    def _inicial(self):
+        raise NotImplementedError
+    
+    def _acumular(self, resultado, nuevas):
+        """Suma al resultado las filas nuevas (ya tipadas) y devuelve el resultado al día"""
+        raise NotImplementedError
+    
+    def resultado(self, hoja):
+        """Resultado al día de la hoja, o None si la hoja no está en la réplica"""
+        columnas = self.replica.columnas(hoja) or []
+        if not all(c in columnas for c in self.COLUMNAS):
+            return None
+        with self.lock:
+            version = self.replica.versiones[hoja]
+            estado = self.estados.get(hoja)
+            if estado and estado["version"] == version:
+                return estado["resultado"]
+            
+            descarga = self._descarga(hoja)
+            if estado and estado["descarga"] != descarga and self._control(hoja, 0, estado["hasta"]) != estado["control"]:
+                print(f"⚠️ {hoja} cambió en Sheets: se rehacen {self.DESCRIPCION}")
+                estado = None
+            desde = estado["hasta"] if estado else 0
+            with self.replica.lock:
+                hasta = self.replica.conn.execute(f"SELECT COALESCE(MAX(_fila), 0) FROM {_q(hoja)}").fetchone()[0]
+                nuevas = tipar_hoja(self.replica.leer(hoja, desde=desde), hoja)
+                control = self._control(hoja, desde, hasta)
+            resultado = self._acumular(estado["resultado"] if estado else self._inicial(), nuevas)
+            if estado:
+                control = [a + b for a, b in zip(estado["control"], control)]
+            self.estados[hoja] = {
+                "version": version, "descarga": descarga, "hasta": hasta, "control": control, "resultado": resultado
+            }
+            return resultado
+
+class AgregadosCompras(AcumuladorReplica):
+    """Totales de compras por proveedor, tela y mes, al día sin recorrer la hoja en cada carga
+    
+    Se lleva uno por hoja (la caliente y cada partición fría): con cada compra nueva se suman
+    únicamente las filas posteriores.
+    """
+    COLUMNAS = ("ID", "Fecha", "Proveedor", "Tipo de tela", "Total metros", "Total rollos", "Valor total")
+    DESCRIPCION = "los agregados de compras"
+    
+    def _inicial(self):
+        return None
+    
+    def _acumular(self, resultado, nuevas):
+        totales = _agregar_compras(nuevas)
+        return _sumar_agregados(resultado, totales) if resultado else totales
+    
+    def totales(self, hoja="Compras"):
+        """{dimensión: DataFrame con MEDIDAS_COMPRAS}, o None si la hoja no está en la réplica"""
+        return self.resultado(hoja)
+
+@st.cache_resource
+def init_agregados():
+    return AgregadosCompras(replica)
+
+agregados_compras = init_agregados()
 
 # =====================
-# CONFIGURACIÓN OPTIMIZADA GOOGLE SHEETS
+# VALORIZACIÓN DE STOCK (PROMEDIO PONDERADO Y FIFO)
 # =====================
-SHEET_NAME = "textil_sistema"
+class _SaldoValorizado:
+    """Rollos de un (tela, color) con su costo: promedio ponderado móvil y capas FIFO
+    
+    Los rollos que entran sin costo conocido (ajustes o devoluciones antes de cualquier
+    compra con precio) quedan pendientes y toman el costo de la primera compra que llegue.
+    Un saldo negativo (salieron más rollos de los registrados) lo cubren las entradas siguientes.
+    """
+    __slots__ = ("rollos", "pendientes", "costeados", "valor", "capas", "ultimo")
+    
+    def __init__(self):
+        self.rollos = 0        # Saldo del libro (puede ser negativo)
+        self.pendientes = 0    # Rollos en existencia todavía sin costo
+        self.costeados = 0     # Rollos en existencia con costo (= suma de las capas)
+        self.valor = 0.0       # Valor de los costeados al promedio ponderado
+        self.capas = deque()   # [rollos, costo por rollo], de la más vieja a la más nueva
+        self.ultimo = None     # Último costo por rollo (para saldos en 0 o negativos)
+    
+    def promedio(self):
+        return self.valor / self.costeados if self.costeados else self.ultimo
+    
+    def fifo(self):
+        if not self.costeados:
+            return self.ultimo
+        return sum(rollos * costo for rollos, costo in self.capas) / self.costeados
+    
+    def entrada(self, rollos, costo=None):
+        """Sin costo propio (devolución, ajuste) entra al costo promedio vigente"""
+        if costo is None:
+            costo = self.promedio()
+        cubre = min(rollos, max(-self.rollos, 0))
+        self.rollos += rollos
+        rollos -= cubre
+        if costo is None:
+            self.pendientes += rollos
+            return
+        rollos += self.pendientes
+        self.pendientes = 0
+        if rollos:
+            self.costeados += rollos
+            self.valor += rollos * costo
+            self.capas.append([rollos, costo])
+        self.ultimo = costo
+    
+    def salida(self, rollos):
+        """Salen primero los pendientes (son los más viejos) y después las capas más viejas"""
+        existencia = max(self.rollos, 0)
+        self.rollos -= rollos
+        rollos = min(rollos, existencia)
+        sin_costo = min(rollos, self.pendientes)
+        self.pendientes -= sin_costo
+        rollos = min(rollos - sin_costo, self.costeados)
+        if not rollos:
+            return
+        self.valor -= rollos * self.valor / self.costeados
+        self.costeados -= rollos
+        if not self.costeados:
+            self.valor = 0.0
+        while rollos:
+            capa = self.capas[0]
+            sale = min(rollos, capa[0])
+            capa[0] -= sale
+            rollos -= sale
+            if not capa[0]:
+                self.capas.popleft()
 
-@st.cache_resource(ttl=1800)  # 30 minutos para la conexión
-def init_connection():
-    """Conexión más robusta a Google Sheets"""
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            scope = [
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/drive"
-            ]
-            creds = Credentials.from_service_account_info(
-                st.secrets["gcp_service_account"], 
-                scopes=scope
-            )
-            client = gspread.authorize(creds)
-            
-            # Test de conexión
-            sheet = client.open(SHEET_NAME)
-            print(f"✅ Conexión exitosa a Google Sheets (intento {attempt + 1})")
-            return client
-            
-        except Exception as e:
-            if attempt == max_retries - 1:
-                st.error(f"❌ Error de conexión después de {max_retries} intentos: {str(e)}")
-                return None
-            time.sleep(2)  # Esperar antes de reintentar
+COLUMNAS_VALUACION = ["Rollos libro", "Costo promedio", "Costo FIFO"]
 
-client = init_connection()
+def _tabla_valuacion(saldos):
+    """{(tela, color): _SaldoValorizado} -> DataFrame indexado por (Tipo de tela, Color)"""
+    if not saldos:
+        return pd.DataFrame(columns=COLUMNAS_VALUACION, dtype=float)
+    return pd.DataFrame(
+        [[s.rollos, s.promedio(), s.fifo()] for s in saldos.values()],
+        index=pd.MultiIndex.from_tuples(list(saldos), names=["Tipo de tela", "Color"]),
+        columns=COLUMNAS_VALUACION, dtype=float
+    )
 
-@st.cache_data(ttl=300)  # 5 minutos de caché para datos
-def cargar_hoja(hoja_nombre):
-    """Carga una hoja completa con manejo de errores"""
-    try:
-        if not client:
-            return pd.DataFrame()
-        
-        sheet = client.open(SHEET_NAME).worksheet(hoja_nombre)
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        # Limpiar filas completamente vacías
-        df = df.dropna(how='all')
-        
-        return df
-        
-    except Exception as e:
-        print(f"⚠️ Error al cargar {hoja_nombre}: {str(e)}")
-        return pd.DataFrame()
+class ValuacionStock(AcumuladorReplica):
+    """Costo por rollo de cada (tela, color) desde el libro Movimientos, en el orden del libro
+    
+    Las compras entran a su costo por rollo (columna Costo rollo; en las filas anteriores a
+    esa columna, el de la cabecera de la compra). Cortes y ajustes negativos sacan rollos al
+    promedio vigente y consumen las capas FIFO más viejas. Con cada movimiento nuevo solo se
+    procesan las filas nuevas del libro.
+    """
+    COLUMNAS = ("Fecha", "Tipo", "Tipo de tela", "Color", "Rollos")
+    OPCIONALES = ("ID Compra", "Costo rollo")
+    DESCRIPCION = "los costos del stock"
+    
+    def __init__(self, replica, costos_compras):
+        super().__init__(replica)
+        self.costos_compras = costos_compras  # () -> {ID Compra: costo por rollo}
+    
+    def _inicial(self):
+        return {"saldos": {}, "tabla": None}
+    
+    def _acumular(self, resultado, nuevas):
+        if nuevas.empty:
+            return resultado
+        vacia = pd.Series(np.nan, index=nuevas.index)
+        costos = None
+        saldos = resultado["saldos"]
+        # Arrays de NumPy: recorrer las columnas de pandas valor por valor es varias veces más lento
+        for tipo, tela, color, rollos, costo, id_compra in zip(
+            nuevas["Tipo"].astype(str).to_numpy(), nuevas["Tipo de tela"].to_numpy(dtype=object),
+            nuevas["Color"].to_numpy(dtype=object), nuevas["Rollos"].fillna(0).to_numpy(dtype="int64"),
+            nuevas.get("Costo rollo", vacia).to_numpy(dtype=float, na_value=np.nan),
+            nuevas.get("ID Compra", vacia).to_numpy(dtype=float, na_value=np.nan)
+        ):
+            if not rollos:
+                continue
+            saldo = saldos.get((tela, color))
+            if saldo is None:
+                saldo = saldos[(tela, color)] = _SaldoValorizado()
+            if rollos < 0:
+                saldo.salida(-int(rollos))
+                continue
+            if tipo != "compra":
+                costo = None
+            elif not costo > 0:  # Fila anterior a la columna Costo rollo (o NaN)
+                if costos is None:
+                    costos = self.costos_compras()
+                costo = None if np.isnan(id_compra) else costos.get(int(id_compra))
+            else:
+                costo = float(costo)
+            saldo.entrada(int(rollos), costo)
+        resultado["tabla"] = None
+        return resultado
+    
+    def tabla(self, hoja="Movimientos"):
+        """DataFrame por (Tipo de tela, Color) con COLUMNAS_VALUACION, o None sin libro"""
+        resultado = self.resultado(hoja)
+        if resultado is None:
+            return None
+        with self.lock:
+            if resultado["tabla"] is None:
+                resultado["tabla"] = _tabla_valuacion(resultado["saldos"])
+            return resultado["tabla"]
 
-def guardar_hoja(df, hoja_nombre):
-    """Guarda DataFrame en Google Sheet"""
-    try:
-        if not client:
-            return False
-        
-        sheet = client.open(SHEET_NAME).worksheet(hoja_nombre)
-        
-        # Limpiar hoja existente
-        sheet.clear()
-        
-        # Agregar encabezados primero
-        if not df.empty:
-            headers = df.columns.tolist()
-            sheet.append_row(headers)
-            
-            # Agregar datos fila por fila
-            for _, row in df.iterrows():
-                sheet.append_row(row.tolist())
-        
-        return True
-        
-    except Exception as e:
-        st.error(f"❌ Error al guardar {hoja_nombre}: {str(e)}")
-        return False
+@st.cache_resource
+def init_valuacion():
+    # get_costos_compras se define con las demás funciones de lectura
+    return ValuacionStock(replica, lambda: get_costos_compras())
+
+valuacion_stock = init_valuacion()
 
 # =====================
 # FUNCIONES DE GUARDADO OPTIMIZADAS
 # =====================
 def insert_purchase(fecha, proveedor, tipo_tela, precio_por_metro, total_metros, lineas):
-    """Versión optimizada de inserción de compra"""
+    """Versión optimizada de inserción de compra (solo escribe lo nuevo)"""
     try:
-        # Cargar datos actuales (lotes completos)
-        df_compras = cargar_hoja("Compras")
-        df_detalle = cargar_hoja("Detalle_Compras")
-        df_stock = cargar_hoja("Stock")
-        
-        # Inicializar DataFrames si están vacíos
-        if df_compras.empty:
-            df_compras = pd.DataFrame(columns=[
-                "ID", "Fecha", "Proveedor", "Tipo de tela", "Total metros", 
-                "Precio por metro", "Total rollos", "Valor total", "Precio promedio rollo"
-            ])
-        
-        if df_detalle.empty:
-            df_detalle = pd.DataFrame(columns=["ID Compra", "Tipo de tela", "Color", "Rollos"])
+        # Stock indexado por (tela, color) (Compras y Detalle_Compras no hacen falta: solo se agregan filas)
+        mapa = mapa_stock()
         
-        if df_stock.empty:
-            df_stock = pd.DataFrame(columns=["Tipo de tela", "Color", "Rollos"])
-        
-        # Generar ID
-        compra_id = len(df_compras) + 1 if not df_compras.empty else 1
+        # Generar ID (secuencia local: no hace falta leer Compras)
+        compra_id = secuencias.siguiente("Compras")
         
         # Calcular valores
         total_rollos = sum(l["rollos"] for l in lineas)
@@ -132,44 +2706,43 @@ def insert_purchase(fecha, proveedor, tipo_tela, precio_por_metro, total_metros,
             "Precio promedio rollo": precio_promedio
         }
         
-        df_compras = pd.concat([df_compras, pd.DataFrame([nueva_compra])], ignore_index=True)
+        # 2. Agregar a Detalle_Compras (histórico): un solo bloque de registros
+        nuevos_detalles = [
+            {
+                "ID Compra": compra_id,
+                "Tipo de tela": tipo_tela,
+                "Color": l["color"],
+                "Rollos": l["rollos"]
+            }
+            for l in lineas if l["rollos"] > 0
+        ]
         
-        # 2. Agregar a Detalle_Compras (histórico)
+        # 3. Movimientos de ingreso en el libro y Stock al día (solo las celdas afectadas)
+        ingresos = defaultdict(int)
         for l in lineas:
             if l["rollos"] > 0:
-                nuevo_detalle = {
-                    "ID Compra": compra_id,
-                    "Tipo de tela": tipo_tela,
-                    "Color": l["color"],
-                    "Rollos": l["rollos"]
-                }
-                df_detalle = pd.concat([df_detalle, pd.DataFrame([nuevo_detalle])], ignore_index=True)
-        
-        # 3. Actualizar Stock
-        for l in lineas:
-            if l["rollos"] > 0:
-                mask = (df_stock["Tipo de tela"] == tipo_tela) & (df_stock["Color"] == l["color"])
-                
-                if mask.any():
-                    # Actualizar existente
-                    idx = df_stock[mask].index[0]
-                    df_stock.at[idx, "Rollos"] += l["rollos"]
-                else:
-                    # Agregar nuevo
-                    nuevo_stock = {
-                        "Tipo de tela": tipo_tela,
-                        "Color": l["color"],
-                        "Rollos": l["rollos"]
-                    }
-                    df_stock = pd.concat([df_stock, pd.DataFrame([nuevo_stock])], ignore_index=True)
-        
-        # 4. Guardar todo (una sola operación por hoja)
-        guardar_hoja(df_compras, "Compras")
-        guardar_hoja(df_detalle, "Detalle_Compras")
-        guardar_hoja(df_stock, "Stock")
-        
-        # Limpiar caché
-        st.cache_data.clear()
+                ingresos[l["color"]] += l["rollos"]
+        
+        # 4. Encolar solo el delta de la operación (se escribe en Sheets en segundo plano)
+        # El ID se verifica contra Sheets al escribir, por si otro operador ya lo usó
+        mutaciones = [
+            {"tipo": "id", "hoja": "Compras", "columna": "ID", "valor": compra_id,
+             "referencias": [["Detalle_Compras", "ID Compra"], ["Movimientos", "ID Compra"]],
+             "revision": replica.revision("Compras")},
+            {"tipo": "agregar", "hoja": "Compras", "registros": [nueva_compra]}
+        ]
+        if nuevos_detalles:
+            mutaciones.append({"tipo": "agregar", "hoja": "Detalle_Compras", "registros": nuevos_detalles})
+        mutaciones.extend(_mutaciones_inventario(
+            mapa, fecha, "compra", tipo_tela, ingresos, referencia={"ID Compra": compra_id}, costo=precio_promedio
+        ))
+        cola.encolar(f"Compra {compra_id}", mutaciones)
+        
+        # Invalidar solo lo que depende de las hojas escritas
+        invalidar_hojas("Compras", "Detalle_Compras", "Stock", "Movimientos")
+        
+        # Sumar ya la compra a los agregados (solo la fila nueva)
+        agregados_compras.totales("Compras")
         
         return True
         
@@ -178,25 +2751,13 @@ def insert_purchase(fecha, proveedor, tipo_tela, precio_por_metro, total_metros,
         return False
 
 def insert_corte(fecha, nro_corte, articulo, tipo_tela, lineas, consumo_total, prendas, consumo_x_prenda):
-    """Versión optimizada de inserción de corte"""
+    """Versión optimizada de inserción de corte (solo escribe lo nuevo)"""
     try:
-        # Cargar datos actuales (lotes completos)
-        df_cortes = cargar_hoja("Cortes")
-        df_detalle = cargar_hoja("Detalle_Cortes")
-        df_stock = cargar_hoja("Stock")
-        
-        # Inicializar DataFrames si están vacíos
-        if df_cortes.empty:
-            df_cortes = pd.DataFrame(columns=[
-                "ID", "Fecha", "Número de corte", "Artículo", "Tipo de tela",
-                "Total rollos", "Consumo total", "Prendas", "Consumo por prenda"
-            ])
+        # Stock indexado por (tela, color) (Cortes y Detalle_Cortes no hacen falta: solo se agregan filas)
+        mapa = mapa_stock()
         
-        if df_detalle.empty:
-            df_detalle = pd.DataFrame(columns=["ID Corte", "Color", "Rollos", "Tipo de tela"])
-        
-        # Generar ID
-        corte_id = len(df_cortes) + 1 if not df_cortes.empty else 1
+        # Generar ID (secuencia local: no hace falta leer Cortes)
+        corte_id = secuencias.siguiente("Cortes")
         
         total_rollos = sum(l["rollos"] for l in lineas)
         
@@ -213,36 +2774,46 @@ def insert_corte(fecha, nro_corte, articulo, tipo_tela, lineas, consumo_total, p
             "Consumo por prenda": consumo_x_prenda
         }
         
-        df_cortes = pd.concat([df_cortes, pd.DataFrame([nuevo_corte])], ignore_index=True)
-        
-        # 2. Agregar a Detalle_Cortes
-        for l in lineas:
-            nuevo_detalle = {
+        # 2. Agregar a Detalle_Cortes: todas las líneas en un solo bloque de registros
+        # (en el modo desglosado hay una línea por rollo: pueden ser cientos)
+        nuevos_detalles = [
+            {
                 "ID Corte": corte_id,
                 "Color": l["color"],
                 "Rollos": l["rollos"],
-                "Tipo de tela": tipo_tela
+                "Tipo de tela": tipo_tela,
+                "Talles": codificar_talles(l.get("talles"))
             }
-            df_detalle = pd.concat([df_detalle, pd.DataFrame([nuevo_detalle])], ignore_index=True)
+            for l in lineas
+        ]
         
-        # 3. Actualizar Stock (restar)
+        # 3. Movimientos de egreso en el libro y Stock al día (restar solo en las celdas afectadas)
+        # Sin recortar en 0: si el corte supera el stock, la diferencia queda registrada
+        egresos = defaultdict(int)
         for l in lineas:
-            mask = (df_stock["Tipo de tela"] == tipo_tela) & (df_stock["Color"] == l["color"])
-            
-            if mask.any():
-                idx = df_stock[mask].index[0]
-                nuevo_stock = df_stock.at[idx, "Rollos"] - l["rollos"]
-                df_stock.at[idx, "Rollos"] = max(0, nuevo_stock)  # No negativo
-            else:
-                st.warning(f"⚠️ No se encontró en stock: {tipo_tela} - {l['color']}")
+            egresos[l["color"]] -= l["rollos"]
+        for color, rollos in egresos.items():
+            disponible = mapa.disponible(tipo_tela, color)
+            if disponible + rollos < 0:
+                st.warning(f"⚠️ {tipo_tela} - {color}: el corte supera el stock ({disponible} rollos), queda en {disponible + rollos}")
         
-        # 4. Guardar todo (una sola operación por hoja)
-        guardar_hoja(df_cortes, "Cortes")
-        guardar_hoja(df_detalle, "Detalle_Cortes")
-        guardar_hoja(df_stock, "Stock")
+        # 4. Encolar solo el delta de la operación (se escribe en Sheets en segundo plano)
+        # El ID se verifica contra Sheets al escribir, por si otro operador ya lo usó
+        mutaciones = [
+            {"tipo": "id", "hoja": "Cortes", "columna": "ID", "valor": corte_id,
+             "referencias": [["Detalle_Cortes", "ID Corte"], ["Movimientos", "ID Corte"]],
+             "revision": replica.revision("Cortes")},
+            {"tipo": "agregar", "hoja": "Cortes", "registros": [nuevo_corte]}
+        ]
+        if nuevos_detalles:
+            mutaciones.append({"tipo": "agregar", "hoja": "Detalle_Cortes", "registros": nuevos_detalles})
+        mutaciones.extend(_mutaciones_inventario(
+            mapa, fecha, "corte", tipo_tela, egresos, referencia={"ID Corte": corte_id}
+        ))
+        cola.encolar(f"Corte {nro_corte}", mutaciones)
         
-        # Limpiar caché
-        st.cache_data.clear()
+        # Invalidar solo lo que depende de las hojas escritas
+        invalidar_hojas("Cortes", "Detalle_Cortes", "Stock", "Movimientos")
         
         return True
         
@@ -250,10 +2821,66 @@ def insert_corte(fecha, nro_corte, articulo, tipo_tela, lineas, consumo_total, p
         st.error(f"❌ Error en corte: {str(e)}")
         return False
 
+def insert_movimiento(fecha, tipo, tipo_tela, color, rollos, id_corte=None):
+    """Registra una devolución o un ajuste de stock (rollos con signo)"""
+    try:
+        referencia = {"ID Corte": id_corte} if id_corte else None
+        mutaciones = _mutaciones_inventario(mapa_stock(), fecha, tipo, tipo_tela, {color: rollos}, referencia=referencia)
+        cola.encolar(f"{TIPOS_MOVIMIENTO[tipo]} {tipo_tela} - {color} ({rollos:+d})", mutaciones)
+        
+        invalidar_hojas("Stock", "Movimientos")
+        
+        return True
+        
+    except Exception as e:
+        st.error(f"❌ Error en movimiento de stock: {str(e)}")
+        return False
+
 # =====================
 # CONSULTAS OPTIMIZADAS
 # =====================
-@st.cache_data(ttl=300)
+# Funciones cacheadas registradas por hoja de la que dependen
+_DEPENDENCIAS = defaultdict(list)
+
+CACHE_ENTRADAS = 4  # Versiones que se conservan por función cacheada
+
+def versiones_hojas(hojas):
+    """Pone al día las hojas (si cambió la revisión) y devuelve su versión local"""
+    precargar_hojas(hojas)
+    return tuple(replica.versiones[hoja] for hoja in hojas)
+
+def cache_hojas(*hojas, ttl=None, vacio=pd.DataFrame):
+    """Como st.cache_data, pero la clave incluye la versión de las hojas de las que depende
+    la función (directa o indirectamente): sin TTL fijo, se recalcula solo si cambiaron.
+    Si una hoja no está disponible se avisa y se devuelve vacio() sin guardarlo en cache."""
+    def decorador(funcion):
+        def cacheada(versiones, *args, **kwargs):
+            return funcion(*args, **kwargs)
+        # Clave de cache propia por función (si no, todas compartirían el mismo código)
+        cacheada.__qualname__ = funcion.__qualname__
+        cacheada = st.cache_data(ttl=ttl, max_entries=CACHE_ENTRADAS)(cacheada)
+        
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            try:
+                return cacheada(versiones_hojas(hojas), *args, **kwargs)
+            except HojaNoDisponible as e:
+                st.warning(f"⚠️ {str(e)}")
+                return vacio()
+        
+        envoltura.clear = cacheada.clear
+        for hoja in hojas:
+            _DEPENDENCIAS[hoja].append(cacheada)
+        return envoltura
+    return decorador
+
+def invalidar_hojas(*hojas):
+    """Vacía solo las caches que dependen de las hojas modificadas"""
+    for hoja in hojas:
+        for funcion in _DEPENDENCIAS.get(hoja, []):
+            funcion.clear()
+
+@cache_hojas("Stock")
 def get_stock_resumen():
     """Obtiene stock actual desde la hoja Stock"""
     df = cargar_hoja("Stock")
@@ -268,29 +2895,137 @@ def get_stock_resumen():
         st.error(f"❌ Faltan columnas en Stock: {missing_cols}")
         return pd.DataFrame(columns=required_cols)
     
-    # Convertir rollos a numérico y agrupar por si hay duplicados
-    df["Rollos"] = pd.to_numeric(df["Rollos"], errors="coerce").fillna(0)
+    # Agrupar por si hay duplicados (Rollos ya viene numérico del esquema)
     df_stock = df.groupby(["Tipo de tela", "Color"])["Rollos"].sum().reset_index()
     
     return df_stock
 
-@st.cache_data(ttl=300)
-def get_compras_resumen():
-    """Obtiene resumen de compras"""
-    df = cargar_hoja("Compras")
+@cache_hojas("Stock", vacio=list)
+def get_telas_existentes():
+    """Obtiene los tipos de tela existentes del STOCK"""
+    try:
+        df_stock = get_stock_resumen()
+        if not df_stock.empty and "Tipo de tela" in df_stock.columns:
+            return sorted(df_stock["Tipo de tela"].dropna().unique().tolist())
+        return []
+    except:
+        return []
+
+@cache_hojas("Stock", vacio=list)
+def get_colores_existentes():
+    """Obtiene los colores existentes del STOCK"""
+    try:
+        df_stock = get_stock_resumen()
+        if not df_stock.empty and "Color" in df_stock.columns:
+            return sorted(df_stock["Color"].dropna().unique().tolist())
+        return []
+    except:
+        return []
+
+@cache_hojas("Movimientos")
+def get_stock_al(fecha):
+    """Stock por tela y color al cierre de la fecha, desde el libro de movimientos"""
+    saldos = libro.stock_al(fecha)
+    df = pd.DataFrame(
+        [(tela, color, rollos) for (tela, color), rollos in saldos.items()],
+        columns=["Tipo de tela", "Color", "Rollos"]
+    )
+    return df.sort_values(["Tipo de tela", "Color"], ignore_index=True)
+
+@cache_hojas("Stock", "Movimientos")
+def get_auditoria_stock():
+    """Diferencias entre la hoja Stock y el saldo del libro de movimientos"""
+    claves = ["Tipo de tela", "Color"]
+    en_libro = get_stock_al(None).set_index(claves)["Rollos"]
+    en_stock = get_stock_resumen().set_index(claves)["Rollos"]
+    df = pd.DataFrame({"Stock": en_stock, "Libro": en_libro}).fillna(0).astype("int64")
+    df["Diferencia"] = df["Stock"] - df["Libro"]
+    return df[df["Diferencia"] != 0].reset_index()
+
+@cache_hojas("Compras", "Detalle_Compras", "Cortes", "Detalle_Cortes", "Stock", "Movimientos", vacio=list)
+def get_movimientos_sin_registrar():
+    """Compras y cortes del historial que todavía no están en el libro de movimientos"""
+    return [r for r in movimientos_historicos() if "ID Compra" in r or "ID Corte" in r]
+
+@cache_hojas("Compras")
+def get_compras_resumen(anios=()):
+    """Obtiene resumen de compras (los años abiertos, más los archivados que se pidan)"""
+    df = cargar_historico("Compras", anios) if anios else cargar_hoja("Compras")
     if df.empty:
         return pd.DataFrame()
     return df
 
-@st.cache_data(ttl=300)
-def get_detalle_compras():
+@cache_hojas("Compras", vacio=dict)
+def get_agregados_compras(anios=()):
+    """Totales de compras por proveedor, tela y mes (años abiertos más los archivados que se pidan)"""
+    hojas = [titulo for anio, titulo in sorted(particiones("Compras").items()) if anio in anios] + ["Compras"]
+    precargar_hojas(hojas)
+    partes = []
+    for hoja in hojas:
+        cargar_hoja(hoja)  # Por si la carga en lote falló
+        totales = agregados_compras.totales(hoja)
+        if totales is not None:
+            partes.append(totales)
+    return functools.reduce(_sumar_agregados, partes) if partes else {}
+
+@cache_hojas("Compras", vacio=dict)
+def get_costos_compras():
+    """Costo por rollo de cada compra, incluidos los años archivados: {ID: USD por rollo}"""
+    df = cargar_historico("Compras")
+    if df.empty:
+        return {}
+    df = df[df["ID"].notna()]
+    return dict(zip(df["ID"].astype(int), _costo_por_rollo(df)))
+
+@cache_hojas("Compras", "Detalle_Compras", "Cortes", "Detalle_Cortes", "Stock", "Movimientos")
+def _valuacion_historica():
+    """Costos por (tela, color) rearmando el libro desde compras y cortes: las filas que ya
+    tiene el libro más las del historial que todavía no se registraron, por fecha"""
+    movimientos = pd.DataFrame(movimientos_historicos(), columns=COLUMNAS["Movimientos"])
+    df_mov = cargar_hoja("Movimientos")
+    if not df_mov.empty:
+        en_libro = df_mov.reindex(columns=COLUMNAS["Movimientos"])
+        en_libro["Fecha"] = df_mov["Fecha"].dt.strftime("%Y-%m-%d")
+        movimientos = pd.concat([en_libro, movimientos], ignore_index=True).sort_values("Fecha", kind="stable")
+    motor = ValuacionStock(replica, get_costos_compras)
+    return _tabla_valuacion(motor._acumular(motor._inicial(), movimientos)["saldos"])
+
+def valorizar_stock(df_stock):
+    """Costo y valor (promedio ponderado y FIFO) de cada fila de una vista de Stock
+    
+    df_stock: filas de get_stock_resumen (una por tela y color, con el total de la hoja).
+    Solo se buscan en la tabla de costos las filas de la vista: O(filas filtradas). Los
+    costos salen del libro Movimientos, al día con cada compra o corte. Para las telas y
+    colores cuyo saldo en el libro no coincide con la hoja Stock (libro sin generar, o
+    generado después de operar con la app), salen del historial de compras y cortes.
+    """
+    df = df_stock[["Tipo de tela", "Color", "Rollos"]].copy()
+    claves = pd.MultiIndex.from_frame(df[["Tipo de tela", "Color"]])
+    tabla = valuacion_stock.tabla() if libro.disponible() else None
+    if tabla is None or tabla.empty:
+        costos = _valuacion_historica().reindex(claves)
+    else:
+        costos = tabla.reindex(claves)
+        distintas = costos["Rollos libro"].fillna(0).to_numpy() != df["Rollos"].fillna(0).to_numpy()
+        if distintas.any():
+            historica = _valuacion_historica().reindex(claves)
+            costos = pd.DataFrame(
+                np.where(distintas[:, None], historica.to_numpy(), costos.to_numpy()), columns=COLUMNAS_VALUACION
+            )
+    for metodo, columna in (("promedio", "Costo promedio"), ("FIFO", "Costo FIFO")):
+        df[columna] = costos[columna].to_numpy()
+        df[f"Valor {metodo}"] = df["Rollos"] * df[columna]
+    return df
+
+@cache_hojas("Detalle_Compras")
+def get_detalle_compras(anios=()):
     """Obtiene el detalle de colores por compra"""
-    df = cargar_hoja("Detalle_Compras")
+    df = cargar_historico("Detalle_Compras", anios) if anios else cargar_hoja("Detalle_Compras")
     if df.empty:
         return pd.DataFrame()
     return df
 
-@st.cache_data(ttl=3600)  # 1 hora para proveedores (cambia poco)
+@cache_hojas("Proveedores", vacio=list)
 def get_proveedores():
     """Obtiene lista de proveedores"""
     try:
@@ -300,6 +3035,8 @@ def get_proveedores():
         
         # Si no existe la hoja o columna, crear lista vacía
         return []
+    except HojaNoDisponible:
+        raise
     except:
         return []
 
@@ -322,7 +3059,7 @@ def insert_proveedor(nombre):
         
         # Guardar
         if guardar_hoja(df, "Proveedores"):
-            st.cache_data.clear()  # Limpiar caché de proveedores
+            invalidar_hojas("Proveedores")  # Limpiar caché de proveedores
             return True
         return False
         
@@ -330,15 +3067,25 @@ def insert_proveedor(nombre):
         st.error(f"❌ Error al agregar proveedor: {str(e)}")
         return False
 
-@st.cache_data(ttl=300)
-def get_cortes_resumen():
-    """Obtiene resumen de cortes"""
-    df = cargar_hoja("Cortes")
+@cache_hojas("Cortes")
+def get_cortes_resumen(anios=()):
+    """Obtiene resumen de cortes (los años abiertos, más los archivados que se pidan)"""
+    df = cargar_historico("Cortes", anios) if anios else cargar_hoja("Cortes")
     if df.empty:
         return pd.DataFrame()
     return df
 
-@st.cache_data(ttl=300)
+@cache_hojas("Detalle_Cortes")
+def get_curva_cortes(anios=()):
+    """Prendas por talle de cada corte (índice ID Corte, una columna por talle)
+    Las curvas se decodifican solo acá, cuando una vista necesita totales por talle"""
+    df = cargar_historico("Detalle_Cortes", anios) if anios else cargar_hoja("Detalle_Cortes")
+    if df.empty or "Talles" not in df.columns:
+        return pd.DataFrame(columns=[str(t) for t in TALLES])
+    curva = pd.DataFrame(matriz_talles(df["Talles"]), columns=[str(t) for t in TALLES], index=df["ID Corte"].values)
+    return curva.groupby(level=0).sum()
+
+@cache_hojas("Talleres")
 def get_talleres_data():
     """Obtiene datos de talleres"""
     df = cargar_hoja("Talleres")
@@ -346,7 +3093,44 @@ def get_talleres_data():
         return pd.DataFrame()
     return df
 
-@st.cache_data(ttl=300)
+# Columnas del tablero con su valor si la hoja Talleres no las tiene
+COLUMNAS_TABLERO = {
+    "Artículo": "Sin nombre", "Número de Corte": "", "Taller": "Sin taller", "Estado": "",
+    "Prendas Recibidas": 0, "Prendas Falladas": 0, "Fecha Envío": pd.NaT, "Fecha Entrega": pd.NaT,
+}
+
+@cache_hojas("Talleres", "Cortes")
+def get_tablero_talleres(hoy):
+    """Talleres cruzado con Cortes para el tablero (una vez por versión de los datos y por día)
+    
+    El cruce es un map por ID Corte sobre el índice de IDs de Cortes, no una búsqueda por
+    tarjeta. Agrega Prendas Totales (las del corte), Prendas Faltantes y Días Transcurridos
+    desde el envío, y deja los envíos más recientes primero.
+    """
+    df = cargar_hoja("Talleres")
+    if df.empty or "ID Corte" not in df.columns:
+        return pd.DataFrame()
+    for columna, valor in COLUMNAS_TABLERO.items():
+        if columna not in df.columns:
+            df[columna] = valor
+    
+    df_cortes = cargar_hoja("Cortes")
+    if df_cortes.empty or not df["ID Corte"].isin(df_cortes["ID"]).all():
+        df_cortes = cargar_historico("Cortes")  # Cortes entregados que ya pasaron al archivo
+    if df_cortes.empty:
+        prendas = pd.Series(dtype="int64")
+    else:
+        prendas = df_cortes.drop_duplicates("ID").set_index("ID")["Prendas"]
+    
+    df["Prendas Totales"] = df["ID Corte"].map(prendas).fillna(0).astype("int64")
+    for columna in ("Prendas Recibidas", "Prendas Falladas"):
+        df[columna] = pd.to_numeric(df[columna], errors="coerce").fillna(0).astype("int64")
+    df["Prendas Faltantes"] = df["Prendas Totales"] - df["Prendas Recibidas"] - df["Prendas Falladas"]
+    envio = pd.to_datetime(df["Fecha Envío"], errors="coerce").dt.normalize()
+    df["Días Transcurridos"] = (pd.Timestamp(hoy) - envio).dt.days.fillna(0).astype("int64")
+    return df.sort_values("Fecha Envío", ascending=False)
+
+@cache_hojas("Nombre_talleres", vacio=list)
 def get_nombre_talleres():
     """Obtiene lista de nombres de talleres"""
     try:
@@ -363,10 +3147,12 @@ def get_nombre_talleres():
             return sorted(list(set(talleres)))
         
         return []
+    except HojaNoDisponible:
+        raise
     except:
         return []
 
-@st.cache_data(ttl=300)
+@cache_hojas("Historial_Entregas")
 def get_historial_entregas():
     """Obtiene historial de entregas"""
     try:
@@ -374,10 +3160,12 @@ def get_historial_entregas():
         if df.empty:
             return pd.DataFrame()
         return df
+    except HojaNoDisponible:
+        raise
     except:
         return pd.DataFrame()
 
-@st.cache_data(ttl=300)
+@cache_hojas("Devoluciones")
 def get_devoluciones():
     """Obtiene datos de devoluciones"""
     try:
@@ -385,9 +3173,124 @@ def get_devoluciones():
         if df.empty:
             return pd.DataFrame()
         return df
+    except HojaNoDisponible:
+        raise
     except:
         return pd.DataFrame()
 
+def tarjetas_kanban(df, columna):
+    """HTML de las tarjetas de una columna del tablero ("produccion", "pendientes" o
+    "completados"): una Series de textos armada columna por columna, sin recorrer filas"""
+    def texto(valores):
+        return pd.Series(valores, index=df.index).astype(str)
+    
+    recibidas = texto(df["Prendas Recibidas"])
+    totales = texto(df["Prendas Totales"])
+    encabezado = (
+        "<strong>" + texto(df["Artículo"]) + "</strong>"
+        + "<small>Corte: " + texto(df["Número de Corte"]) + " | Taller: " + texto(df["Taller"]) + "</small>"
+    )
+    if columna == "produccion":
+        dias = df["Días Transcurridos"]
+        clase = texto(np.where(dias > 20, "corte-card urgente", "corte-card"))
+        progreso = texto(np.minimum(dias / 20, 1.0) * 100)
+        cuerpo = (
+            '<div class="progress-bar"><div class="progress-fill" style="width: ' + progreso + '%"></div></div>'
+            + "<small>Días: " + texto(dias) + "/20 | Recibidas: " + recibidas + "/" + totales + "</small>"
+        )
+    elif columna == "pendientes":
+        clase = "corte-card"
+        faltantes = df["Estado"].astype(str) == "ENTREGADO c/FALTANTES"
+        detalle = "Recibidas: " + recibidas + "/" + totales + texto(np.where(
+            faltantes,
+            " | Faltan: " + texto(df["Prendas Faltantes"]),
+            " | Falladas: " + texto(df["Prendas Falladas"]) + " | En reparación"
+        ))
+        cuerpo = (
+            "<small>" + texto(np.where(faltantes, "⚠️", "🔧")) + " " + texto(df["Estado"]) + "</small>"
+            + "<small>" + detalle + "</small>"
+        )
+    else:
+        clase = "corte-card completado"
+        entrega = pd.to_datetime(df["Fecha Entrega"], errors="coerce").dt.strftime("%Y-%m-%d").fillna("")
+        cuerpo = (
+            "<small>✅ 100% completado (" + recibidas + "/" + totales + ")</small>"
+            + "<small>Entregado: " + entrega + "</small>"
+        )
+    return '<div class="' + clase + '">' + encabezado + cuerpo + "</div>"
+
+# Tablero Kanban: columnas (clave, título, estados), tarjetas por página, órdenes y antigüedad
+COLUMNAS_KANBAN = [
+    ("produccion", "### 🟦 En Producción", ["EN PRODUCCIÓN"]),
+    ("pendientes", "### 🟨 Pendientes de Revisión", ["ENTREGADO c/FALTANTES", "ARREGLANDO FALLAS"]),
+    ("completados", "### 🟩 Completados", ["ENTREGADO"]),
+]
+TARJETAS_POR_PAGINA = 10
+ORDENES_KANBAN = {
+    "Envío más reciente": ("Fecha Envío", False),
+    "Envío más antiguo": ("Fecha Envío", True),
+    "Más días en taller": ("Días Transcurridos", False),
+    "Taller": ("Taller", True),
+    "Artículo": ("Artículo", True),
+}
+ANTIGUEDAD_KANBAN = {
+    "Todas": (None, None),
+    "Hasta 10 días": (None, 10),
+    "11 a 20 días": (11, 20),
+    "Más de 20 días (urgentes)": (21, None),
+}
+
+def filtrar_tablero(df, talleres, estados, antiguedad, orden):
+    """Filtra y ordena el tablero en bloque (máscaras sobre columnas, sin recorrer filas)"""
+    mascara = pd.Series(True, index=df.index)
+    if talleres:
+        mascara &= df["Taller"].astype(str).isin(talleres)
+    if estados:
+        mascara &= df["Estado"].astype(str).isin(estados)
+    minimo, maximo = ANTIGUEDAD_KANBAN[antiguedad]
+    if minimo is not None:
+        mascara &= df["Días Transcurridos"] >= minimo
+    if maximo is not None:
+        mascara &= df["Días Transcurridos"] <= maximo
+    columna, ascendente = ORDENES_KANBAN[orden]
+    return df[mascara].sort_values(columna, ascending=ascendente, kind="stable", na_position="last")
+
+def columna_kanban(df, clave, titulo):
+    """Una columna del tablero paginada en el servidor: la página visible sale como un único
+    bloque HTML y el cursor (página actual) queda en la sesión, así se llega a todas las tarjetas"""
+    cursor = f"pagina_kanban_{clave}"
+    paginas = max(1, -(-len(df) // TARJETAS_POR_PAGINA))
+    pagina = min(max(st.session_state.get(cursor, 0), 0), paginas - 1)
+    st.session_state[cursor] = pagina
+    desde = pagina * TARJETAS_POR_PAGINA
+    
+    st.markdown(f"{titulo} ({len(df)})")
+    if df.empty:
+        st.caption("Sin cortes con estos filtros")
+        return
+    tarjetas = tarjetas_kanban(df.iloc[desde:desde + TARJETAS_POR_PAGINA], clave)
+    st.markdown('<div class="kanban-column">' + "".join(tarjetas) + "</div>", unsafe_allow_html=True)
+    
+    if paginas > 1:
+        anterior, posicion, siguiente = st.columns([1, 2, 1])
+        with anterior:
+            if st.button("◀", key=f"{cursor}_anterior", disabled=pagina == 0):
+                st.session_state[cursor] = pagina - 1
+                st.rerun()
+        with posicion:
+            st.caption(f"Página {pagina + 1} de {paginas} · {desde + 1}-{min(desde + TARJETAS_POR_PAGINA, len(df))} de {len(df)}")
+        with siguiente:
+            if st.button("▶", key=f"{cursor}_siguiente", disabled=pagina == paginas - 1):
+                st.session_state[cursor] = pagina + 1
+                st.rerun()
+
+def selector_archivo(hoja_nombre, clave):
+    """Años archivados de la hoja que el usuario quiere sumar (por defecto, ninguno)"""
+    anios = sorted(particiones(hoja_nombre), reverse=True)
+    if not anios:
+        return ()
+    return tuple(st.multiselect("📦 Incluir años archivados", anios, key=clave))
+
 # =====================
 # INTERFAZ STREAMLIT
 # =====================
@@ -399,6 +3302,19 @@ menu = st.sidebar.radio(
     ["📥 Compras", "📊 Resumen Compras", "📦 Stock", "✂ Cortes", "🏭 Talleres", "👥 Proveedores"]
 )
 
+# Hojas que necesita cada página: se descargan juntas en un solo pedido
+HOJAS_POR_PAGINA = {
+    "📥 Compras": ["Proveedores", "Stock"],
+    "📊 Resumen Compras": ["Compras", "Detalle_Compras"],
+    "📦 Stock": ["Stock", "Compras", "Movimientos"],
+    "✂ Cortes": ["Stock", "Cortes"],
+    "🏭 Talleres": ["Cortes", "Historial_Entregas", "Devoluciones", "Talleres", "Nombre_talleres"],
+    "👥 Proveedores": ["Proveedores"],
+}
+precargar_hojas(HOJAS_POR_PAGINA[menu])
+
+FILAS_HISTORIAL = 200  # Compras que muestra el historial de Resumen Compras sin pedir todas
+
 # -------------------------------
 # COMPRAS
 # -------------------------------
@@ -412,17 +3328,6 @@ if menu == "📥 Compras":
     # --- TIPO DE TELA ---
     st.subheader("Tipo de Tela")
     
-    @st.cache_data(ttl=300)
-    def get_telas_existentes():
-        """Obtiene los tipos de tela existentes del STOCK"""
-        try:
-            df_stock = get_stock_resumen()
-            if not df_stock.empty and "Tipo de tela" in df_stock.columns:
-                return sorted(df_stock["Tipo de tela"].dropna().unique().tolist())
-            return []
-        except:
-            return []
-    
     telas_existentes = get_telas_existentes()
     
     # Selector para tipo de tela con opción de agregar nuevo
@@ -472,16 +3377,6 @@ if menu == "📥 Compras":
 
     st.subheader("Colores y rollos")
     
-    @st.cache_data(ttl=300)
-    def get_colores_existentes():
-        try:
-            df_stock = get_stock_resumen()
-            if not df_stock.empty and "Color" in df_stock.columns:
-                return sorted(df_stock["Color"].dropna().unique().tolist())
-            return []
-        except:
-            return []
-    
     colores_existentes = get_colores_existentes()
     
     lineas = []
@@ -555,11 +3450,11 @@ if menu == "📥 Compras":
             st.write(f"**Proveedor:** {proveedor}")
             st.write(f"**Fecha:** {fecha}")
         with col2:
-            st.write(f"**Total metros:** {total_metros:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
-            st.write(f"**Precio por metro:** USD {precio_por_metro:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
+            st.write(f"**Total metros:** {formato_argentino(total_metros, cero='0,00')}")
+            st.write(f"**Precio por metro:** {formato_argentino(precio_por_metro, True, cero='USD 0,00')}")
             st.write(f"**Total rollos:** {total_rollos}")
         
-        st.info(f"💲 **Valor total de la compra:** USD {total_valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."))
+        st.info(f"💲 **Valor total de la compra:** {formato_argentino(total_valor, True, cero='USD 0,00')}")
 
     if st.button("💾 Guardar compra", type="primary"):
         # Validación final
@@ -586,7 +3481,7 @@ if menu == "📥 Compras":
                 st.error(f"❌ Colores duplicados: {', '.join(set(colores_duplicados))}")
             else:
                 if insert_purchase(fecha, proveedor, tipo_tela, precio_por_metro, total_metros, lineas):
-                    st.success("✅ Compra registrada exitosamente!")
+                    st.success("✅ Compra registrada exitosamente! Se sincroniza con Google Sheets en segundo plano.")
                     st.balloons()
                     time.sleep(2)
                     st.rerun()
@@ -597,32 +3492,19 @@ if menu == "📥 Compras":
 elif menu == "📊 Resumen Compras":
     st.header("📊 Resumen de Compras")
     
-    # Obtener datos de compras y detalles
-    df_compras = get_compras_resumen()
-    df_detalle = get_detalle_compras()
+    # Obtener datos de compras y detalles (los años archivados solo si se piden)
+    anios_archivados = selector_archivo("Compras", "archivo_compras")
+    df_compras = get_compras_resumen(anios_archivados)
+    df_detalle = get_detalle_compras(anios_archivados)
     
     if not df_compras.empty:
-        # Limpiar y formatear datos
-        df_compras["Total metros"] = pd.to_numeric(df_compras["Total metros"], errors="coerce")
-        df_compras["Precio por metro"] = pd.to_numeric(df_compras["Precio por metro"], errors="coerce")
-        df_compras["Total rollos"] = pd.to_numeric(df_compras["Total rollos"], errors="coerce")
-        df_compras["Valor total"] = pd.to_numeric(df_compras["Valor total"], errors="coerce")
-        df_compras["Precio promedio rollo"] = pd.to_numeric(df_compras["Precio promedio rollo"], errors="coerce")
-        
-        # Formatear fecha
-        if "Fecha" in df_compras.columns:
-            df_compras["Fecha"] = pd.to_datetime(df_compras["Fecha"], errors='coerce')
-            df_compras["Fecha"] = df_compras["Fecha"].dt.strftime("%d/%m/%Y")
-        
-        # Función para formatear números en estilo argentino
-        def formato_argentino(valor, es_moneda=False):
-            if pd.isna(valor) or valor == 0:
-                return ""
-            formatted = f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-            return f"USD {formatted}" if es_moneda else formatted
-        
-        # Aplicar formato a las columnas numéricas
-        df_mostrar = df_compras.copy()
+        # Solo se formatean las últimas compras (el historial completo se pide aparte)
+        ver_todas = len(df_compras) > FILAS_HISTORIAL and st.checkbox(
+            f"Ver las {len(df_compras)} compras", key="historial_completo"
+        )
+        df_mostrar = df_compras.copy() if ver_todas else df_compras.tail(FILAS_HISTORIAL).copy()
+        if "Fecha" in df_mostrar.columns:
+            df_mostrar["Fecha"] = df_mostrar["Fecha"].dt.strftime("%d/%m/%Y")
         
         # Seleccionar y ordenar columnas para mostrar - AGREGAR ID PRIMERO
         columnas_mostrar = []
@@ -642,9 +3524,9 @@ elif menu == "📊 Resumen Compras":
             if col_original in df_mostrar.columns:
                 columnas_mostrar.append(col_nuevo)
                 if col_original in ["Precio por metro", "Valor total", "Precio promedio rollo"]:
-                    df_mostrar[col_nuevo] = df_mostrar[col_original].apply(lambda x: formato_argentino(x, True))
+                    df_mostrar[col_nuevo] = formato_numero(df_mostrar[col_original], moneda=True, cero="")
                 elif col_original == "Total metros":
-                    df_mostrar[col_nuevo] = df_mostrar[col_original].apply(formato_argentino)
+                    df_mostrar[col_nuevo] = formato_numero(df_mostrar[col_original], cero="")
                 elif col_original == "Total rollos":
                     df_mostrar[col_nuevo] = df_mostrar[col_original].astype(int)
                 else:
@@ -652,6 +3534,8 @@ elif menu == "📊 Resumen Compras":
         
         # Mostrar tabla principal de compras
         st.subheader("📋 Historial de Compras")
+        if len(df_mostrar) < len(df_compras):
+            st.caption(f"Últimas {len(df_mostrar)} de {len(df_compras)} compras")
         st.dataframe(df_mostrar[columnas_mostrar], use_container_width=True)
         
         # --- DETALLES DE COLORES POR COMPRA ---
@@ -659,23 +3543,18 @@ elif menu == "📊 Resumen Compras":
         st.subheader("🎨 Detalles de Colores por Compra")
         
         if not df_detalle.empty and "ID Compra" in df_detalle.columns:
-            # Crear lista de compras con ID + Tipo de Tela para mejor identificación
-            compras_con_info = []
-            for compra_id in df_compras["ID"].unique():
-                tipo_tela = df_compras[df_compras["ID"] == compra_id]["Tipo de tela"].iloc[0] if "Tipo de tela" in df_compras.columns else "N/A"
-                compras_con_info.append({
-                    "id": compra_id,
-                    "display": f"ID: {compra_id} - {tipo_tela}"
-                })
-            
-            # Ordenar por ID descendente (más reciente primero)
-            compras_con_info.sort(key=lambda x: x["id"], reverse=True)
+            # Compras con ID + Tipo de Tela para mejor identificación, la más reciente primero
+            telas_por_id = (
+                df_compras.drop_duplicates("ID").set_index("ID")["Tipo de tela"]
+                if "Tipo de tela" in df_compras.columns else pd.Series("N/A", index=df_compras["ID"].unique())
+            ).sort_index(ascending=False)
+            compras_con_info = {compra_id: f"ID: {compra_id} - {tela}" for compra_id, tela in telas_por_id.items()}
             
             if compras_con_info:
                 compra_seleccionada = st.selectbox(
                     "Selecciona una compra para ver los detalles de colores:",
-                    options=[c["id"] for c in compras_con_info],
-                    format_func=lambda x: next((c["display"] for c in compras_con_info if c["id"] == x), f"ID: {x}")
+                    options=list(compras_con_info),
+                    format_func=lambda x: compras_con_info.get(x, f"ID: {x}")
                 )
                 
                 # Filtrar detalles de la compra seleccionada
@@ -694,7 +3573,8 @@ elif menu == "📊 Resumen Compras":
                     with col3:
                         st.write(f"**Tipo de Tela:** {info_compra.get('Tipo de tela', 'N/A')}")
                     with col4:
-                        st.write(f"**Fecha:** {info_compra.get('Fecha', 'N/A')}")
+                        fecha_compra = info_compra.get("Fecha")
+                        st.write(f"**Fecha:** {fecha_compra.strftime('%d/%m/%Y') if pd.notna(fecha_compra) else 'N/A'}")
                     
                     # Mostrar tabla de colores
                     df_colores = detalle_compra[["Color", "Rollos"]].copy()
@@ -723,10 +3603,19 @@ elif menu == "📊 Resumen Compras":
         st.markdown("---")
         st.subheader("📈 Estadísticas Generales")
         
-        total_compras = len(df_compras)
-        total_inversion = df_compras["Valor total"].sum()
-        total_metros = df_compras["Total metros"].sum()
-        total_rollos = df_compras["Total rollos"].sum()
+        # Desde los agregados: no dependen de cuántas compras haya
+        agregados = get_agregados_compras(anios_archivados)
+        if agregados:
+            totales = agregados["Proveedor"].sum()
+            total_compras = int(totales["Compras"])
+            total_inversion = totales["USD"]
+            total_metros = totales["Metros"]
+            total_rollos = totales["Rollos"]
+        else:
+            total_compras = len(df_compras)
+            total_inversion = df_compras["Valor total"].sum()
+            total_metros = df_compras["Total metros"].sum()
+            total_rollos = df_compras["Total rollos"].sum()
         
         col1, col2, col3, col4 = st.columns(4)
         
@@ -735,9 +3624,23 @@ elif menu == "📊 Resumen Compras":
         with col2:
             st.metric("💰 Inversión Total", formato_argentino(total_inversion, True))
         with col3:
-            st.metric("📏 Metros Totales", f"{total_metros:,.0f}")
+            st.metric("📏 Metros Totales", formato_argentino(total_metros, decimales=0, cero="0"))
         with col4:
-            st.metric("📦 Rollos Totales", f"{total_rollos:,.0f}")
+            st.metric("📦 Rollos Totales", formato_argentino(total_rollos, decimales=0, cero="0"))
+        
+        if agregados:
+            titulos_dimension = {"Proveedor": "🏢 Por proveedor", "Tipo de tela": "🧵 Por tela", "Mes": "📅 Por mes"}
+            for tab, dimension in zip(st.tabs([titulos_dimension[d] for d in DIMENSIONES_COMPRAS]), DIMENSIONES_COMPRAS):
+                with tab:
+                    df_dimension = agregados[dimension].sort_index(ascending=dimension != "Mes")
+                    precio_metro = df_dimension["USD"] / df_dimension["Metros"].where(df_dimension["Metros"] > 0)
+                    st.dataframe(pd.DataFrame({
+                        "Compras": df_dimension["Compras"].astype(int),
+                        "Metros": formato_numero(df_dimension["Metros"], cero=""),
+                        "Rollos": df_dimension["Rollos"].astype(int),
+                        "Total USD": formato_numero(df_dimension["USD"], moneda=True, cero=""),
+                        "Precio x Metro (ponderado)": formato_numero(precio_metro, moneda=True, cero=""),
+                    }), use_container_width=True)
             
     else:
         st.info("No hay compras registradas aún.")
@@ -754,7 +3657,12 @@ elif menu == "📦 Stock":
     else:
         # Crear DataFrames separados
         df_con_stock = df[df["Rollos"] > 0]
-        df_sin_stock = df[df["Rollos"] == 0]
+        df_sin_stock = df[df["Rollos"] <= 0]
+        
+        # Sin recorte en 0: un saldo negativo indica cortes por encima del stock registrado
+        df_negativo = df[df["Rollos"] < 0]
+        if not df_negativo.empty:
+            st.warning(f"⚠️ {len(df_negativo)} combinación/es de tela y color con stock negativo (ver telas sin stock)")
         
         # Mostrar resumen rápido
         col1, col2, col3 = st.columns(3)
@@ -801,18 +3709,13 @@ elif menu == "📦 Stock":
         if not df_filtrado.empty:
             st.subheader("📋 Stock Disponible")
             
-            # Agregar indicadores visuales
-            def estilo_fila(row):
-                rollos = row["Rollos"]
-                if rollos >= 10:
-                    return "✅ Buen stock"
-                elif rollos >= 5:
-                    return "⚠️ Stock medio"
-                else:
-                    return "🔴 Stock bajo"
-            
+            # Agregar indicadores visuales (en bloque, no fila por fila)
             df_mostrar = df_filtrado.copy()
-            df_mostrar["Estado"] = df_mostrar.apply(estilo_fila, axis=1)
+            df_mostrar["Estado"] = np.select(
+                [df_mostrar["Rollos"] >= 10, df_mostrar["Rollos"] >= 5],
+                ["✅ Buen stock", "⚠️ Stock medio"],
+                default="🔴 Stock bajo"
+            )
             df_mostrar = df_mostrar[["Tipo de tela", "Color", "Rollos", "Estado"]]
             
             st.dataframe(df_mostrar, use_container_width=True, hide_index=True)
@@ -871,87 +3774,51 @@ elif menu == "📦 Stock":
             st.markdown("---")
             st.subheader("💰 Valorización del Stock")
             
-            # Obtener el resumen de compras para calcular precios promedios
-            df_compras = get_compras_resumen()
+            # Costo por rollo de cada (tela, color) de la vista: promedio ponderado y FIFO
+            formato_argentino_moneda = functools.partial(formato_argentino, es_moneda=True, cero="USD 0,00")
+            df_valor = valorizar_stock(df_filtrado)
             total_rollos_filtrado = df_filtrado["Rollos"].sum()
+            sin_costo = df_valor["Costo promedio"].isna()
             
-            # 1. Mostrar precio promedio por tipo de tela seleccionado
-            if not df_compras.empty and "Precio promedio rollo" in df_compras.columns:
-                # Función para convertir correctamente el formato argentino
-                def convertir_formato_argentino(valor):
-                    if pd.isna(valor):
-                        return 0.0
-                    if isinstance(valor, (int, float)):
-                        return float(valor)
-                    valor_str = str(valor).replace("USD", "").replace(" ", "").strip()
-                    try:
-                        # Si tiene formato 15.012,00 -> convertir a 15012.00
-                        if "." in valor_str and "," in valor_str:
-                            return float(valor_str.replace(".", "").replace(",", "."))
-                        # Si tiene formato 150,12 -> convertir a 150.12
-                        elif "," in valor_str:
-                            return float(valor_str.replace(",", "."))
-                        else:
-                            return float(valor_str)
-                    except:
-                        return 0.0
+            if sin_costo.all():
+                st.info("ℹ️ No hay información de precios para las telas seleccionadas")
+            else:
+                df_valor["Rollos costeados"] = df_valor["Rollos"].where(~sin_costo, 0)
+                valor_promedio = df_valor["Valor promedio"].sum()
+                valor_fifo = df_valor["Valor FIFO"].sum()
+                rollos_costeados = df_valor["Rollos costeados"].sum()
                 
-                # Función para formatear en estilo argentino
-                def formato_argentino_moneda(valor):
-                    if pd.isna(valor) or valor == 0:
-                        return "USD 0,00"
-                    formatted = f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-                    return f"USD {formatted}"
+                # Mostrar métricas de valorización
+                col_v1, col_v2, col_v3 = st.columns(3)
                 
-                # Convertir la columna de precios
-                df_compras["Precio promedio rollo num"] = df_compras["Precio promedio rollo"].apply(convertir_formato_argentino)
+                with col_v1:
+                    st.metric("📦 Total Rollos", total_rollos_filtrado)
                 
-                # Calcular precio promedio por tipo de tela si hay filtro
-                precios_telas = {}
-                if filtro_tela:
-                    for tela in filtro_tela:
-                        precio_promedio_tela = df_compras[
-                            df_compras["Tipo de tela"] == tela
-                        ]["Precio promedio rollo num"].mean()
-                        
-                        if not pd.isna(precio_promedio_tela) and precio_promedio_tela > 0:
-                            precio_corregido = precio_promedio_tela
-                            precios_telas[tela] = precio_corregido
+                with col_v2:
+                    st.metric("💰 Valor (promedio ponderado)", formato_argentino_moneda(valor_promedio))
                 
-                # Mostrar precios individuales si hay múltiples telas
-                if precios_telas:
-                    st.write("**Precios Promedio por Tela:**")
-                    for tela, precio in precios_telas.items():
-                        st.write(f"• **{tela}**: {formato_argentino_moneda(precio)} x rollo")
+                with col_v3:
+                    st.metric("💲 Valor (FIFO)", formato_argentino_moneda(valor_fifo))
                 
-                # 2. Calcular valor estimado CORRECTAMENTE
-                if precios_telas:
-                    if len(precios_telas) == 1:
-                        precio_promedio_global = list(precios_telas.values())[0]
-                    else:
-                        precio_promedio_global = sum(precios_telas.values()) / len(precios_telas)
-                    
-                    # Calcular valorización
-                    total_valorizado = total_rollos_filtrado * precio_promedio_global
-                    
-                    # Mostrar métricas de valorización
-                    col_v1, col_v2, col_v3 = st.columns(3)
-                    
-                    with col_v1:
-                        st.metric("📦 Total Rollos", total_rollos_filtrado)
-                    
-                    with col_v2:
-                        st.metric("💰 Precio Promedio", formato_argentino_moneda(precio_promedio_global))
-                    
-                    with col_v3:
-                        st.metric("💲 Valor Total", formato_argentino_moneda(total_valorizado))
-                    
-                    # Detalle adicional
-                    st.info(f"**Valorización calculada:** {total_rollos_filtrado} rollos × {formato_argentino_moneda(precio_promedio_global)} = **{formato_argentino_moneda(total_valorizado)}**")
-                else:
-                    st.info("ℹ️ No hay información de precios para las telas seleccionadas")
-            else:
-                st.info("ℹ️ No hay información de precios disponible para valorización")
+                st.info(
+                    f"**Valorización calculada:** {rollos_costeados} rollos × costo de cada tela y color "
+                    f"(promedio {formato_argentino_moneda(valor_promedio / rollos_costeados)} x rollo)"
+                )
+                
+                # Detalle por tela (solo las filas de la vista)
+                por_tela = df_valor.groupby("Tipo de tela")[["Rollos costeados", "Valor promedio", "Valor FIFO"]].sum()
+                por_tela = por_tela[por_tela["Rollos costeados"] > 0].sort_values("Valor promedio", ascending=False)
+                st.write("**Costo por Tela:**")
+                st.dataframe(pd.DataFrame({
+                    "Tipo de tela": por_tela.index,
+                    "Rollos": por_tela["Rollos costeados"].astype(int).values,
+                    "Costo promedio x rollo": formato_numero(por_tela["Valor promedio"] / por_tela["Rollos costeados"], moneda=True).values,
+                    "Valor (promedio)": formato_numero(por_tela["Valor promedio"], moneda=True).values,
+                    "Valor (FIFO)": formato_numero(por_tela["Valor FIFO"], moneda=True).values,
+                }), use_container_width=True, hide_index=True)
+                
+                if sin_costo.any():
+                    st.warning(f"⚠️ {sin_costo.sum()} combinación/es de tela y color sin compras con precio: no entran en el valor")
             
             # Totales generales
             st.markdown("---")
@@ -979,6 +3846,75 @@ elif menu == "📦 Stock":
             else:
                 st.success("🎉 ¡Todas las telas tienen stock disponible!")
 
+    # LIBRO DE MOVIMIENTOS
+    st.markdown("---")
+    st.subheader("📒 Libro de movimientos")
+    
+    try:
+        df_movimientos = cargar_hoja("Movimientos")
+        sin_registrar = get_movimientos_sin_registrar()
+    except HojaNoDisponible as e:
+        # Sin libro no se ofrece generarlo: se escribiría encima del que no se pudo leer
+        st.warning(f"⚠️ {str(e)}. El libro se muestra cuando se pueda volver a cargar.")
+        df_movimientos, sin_registrar = None, []
+    if df_movimientos is not None and (sin_registrar or df_movimientos.empty):
+        # Las operaciones nuevas escriben en el libro desde el primer día: mientras no se
+        # generen las anteriores, el stock a una fecha y la auditoría quedan incompletos
+        if df_movimientos.empty:
+            st.info("ℹ️ El libro de movimientos está vacío. Se puede generar desde las compras y cortes registrados; "
+                    "la diferencia con el stock actual queda como un ajuste con fecha de hoy.")
+        else:
+            st.warning(f"⚠️ {len(sin_registrar)} movimiento/s de compras y cortes anteriores al libro no están registrados: "
+                       "el stock a una fecha y la auditoría quedan incompletos hasta generarlos.")
+        if st.button("📒 Generar libro desde el historial"):
+            registros = movimientos_historicos()
+            if registros:
+                cola.encolar("Libro de movimientos inicial", [{"tipo": "agregar", "hoja": "Movimientos", "registros": registros}])
+                invalidar_hojas("Movimientos")
+                st.success(f"✅ {len(registros)} movimientos generados")
+                st.rerun()
+            else:
+                st.info("ℹ️ No hay compras, cortes ni stock para registrar")
+    if df_movimientos is not None and not df_movimientos.empty:
+        with st.expander("🕓 Stock a una fecha"):
+            fecha_stock = st.date_input("Stock al cierre del día", value=date.today(), key="fecha_stock_al")
+            df_al = get_stock_al(fecha_stock)
+            df_al = df_al[df_al["Rollos"] != 0]
+            if df_al.empty:
+                st.info("ℹ️ No había stock a esa fecha")
+            else:
+                st.metric("📦 Total Rollos", int(df_al["Rollos"].sum()))
+                st.dataframe(df_al, use_container_width=True, hide_index=True)
+        
+        with st.expander("🔎 Auditoría: Stock vs. libro"):
+            df_auditoria = get_auditoria_stock()
+            if df_auditoria.empty:
+                st.success("✅ La hoja Stock coincide con el libro de movimientos")
+            else:
+                st.warning(f"⚠️ {len(df_auditoria)} diferencia/s entre la hoja Stock y el libro")
+                st.dataframe(df_auditoria, use_container_width=True, hide_index=True)
+    
+    with st.expander("➕ Registrar devolución o ajuste"):
+        col_m1, col_m2 = st.columns(2)
+        with col_m1:
+            tipo_movimiento = st.selectbox("Tipo", TIPOS_MOVIMIENTO_MANUALES, format_func=TIPOS_MOVIMIENTO.get)
+            tela_movimiento = st.text_input("Tipo de tela", key="tela_movimiento")
+            color_movimiento = st.text_input("Color", key="color_movimiento")
+        with col_m2:
+            fecha_movimiento = st.date_input("Fecha", value=date.today(), key="fecha_movimiento")
+            rollos_movimiento = st.number_input(
+                "Rollos (+ ingresan, - salen)", value=0, step=1, key="rollos_movimiento"
+            )
+            corte_movimiento = st.number_input("ID de corte (devoluciones, opcional)", min_value=0, step=1)
+        if st.button("💾 Registrar movimiento"):
+            if not tela_movimiento.strip() or not color_movimiento.strip() or rollos_movimiento == 0:
+                st.error("❌ Completar tela, color y una cantidad de rollos distinta de 0")
+            elif insert_movimiento(
+                fecha_movimiento, tipo_movimiento, tela_movimiento.strip(), color_movimiento.strip(),
+                int(rollos_movimiento), int(corte_movimiento) or None
+            ):
+                st.success("✅ Movimiento registrado")
+
 # -------------------------------
 # CORTES (CON DESGLOSE POR ROLLOS Y TOTALES AUTOMÁTICOS)
 # -------------------------------
@@ -990,6 +3926,14 @@ elif menu == "✂ Cortes":
     articulo = st.text_input("Artículo")
 
     df_stock = get_stock_resumen()
+    try:
+        mapa = mapa_stock()
+        stock_disponible = True
+    except HojaNoDisponible as e:
+        # Sin Stock no se puede descontar el corte: el formulario se muestra sin poder guardar
+        st.warning(f"⚠️ {str(e)}. No se pueden guardar cortes hasta que Stock se pueda volver a cargar.")
+        mapa = MapaStock(pd.DataFrame())
+        stock_disponible = False
     telas = df_stock["Tipo de tela"].unique() if not df_stock.empty else []
     tipo_tela = st.selectbox("Tela usada", telas if len(telas) else ["---"])
 
@@ -1025,7 +3969,7 @@ elif menu == "✂ Cortes":
             help="""Por totales: Carga cantidades totales por color\nDesglosado por rollos: Crea una fila por cada rollo utilizado"""
         )
         
-        talles = [5, 6, 7, 8, 9, 10]
+        talles = TALLES
         lineas = []
         suma_total_color = 0
         
@@ -1071,9 +4015,8 @@ elif menu == "✂ Cortes":
                     unsafe_allow_html=True
                 )
         
-                # Stock real desde df_stock
-                stock_color = int(df_stock[(df_stock["Tipo de tela"] == tipo_tela) & 
-                                           (df_stock["Color"] == c)]["Rollos"].sum())
+                # Stock real desde el mapa indexado por (tela, color)
+                stock_color = mapa.disponible(tipo_tela, c)
         
                 # Campo manual para rollos consumidos
                 total_rollos = cols[-1].number_input(
@@ -1095,7 +4038,7 @@ elif menu == "✂ Cortes":
         
                 # Guardar info
                 tabla_data[c] = valores_fila
-                lineas.append({"color": c, "rollos": total_rollos, "tipo_tela": tipo_tela})
+                lineas.append({"color": c, "rollos": total_rollos, "tipo_tela": tipo_tela, "talles": valores_fila})
         
                 totales_x_color.append(total_color)
                 totales_rollos.append(total_rollos)
@@ -1150,8 +4093,7 @@ elif menu == "✂ Cortes":
                 st.markdown(f"### 🎨 Color: {c}")
                 
                 # Stock disponible para este color
-                stock_color = int(df_stock[(df_stock["Tipo de tela"] == tipo_tela) & 
-                                           (df_stock["Color"] == c)]["Rollos"].sum())
+                stock_color = mapa.disponible(tipo_tela, c)
                 
                 # Número de rollos a utilizar
                 num_rollos = st.number_input(
@@ -1220,7 +4162,7 @@ elif menu == "✂ Cortes":
                     total_color += total_rollo
                     
                     # Agregar a lineas (cada rollo es una línea separada)
-                    lineas.append({"color": c, "rollos": 1, "tipo_tela": tipo_tela})
+                    lineas.append({"color": c, "rollos": 1, "tipo_tela": tipo_tela, "talles": valores_rollo})
                 
                 # Guardar totales por color
                 totales_x_color[c] = total_color
@@ -1317,7 +4259,7 @@ elif menu == "✂ Cortes":
     col_btn, _ = st.columns([1, 3])
     
     with col_btn:
-        if st.button("💾 Guardar corte", type="primary", use_container_width=True):
+        if st.button("💾 Guardar corte", type="primary", use_container_width=True, disabled=not stock_disponible):
             # Validaciones
             if not colores_sel:
                 st.error("❌ Debe seleccionar al menos un color")
@@ -1334,7 +4276,7 @@ elif menu == "✂ Cortes":
                         linea["tipo_tela"] = tipo_tela
                     
                     if insert_corte(fecha, nro_corte, articulo, tipo_tela, lineas, consumo_total, prendas, consumo_x_prenda):
-                        st.success("✅ Corte registrado y stock actualizado correctamente")
+                        st.success("✅ Corte registrado y stock actualizado correctamente. Se sincroniza con Google Sheets en segundo plano.")
                         st.balloons()
                         time.sleep(2)
                         st.rerun()
@@ -1346,7 +4288,8 @@ elif menu == "✂ Cortes":
     # -------------------------------
     st.subheader("📊 Resumen de cortes registrados")
     
-    df_cortes = get_cortes_resumen()
+    anios_archivados = selector_archivo("Cortes", "archivo_cortes")
+    df_cortes = get_cortes_resumen(anios_archivados)
     
     if not df_cortes.empty:
         
@@ -1365,17 +4308,6 @@ elif menu == "✂ Cortes":
                     real_columns[key] = name
                     break
         
-        # Convertir columnas numéricas si existen
-        if 'consumo_total' in real_columns:
-            df_cortes[real_columns['consumo_total']] = pd.to_numeric(
-                df_cortes[real_columns['consumo_total']], errors="coerce"
-            )
-        
-        if 'cantidad_prendas' in real_columns:
-            df_cortes[real_columns['cantidad_prendas']] = pd.to_numeric(
-                df_cortes[real_columns['cantidad_prendas']], errors="coerce"
-            )
-        
         # Calcular consumo por prenda si no existe la columna
         if 'consumo_x_prenda' not in real_columns and 'consumo_total' in real_columns and 'cantidad_prendas' in real_columns:
             df_cortes['Consumo por prenda'] = df_cortes[real_columns['consumo_total']] / df_cortes[real_columns['cantidad_prendas']]
@@ -1386,14 +4318,13 @@ elif menu == "✂ Cortes":
         
         # Formatear columnas numéricas
         if 'consumo_total' in real_columns:
-            df_mostrar_cortes[real_columns['consumo_total']] = df_mostrar_cortes[real_columns['consumo_total']].apply(
-                lambda x: f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if pd.notna(x) else ""
-            )
+            df_mostrar_cortes[real_columns['consumo_total']] = formato_numero(df_mostrar_cortes[real_columns['consumo_total']])
         
         if 'consumo_x_prenda' in real_columns:
-            df_mostrar_cortes[real_columns['consumo_x_prenda']] = df_mostrar_cortes[real_columns['consumo_x_prenda']].apply(
-                lambda x: f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if pd.notna(x) else ""
-            )
+            df_mostrar_cortes[real_columns['consumo_x_prenda']] = formato_numero(df_mostrar_cortes[real_columns['consumo_x_prenda']])
+        
+        if "Fecha" in df_mostrar_cortes.columns:
+            df_mostrar_cortes["Fecha"] = df_mostrar_cortes["Fecha"].dt.strftime("%Y-%m-%d").fillna("")
         
         # Mostrar columnas relevantes (usar nombres reales)
         columnas_a_mostrar = []
@@ -1414,7 +4345,25 @@ elif menu == "✂ Cortes":
             total_prendas = df_cortes[real_columns['cantidad_prendas']].sum()
             consumo_promedio = total_consumo / total_prendas if total_prendas > 0 else 0
             
-            st.write(f"**Total general:** {total_prendas:,.0f} prendas, {total_consumo:,.2f} m de tela")
+            st.write(
+                f"**Total general:** {formato_argentino(total_prendas, decimales=0, cero='0')} prendas, "
+                f"{formato_argentino(total_consumo, cero='0,00')} m de tela"
+            )
+        
+        # Curva de talles: las curvas se decodifican solo si se pide la vista
+        if st.checkbox("👕 Ver prendas por talle", key="ver_curva_cortes"):
+            curva = get_curva_cortes(anios_archivados)
+            curva = curva[curva.index.isin(df_cortes["ID"])] if "ID" in df_cortes.columns else curva
+            if curva.empty or not curva.values.any():
+                st.info("Los cortes registrados no tienen curva de talles.")
+            else:
+                numeros = df_cortes.set_index("ID")["Número de corte"] if "Número de corte" in df_cortes.columns else None
+                df_curva = curva[curva.sum(axis=1) > 0].copy()
+                if numeros is not None:
+                    df_curva.index = df_curva.index.map(numeros.to_dict()).fillna("").astype(str)
+                df_curva["Total"] = df_curva.sum(axis=1)
+                df_curva.loc["Total x talle"] = df_curva.sum()
+                st.dataframe(df_curva, use_container_width=True)
                  
     else:
         st.info("No hay cortes registrados aún.")
@@ -1552,7 +4501,7 @@ elif menu == "🏭 Talleres":
         # ==============================================
         
         # Calcular métricas para el header
-        cortes_sin_asignar = df_cortes[~df_cortes["ID"].astype(str).isin(df_talleres["ID Corte"].astype(str))] if not df_talleres.empty else df_cortes
+        cortes_sin_asignar = df_cortes[~df_cortes["ID"].isin(df_talleres["ID Corte"])] if not df_talleres.empty else df_cortes
         
         en_produccion = len(df_talleres[df_talleres["Estado"] == "EN PRODUCCIÓN"]) if not df_talleres.empty else 0
         entregados = len(df_talleres[df_talleres["Estado"].str.contains("ENTREGADO", na=False)]) if not df_talleres.empty else 0
@@ -1648,7 +4597,11 @@ elif menu == "🏭 Talleres":
                     
                     if not cortes_a_asignar.empty:
                         # Cargar datos actuales de talleres
-                        df_talleres_actual = cargar_hoja("Talleres")
+                        try:
+                            df_talleres_actual = cargar_hoja("Talleres")
+                        except HojaNoDisponible as e:
+                            st.warning(f"⚠️ {str(e)}. No se asignó ningún corte.")
+                            st.stop()
                         
                         if df_talleres_actual.empty:
                             df_talleres_actual = pd.DataFrame(columns=[
@@ -1683,6 +4636,7 @@ elif menu == "🏭 Talleres":
                         if success_count > 0:
                             # Guardar en Google Sheets
                             if guardar_hoja(df_talleres_actual, "Talleres"):
+                                invalidar_hojas("Talleres")
                                 st.success(f"✅ {success_count} cortes asignados correctamente")
                                 time.sleep(2)
                                 st.rerun()
@@ -1696,171 +4650,69 @@ elif menu == "🏭 Talleres":
         # ==============================================
         st.subheader("📋 Tablero Kanban de Producción")
         
-        if not df_talleres.empty:
-            # Convertir fechas de manera segura
-            try:
-                df_talleres["Fecha Envío"] = pd.to_datetime(df_talleres["Fecha Envío"], errors='coerce')
-                df_talleres["Días Transcurridos"] = df_talleres["Fecha Envío"].apply(
-                    lambda x: (date.today() - x.date()).days if pd.notnull(x) else 0
+        # Talleres ya cruzado con Cortes: prendas totales, faltantes y días por corte
+        df_tablero = get_tablero_talleres(date.today())
+        
+        if not df_tablero.empty:
+            # Filtros y orden (se aplican a las tres columnas)
+            col_f1, col_f2, col_f3, col_f4 = st.columns(4)
+            with col_f1:
+                filtro_taller = st.multiselect(
+                    "Taller", sorted(df_tablero["Taller"].astype(str).unique()),
+                    key="kanban_taller", placeholder="Todos los talleres"
                 )
-            except Exception as e:
-                df_talleres["Días Transcurridos"] = 0
-            
-            # Ordenar cortes: los más recientes primero
-            df_talleres = df_talleres.sort_values("Fecha Envío", ascending=False)
-            
-            # Crear columnas Kanban CON SCROLL
-            col1, col2, col3 = st.columns(3)
+            with col_f2:
+                estados_tablero = [estado for _, _, estados in COLUMNAS_KANBAN for estado in estados]
+                filtro_estado = st.multiselect(
+                    "Estado", estados_tablero, key="kanban_estado", placeholder="Todos los estados"
+                )
+            with col_f3:
+                filtro_antiguedad = st.selectbox("Días desde el envío", list(ANTIGUEDAD_KANBAN), key="kanban_antiguedad")
+            with col_f4:
+                orden_tablero = st.selectbox("Ordenar por", list(ORDENES_KANBAN), key="kanban_orden")
             
-            with col1:
-                st.markdown('<div class="kanban-column">', unsafe_allow_html=True)
-                st.markdown("### 🟦 En Producción")
-                en_produccion_df = df_talleres[df_talleres["Estado"] == "EN PRODUCCIÓN"]
-                
-                # Limitar visualmente a 10 cortes, pero permitir scroll
-                cortes_mostrar = en_produccion_df.head(10)
-                
-                for idx, corte in cortes_mostrar.iterrows():
-                    # Determinar clase CSS por urgencia
-                    card_class = "corte-card"
-                    dias = corte.get("Días Transcurridos", 0)
-                    if dias > 20:
-                        card_class += " urgente"
-                    
-                    # Obtener información completa
-                    articulo = corte.get('Artículo', 'Sin nombre')
-                    taller = corte.get('Taller', 'Sin taller')
-                    nro_corte = corte.get('Número de Corte', '')
-                    prendas_recibidas = corte.get('Prendas Recibidas', 0)
-                    total_prendas = 0
-                    
-                    # Obtener total de prendas del corte original
-                    try:
-                        id_corte = corte.get('ID Corte', '')
-                        corte_original = df_cortes[df_cortes["ID"].astype(str) == str(id_corte)]
-                        if not corte_original.empty:
-                            total_prendas = int(corte_original.iloc[0].get('Prendas', 0))
-                    except:
-                        pass
-                    
-                    # Barra de progreso de días
-                    progreso_dias = min(dias / 20, 1.0)
-                    
-                    st.markdown(f'''
-                    <div class="{card_class}">
-                        <strong>{articulo}</strong>
-                        <small>Corte: {nro_corte} | Taller: {taller}</small>
-                        <div class="progress-bar">
-                            <div class="progress-fill" style="width: {progreso_dias*100}%"></div>
-                        </div>
-                        <small>Días: {dias}/20 | Recibidas: {prendas_recibidas}/{total_prendas}</small>
-                    </div>
-                    ''', unsafe_allow_html=True)
-                
-                if len(en_produccion_df) > 10:
-                    st.info(f"📜 ... y {len(en_produccion_df) - 10} cortes más (usa scroll)")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+            # Con otros filtros, cada columna vuelve a su primera página
+            firma_filtros = (tuple(filtro_taller), tuple(filtro_estado), filtro_antiguedad, orden_tablero)
+            if st.session_state.get("kanban_filtros") != firma_filtros:
+                st.session_state["kanban_filtros"] = firma_filtros
+                for clave, _, _ in COLUMNAS_KANBAN:
+                    st.session_state[f"pagina_kanban_{clave}"] = 0
             
-            with col2:
-                st.markdown('<div class="kanban-column">', unsafe_allow_html=True)
-                st.markdown("### 🟨 Pendientes de Revisión")
-                
-                # Incluir cortes con faltantes y devoluciones
-                pendientes_df = df_talleres[
-                    (df_talleres["Estado"] == "ENTREGADO c/FALTANTES") |
-                    (df_talleres["Estado"] == "ARREGLANDO FALLAS")
-                ]
-                
-                # Limitar visualmente
-                cortes_mostrar_pendientes = pendientes_df.head(10)
-                
-                for idx, corte in cortes_mostrar_pendientes.iterrows():
-                    articulo = corte.get('Artículo', 'Sin nombre')
-                    taller = corte.get('Taller', 'Sin taller')
-                    nro_corte = corte.get('Número de Corte', '')
-                    estado = corte.get('Estado', '')
-                    prendas_recibidas = int(corte.get('Prendas Recibidas', 0))
-                    prendas_falladas = int(corte.get('Prendas Falladas', 0))
-                    total_prendas = 0
-                    
-                    # Obtener total de prendas
-                    try:
-                        id_corte = corte.get('ID Corte', '')
-                        corte_original = df_cortes[df_cortes["ID"].astype(str) == str(id_corte)]
-                        if not corte_original.empty:
-                            total_prendas = int(corte_original.iloc[0].get('Prendas', 0))
-                    except:
-                        pass
-                    
-                    faltante = total_prendas - prendas_recibidas - prendas_falladas
-                    
-                    # Determinar tipo de pendiente
-                    detalle = ""
-                    if estado == "ENTREGADO c/FALTANTES":
-                        icono = "⚠️"
-                        detalle = f"Recibidas: {prendas_recibidas}/{total_prendas} | Faltan: {faltante}"
-                    elif estado == "ARREGLANDO FALLAS":
-                        icono = "🔧"
-                        detalle = f"Recibidas: {prendas_recibidas}/{total_prendas} | Falladas: {prendas_falladas} | En reparación"
-                    
-                    st.markdown(f'''
-                    <div class="corte-card">
-                        <strong>{articulo}</strong>
-                        <small>Corte: {nro_corte} | Taller: {taller}</small>
-                        <small>{icono} {estado}</small>
-                        <small>{detalle}</small>
-                    </div>
-                    ''', unsafe_allow_html=True)
-                
-                if len(pendientes_df) > 10:
-                    st.info(f"📜 ... y {len(pendientes_df) - 10} cortes más (usa scroll)")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+            df_visible = filtrar_tablero(df_tablero, filtro_taller, filtro_estado, filtro_antiguedad, orden_tablero)
             
-            with col3:
-                st.markdown('<div class="kanban-column">', unsafe_allow_html=True)
-                st.markdown("### 🟩 Completados")
-                completados_df = df_talleres[df_talleres["Estado"] == "ENTREGADO"]
-                
-                # Limitar visualmente
-                cortes_mostrar_completados = completados_df.head(10)
-                
-                for idx, corte in cortes_mostrar_completados.iterrows():
-                    articulo = corte.get('Artículo', 'Sin nombre')
-                    taller = corte.get('Taller', 'Sin taller')
-                    nro_corte = corte.get('Número de Corte', '')
-                    fecha_entrega = corte.get('Fecha Entrega', '')
-                    prendas_recibidas = int(corte.get('Prendas Recibidas', 0))
-                    total_prendas = 0
-                    
-                    # Obtener total de prendas
-                    try:
-                        id_corte = corte.get('ID Corte', '')
-                        corte_original = df_cortes[df_cortes["ID"].astype(str) == str(id_corte)]
-                        if not corte_original.empty:
-                            total_prendas = int(corte_original.iloc[0].get('Prendas', 0))
-                    except:
-                        pass
-                    
-                    st.markdown(f'''
-                    <div class="corte-card completado">
-                        <strong>{articulo}</strong>
-                        <small>Corte: {nro_corte} | Taller: {taller}</small>
-                        <small>✅ 100% completado ({prendas_recibidas}/{total_prendas})</small>
-                        <small>Entregado: {fecha_entrega}</small>
-                    </div>
-                    ''', unsafe_allow_html=True)
-                
-                if len(completados_df) > 10:
-                    st.info(f"📜 ... y {len(completados_df) - 10} cortes más (usa scroll)")
-                
-                st.markdown('</div>', unsafe_allow_html=True)
+            # Columnas Kanban: una página por columna, con scroll dentro de la página
+            for columna, (clave, titulo, estados) in zip(st.columns(3), COLUMNAS_KANBAN):
+                with columna:
+                    columna_kanban(df_visible[df_visible["Estado"].isin(estados)], clave, titulo)
 
 # =====================
 # BOTÓN DE ACTUALIZACIÓN GLOBAL
 # =====================
+# =====================
+# ESTADO DE LA COLA DE ESCRITURA
+# =====================
+estado_cola = cola.resumen()
+if estado_cola.get("pendiente"):
+    st.sidebar.info(f"⏳ {estado_cola['pendiente']} escritura(s) pendiente(s) de sincronizar")
+if estado_cola.get("fallida"):
+    st.sidebar.error(f"❌ {estado_cola['fallida']} escritura(s) fallida(s)")
+    st.sidebar.caption("No están en Google Sheets: las hojas muestran lo que hay allá hasta reintentarlas.")
+    with st.sidebar.expander("Ver escrituras fallidas"):
+        for op_id, descripcion, error in cola.fallidas():
+            st.write(f"**{descripcion}:** {error}")
+            if st.button("↩️ Deshacer", key=f"deshacer_{op_id}"):
+                cola.deshacer(op_id)
+                st.rerun()
+    if st.sidebar.button("🔁 Reintentar escrituras fallidas", key="reintentar_cola"):
+        cola.reintentar_fallidas()
+        st.rerun()
+
 if st.sidebar.button("🔄 Actualizar todos los datos", key="refresh_all"):
+    # Las hojas con escrituras pendientes se conservan: descartarlas ocultaría esos datos
+    pendientes = cola.hojas_pendientes()
+    for hoja in HOJAS_REPLICA:
+        if hoja not in pendientes:
+            replica.descartar(hoja)
     st.cache_data.clear()
     st.success("✅ Caché limpiado. Los datos se recargarán.")
     st.rerun()
@@ -1868,7 +4720,7 @@ if st.sidebar.button("🔄 Actualizar todos los datos", key="refresh_all"):
 # =====================
 # VERIFICACIÓN DE CONEXIÓN
 # =====================
-if client is None:
+if backend is None:
     st.error("❌ No se pudo conectar a Google Sheets. Verifica las credenciales y la conexión a internet.")
     st.stop()
 
@@ -0,0 +1,115 @@
+"""Formato numérico argentino (1.234,56 / USD 1.234,56): formateo y lectura vectorizados
+
+Trabajan sobre Series completas. Cada valor distinto se convierte una sola vez (precios,
+metros y rollos se repiten mucho) y sin formatear valor por valor en Python.
+"""
+import functools
+
+import numpy as np
+import pandas as pd
+
+# Unidades (valor x 10^decimales) por encima de este límite no entran en int64: van por Python
+LIMITE_UNIDADES = 2 ** 62
+
+def _formatear_python(valor, decimales):
+    """Un valor con el f-string de Python, cambiando separadores al estilo argentino"""
+    return f"{valor:,.{decimales}f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+def _formatear(valores, decimales):
+    """Array de floats -> array de textos "1.234,56" (sin prefijo); "" para NaN e infinitos
+
+    Los valores enormes (más allá de int64) se formatean con Python; el resto, en bloque.
+    """
+    salida = np.full(len(valores), "", dtype=object)
+    escalado = np.abs(valores) * 10 ** decimales
+    finitos = np.isfinite(escalado)
+    normales = finitos & (escalado < LIMITE_UNIDADES)
+    for i in np.flatnonzero(finitos & ~normales):
+        salida[i] = _formatear_python(valores[i], decimales)
+    if normales.any():
+        salida[normales] = _formatear_bloque(valores[normales], escalado[normales], decimales)
+    return salida
+
+def _formatear_bloque(valores, escalado, decimales):
+    """Array de floats finitos -> array de textos "1.234,56" (sin prefijo)
+
+    Se arma una matriz de caracteres (una fila por valor) con aritmética de NumPy: dígitos,
+    puntos de miles, coma y decimales. Los NUL sobrantes a la derecha desaparecen al leerla
+    como texto.
+
+    Redondea igual que el f-string (el valor binario exacto, mitad al par): sumar 0,5 y
+    truncar coincide salvo en los valores que caen a un pelo de la mitad (2.675 es en
+    realidad 2.67499...), y esos pocos se redondean con Python.
+    """
+    escala = 10 ** decimales
+    unidades = np.floor(escalado + 0.5).astype(np.int64)
+    dudosos = np.abs(escalado - np.floor(escalado) - 0.5) <= escalado * 1e-15 + 1e-12
+    for i in np.flatnonzero(dudosos):
+        unidades[i] = int(f"{abs(valores[i]):.{decimales}f}".replace(".", ""))
+    enteros = unidades // escala
+    negativos = ((valores < 0) & (unidades > 0)).astype(np.int64)
+    cifras = 1 + (enteros[:, None] >= 10 ** np.arange(1, 19, dtype=np.int64)).sum(axis=1)
+    puntos = (cifras - 1) // 3
+    ancho_enteros = int(cifras.max())
+    ancho = 1 + ancho_enteros + (ancho_enteros - 1) // 3 + (1 + decimales if decimales else 0)
+    salida = np.zeros((len(valores), ancho), dtype=np.uint32)
+    
+    # Dígitos de la parte entera (alineados a derecha en la matriz de potencias)
+    potencias = 10 ** np.arange(ancho_enteros - 1, -1, -1, dtype=np.int64)
+    digitos = (enteros[:, None] // potencias) % 10
+    fila, columna = np.nonzero(np.arange(ancho_enteros) >= (ancho_enteros - cifras)[:, None])
+    restantes = ancho_enteros - 1 - columna  # Dígitos a la derecha de cada uno
+    posicion = negativos[fila] + (columna - (ancho_enteros - cifras[fila])) + puntos[fila] - restantes // 3
+    salida[fila, posicion] = digitos[fila, columna] + ord("0")
+    miles = (restantes % 3 == 0) & (restantes > 0)
+    salida[fila[miles], posicion[miles] + 1] = ord(".")
+    salida[negativos == 1, 0] = ord("-")
+    
+    if decimales:
+        filas = np.arange(len(valores))
+        coma = negativos + cifras + puntos
+        salida[filas, coma] = ord(",")
+        for d in range(decimales):
+            salida[filas, coma + 1 + d] = (unidades // 10 ** (decimales - 1 - d)) % 10 + ord("0")
+    return salida.view(f"U{ancho}").ravel().astype(object)
+
+def formato_numero(serie, decimales=2, moneda=False, cero=None):
+    """Formatea una Series numérica en estilo argentino (vacío para NaN e infinitos)
+
+    moneda: antepone "USD "; cero: texto para los ceros (None: se formatean como el resto)
+    """
+    serie = serie if isinstance(serie, pd.Series) else pd.Series(serie)
+    codigos, unicos = pd.factorize(pd.to_numeric(serie, errors="coerce"))
+    unicos = np.asarray(unicos, dtype=float)
+    textos = _formatear(unicos, decimales)
+    if moneda:
+        textos = np.where(textos == "", "", "USD " + textos)
+    if cero is not None:
+        textos = np.where(unicos == 0, cero, textos)
+    # El código -1 (NaN) toma el último elemento: el texto vacío
+    return pd.Series(np.append(textos, "")[codigos], index=serie.index, dtype=object)
+
+@functools.lru_cache(maxsize=4096)
+def formato_argentino(valor, es_moneda=False, decimales=2, cero=""):
+    """Formatea un valor suelto (métricas, textos): cero y NaN dan `cero` (infinito, "")"""
+    if pd.isna(valor) or valor == 0:
+        return cero
+    return formato_numero(pd.Series([valor]), decimales, es_moneda).iloc[0]
+
+def parsear_numero(serie):
+    """Convierte números o textos en formato argentino ("USD 15.012,00", "150,12") a float"""
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float)
+    codigos, unicos = pd.factorize(serie)
+    unicos = pd.Series(unicos, dtype=object)
+    numeros = pd.to_numeric(unicos, errors="coerce")
+    pendientes = numeros.isna() & (unicos.astype(str).str.strip() != "")
+    if pendientes.any():
+        texto = unicos[pendientes].astype(str).str.replace("USD", "", regex=False)
+        texto = texto.str.replace(" ", "", regex=False).str.strip()
+        # 15.012,00 -> 15012.00 ; 150,12 -> 150.12
+        con_miles = texto.str.contains(".", regex=False) & texto.str.contains(",", regex=False)
+        texto = texto.where(~con_miles, texto.str.replace(".", "", regex=False))
+        numeros[pendientes] = pd.to_numeric(texto.str.replace(",", ".", regex=False), errors="coerce")
+    # El código -1 (vacío) toma el último elemento: NaN
+    return pd.Series(np.append(numeros.to_numpy(dtype=float), np.nan)[codigos], index=serie.index)
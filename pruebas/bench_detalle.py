@@ -0,0 +1,90 @@
+"""Microbenchmark del detalle de un corte con 10, 100 y 1000 líneas
+
+- Armar Detalle_Cortes: pd.concat por línea (como era antes) vs. un solo bloque de registros
+- encolar la transacción (diario + réplica), sin el hilo que la escribe en Sheets
+- _valor_celda por celda, con y sin el atajo para str/int
+- Replica.reemplazar de una hoja de 10000 filas x 4 columnas
+
+Uso: python pruebas/bench_detalle.py [--repeticiones 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import timeit
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from entorno import cargar_app
+
+COLORES = ["Rojo", "Azul", "Negro"]
+
+def _valor_celda_sin_atajo(valor):
+    """_valor_celda antes del atajo para str/int (referencia de la medición)"""
+    if isinstance(valor, np.generic):
+        valor = valor.item()
+    if pd.isna(valor):
+        return ""
+    if isinstance(valor, (datetime, date)):
+        return valor.strftime("%Y-%m-%d")
+    return valor
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticiones", type=int, default=3, help="Se informa la mejor")
+    args = parser.parse_args()
+
+    app = cargar_app()
+    directorio = tempfile.mkdtemp(prefix="bench_")
+
+    def medir(funcion, numero):
+        """Mejor tiempo por llamada, en ms"""
+        return min(timeit.repeat(funcion, number=numero, repeat=args.repeticiones)) / numero * 1000
+
+    def por_concat(lineas, corte_id=99, tela="Lino"):
+        df_detalle = pd.DataFrame(columns=app["COLUMNAS"]["Detalle_Cortes"])
+        for l in lineas:
+            nuevo = {"ID Corte": corte_id, "Color": l["color"], "Rollos": l["rollos"], "Tipo de tela": tela}
+            df_detalle = pd.concat([df_detalle, pd.DataFrame([nuevo])], ignore_index=True)
+        return df_detalle
+
+    def en_bloque(lineas, corte_id=99, tela="Lino"):
+        return [
+            {"ID Corte": corte_id, "Color": l["color"], "Rollos": l["rollos"], "Tipo de tela": tela,
+             "Talles": app["codificar_talles"](l.get("talles"))}
+            for l in lineas
+        ]
+
+    print("Detalle_Cortes        concat por línea   bloque     encolar")
+    for n in (10, 100, 1000):
+        lineas = [{"color": COLORES[i % 3], "rollos": 1} for i in range(n)]
+        concat = medir(lambda: por_concat(lineas), 1 if n == 1000 else 3)
+        bloque = medir(lambda: en_bloque(lineas), 200)
+        replica = app["Replica"](os.path.join(directorio, f"encolar{n}.db"))
+        cola = app["ColaEscritura"](replica)
+        with contextlib.redirect_stdout(io.StringIO()):  # encolar avisa cada transacción
+            encolar = medir(
+                lambda: cola.encolar("Corte", [{"tipo": "agregar", "hoja": "Detalle_Cortes", "registros": en_bloque(lineas)}]),
+                20
+            )
+        print(f"{n:5d} líneas      {concat:12.2f} ms {bloque:9.3f} ms {encolar:8.2f} ms")
+
+    celdas = ["Lino", 3, "Rojo", 12, "2025-02-01"] * 2000
+    con_atajo = medir(lambda: [app["_valor_celda"](v) for v in celdas], 20)
+    sin_atajo = medir(lambda: [_valor_celda_sin_atajo(v) for v in celdas], 20)
+    print(f"_valor_celda, {len(celdas)} celdas: {sin_atajo:.2f} ms sin atajo -> {con_atajo:.2f} ms")
+
+    df = pd.DataFrame({
+        "Tipo de tela": ["Lino"] * 10000,
+        "Color": [COLORES[i % 3] for i in range(10000)],
+        "Rollos": list(range(10000)),
+        "Fecha": ["2025-02-01"] * 10000,
+    })
+    replica = app["Replica"](os.path.join(directorio, "reemplazar.db"))
+    print(f"Replica.reemplazar, 10000 filas x 4 columnas: {medir(lambda: replica.reemplazar('Stock', df), 5):.1f} ms")
+
+if __name__ == "__main__":
+    main()
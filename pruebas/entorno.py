@@ -0,0 +1,37 @@
+"""Carga app.py con el backend falso, fuera de Streamlit, para pruebas y mediciones
+
+Todo queda en un directorio temporal: el spreadsheet simulado (JSON), la réplica SQLite y
+los snapshots. No toca Google Sheets ni los archivos de la app.
+"""
+import json
+import logging
+import os
+import runpy
+import sys
+import tempfile
+import warnings
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def cargar_app(hojas=None):
+    """Ejecuta app.py con TEXTIL_BACKEND=falso y devuelve sus variables globales
+    hojas: contenido inicial del spreadsheet {hoja: [encabezados, fila, ...]}"""
+    directorio = tempfile.mkdtemp(prefix="textil_")
+    ruta_falso = os.path.join(directorio, "spreadsheet.json")
+    if hojas:
+        with open(ruta_falso, "w", encoding="utf-8") as f:
+            json.dump(hojas, f, ensure_ascii=False)
+    os.environ.update({
+        "TEXTIL_BACKEND": "falso",
+        "TEXTIL_FAKE_PATH": ruta_falso,
+        "TEXTIL_REPLICA_PATH": os.path.join(directorio, "replica.db"),
+        "TEXTIL_SNAPSHOT_DIR": os.path.join(directorio, "snapshots"),
+        "TEXTIL_CUOTA_MINUTO": "100000",
+        "TEXTIL_ARCHIVO_AUTOMATICO": "0",
+    })
+    # Sin contexto de Streamlit, cada st.* avisa por el log: se silencia
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings("ignore")
+    if RAIZ not in sys.path:
+        sys.path.insert(0, RAIZ)
+    return runpy.run_path(os.path.join(RAIZ, "app.py"), run_name="app")
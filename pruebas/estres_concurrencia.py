@@ -0,0 +1,240 @@
+"""Estrés de escrituras concurrentes: varios operadores contra un mismo spreadsheet
+
+Cada operador es un proceso con su propia app cargada (réplica, cola de escritura, secuencia
+de IDs y cachés), como dos sesiones en servidores distintos. Todos comparten un único
+BackendFalso, que este proceso sirve por un BaseManager, y cargan compras y cortes con las
+funciones reales insert_purchase e insert_corte. Primero todos compran a la vez el mismo
+color nuevo (la fila de Stock se agrega en cada sesión) y después hacen operaciones al
+azar, con colores nuevos compartidos entre operadores. Al final se comprueba:
+
+- IDs únicos en Compras y Cortes, y ningún detalle o movimiento sin su cabecera
+- Stock exacto: inicial + compras - cortes, sin filas repetidas por (tela, color)
+- El libro Movimientos suma lo mismo que la diferencia de Stock
+
+Uso: python pruebas/estres_concurrencia.py [--operadores 3] [--operaciones 12] [--semilla 0]
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from multiprocessing.managers import BaseManager
+
+from entorno import cargar_app
+
+TELAS = ["Lino", "Jersey", "Frisa"]
+COLORES = ["Rojo", "Azul", "Negro", "Blanco"]
+NUEVOS = ["Nuevo1", "Nuevo2"]  # Colores que no están en Stock: cualquiera los puede agregar
+HOJAS = ["Compras", "Detalle_Compras", "Stock", "Cortes", "Detalle_Cortes", "Movimientos"]
+CLAVE = b"estres"
+
+class BackendCompartido:
+    """Lado servidor: ejecuta las llamadas en el BackendFalso compartido. ConflictoEscritura
+    se devuelve como valor porque al serializarla se perderían los valores actuales"""
+
+    def __init__(self, falso, conflicto):
+        self.falso = falso
+        self.conflicto = conflicto
+
+    def llamar(self, metodo, *args):
+        try:
+            return "ok", getattr(self.falso, metodo)(*args)
+        except self.conflicto as e:
+            return "conflicto", (str(e), e.actuales)
+
+class BackendRemoto:
+    """Lado operador: reemplaza al BackendFalso dentro del BackendPlanificado de la app"""
+
+    def __init__(self, proxy, conflicto):
+        self.proxy = proxy
+        self.conflicto = conflicto
+
+    def __getattr__(self, metodo):
+        def llamar(*args):
+            estado, resultado = self.proxy.llamar(metodo, *args)
+            if estado == "conflicto":
+                raise self.conflicto(*resultado)
+            return resultado
+        return llamar
+
+class Servidor(BaseManager):
+    pass
+
+class Cliente(BaseManager):
+    pass
+
+Cliente.register("backend")
+
+def operador(args):
+    """Proceso de un operador: opera con la app real y deja lo esperado en args.salida"""
+    app = cargar_app()
+    host, puerto = args.direccion.split(":")
+    cliente = Cliente(address=(host, int(puerto)), authkey=CLAVE)
+    cliente.connect()
+    # La app arrancó contra su propio spreadsheet vacío: se descarta todo lo que leyó
+    app["backend"].base = BackendRemoto(cliente.backend(), app["ConflictoEscritura"])
+    app["replica"].descartar()
+    app["_cache_tipada"]().clear()
+    app["_cache_mapa_stock"]().clear()
+    app["_estado_arranque"]()["revalidado"] = True
+    app["_estado_revision"]().update(valor=None, consultada=0.0)
+
+    rnd = random.Random(args.semilla * 100 + args.operador)
+    esperado = collections.Counter()
+    fallidas = 0
+
+    def compra(tela, color, rollos):
+        nonlocal fallidas
+        if app["insert_purchase"](date(2025, 2, 1), "P", tela, 2.0, 10.0, [{"color": color, "rollos": rollos}]):
+            esperado[(tela, color)] += rollos
+        else:
+            fallidas += 1
+
+    time.sleep(max(0.0, args.inicio - time.time()))
+    # Todos a la vez: el mismo color nuevo, que ninguna sesión tiene en su Stock
+    compra("Lino", "Compartido", args.operador + 1)
+    for k in range(args.operaciones):
+        tela = rnd.choice(TELAS)
+        if rnd.random() < 0.6:
+            color = rnd.choice(NUEVOS) if rnd.random() < 0.2 else rnd.choice(COLORES)
+            compra(tela, color, rnd.randint(1, 5))
+        else:
+            color = rnd.choice(COLORES)
+            if app["insert_corte"](date(2025, 2, 1), f"X{args.operador}-{k}", "A", tela, [{"color": color, "rollos": 1}], 1.0, 1, 1.0):
+                esperado[(tela, color)] -= 1
+            else:
+                fallidas += 1
+        time.sleep(rnd.random() * 0.05)
+
+    limite = time.time() + 300
+    while app["cola"].resumen().get("pendiente") and time.time() < limite:
+        time.sleep(0.2)
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump({
+            "esperado": [[t, c, r] for (t, c), r in esperado.items()],
+            "fallidas": fallidas,
+            "cola": app["cola"].resumen(),
+        }, f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--operadores", type=int, default=3)
+    parser.add_argument("--operaciones", type=int, default=12, help="Operaciones por operador")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--latencia", type=float, default=0.01, help="Segundos por llamada al backend")
+    parser.add_argument("--verboso", action="store_true", help="Muestra el log de la app de cada operador")
+    # Uso interno: cada operador se lanza con estos argumentos
+    parser.add_argument("--operador", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--direccion", help=argparse.SUPPRESS)
+    parser.add_argument("--inicio", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--salida", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.operador is not None:
+        with contextlib.nullcontext() if args.verboso else contextlib.redirect_stdout(io.StringIO()):
+            operador(args)
+        return
+
+    stock_inicial = [["Tipo de tela", "Color", "Rollos"]] + [[t, c, 20] for t in TELAS for c in COLORES]
+    app = cargar_app({"Stock": stock_inicial})
+    falso = app["backend"].base
+    for hoja in HOJAS:
+        if not falso.hojas.get(hoja):
+            falso.hojas[hoja] = [app["COLUMNAS"][hoja]]
+    falso._persistir()
+    falso.latencia = args.latencia
+
+    compartido = BackendCompartido(falso, app["ConflictoEscritura"])
+    Servidor.register("backend", callable=lambda: compartido)
+    servidor = Servidor(address=("127.0.0.1", 0), authkey=CLAVE).get_server()
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    host, puerto = servidor.address
+
+    directorio = tempfile.mkdtemp(prefix="estres_")
+    # Los operadores tardan en cargar la app: arrancan todos juntos en este instante
+    inicio = time.time() + 5 + args.operadores
+    procesos = []
+    for n in range(args.operadores):
+        salida = os.path.join(directorio, f"operador{n}.json")
+        comando = [
+            sys.executable, os.path.abspath(__file__), "--operador", str(n), "--direccion", f"{host}:{puerto}",
+            "--inicio", str(inicio), "--salida", salida, "--operaciones", str(args.operaciones),
+            "--semilla", str(args.semilla),
+        ] + (["--verboso"] if args.verboso else [])
+        procesos.append((subprocess.Popen(comando), salida))
+
+    esperado = collections.Counter({(t, c): r for t, c, r in stock_inicial[1:]})
+    errores = []
+    fallidas = 0
+    for n, (proceso, salida) in enumerate(procesos):
+        if proceso.wait() != 0 or not os.path.exists(salida):
+            errores.append(f"el operador {n} terminó con error")
+            continue
+        with open(salida, encoding="utf-8") as f:
+            resultado = json.load(f)
+        for t, c, r in resultado["esperado"]:
+            esperado[(t, c)] += r
+        fallidas += resultado["fallidas"]
+        if resultado["cola"]:
+            errores.append(f"cola del operador {n} sin drenar: {resultado['cola']}")
+    print(f"⏱️ {args.operadores} operadores x {args.operaciones} operaciones: {time.time() - inicio:.1f} s")
+    if fallidas:
+        errores.append(f"{fallidas} operaciones no se pudieron encolar")
+
+    def filas(hoja):
+        return app["_registros"](falso.hojas[hoja])
+
+    stock = filas("Stock")
+    claves = [(r["Tipo de tela"], r["Color"]) for r in stock]
+    if len(claves) != len(set(claves)):
+        repetidas = [k for k, n in collections.Counter(claves).items() if n > 1]
+        errores.append(f"filas de Stock repetidas: {repetidas}")
+    final = collections.Counter()
+    for r in stock:
+        final[(r["Tipo de tela"], r["Color"])] += r["Rollos"]
+    distintos = {k: (final.get(k), v) for k, v in esperado.items() if final.get(k) != v}
+    if distintos:
+        errores.append(f"Stock distinto de lo esperado (real, esperado): {distintos}")
+
+    for cabecera, detalle, columna in (("Compras", "Detalle_Compras", "ID Compra"), ("Cortes", "Detalle_Cortes", "ID Corte")):
+        ids = [r["ID"] for r in filas(cabecera)]
+        if len(ids) != len(set(ids)):
+            repetidos = [i for i, n in collections.Counter(ids).items() if n > 1]
+            errores.append(f"IDs repetidos en {cabecera}: {repetidos}")
+        huerfanos = {r[columna] for r in filas(detalle)} - set(ids)
+        huerfanos |= {r[columna] for r in filas("Movimientos") if r[columna] != ""} - set(ids)
+        if huerfanos:
+            errores.append(f"{detalle}/Movimientos con {columna} sin cabecera: {huerfanos}")
+
+    totales = {r["ID"]: r["Total rollos"] for r in filas("Compras")}
+    por_compra = collections.Counter()
+    for r in filas("Detalle_Compras"):
+        por_compra[r["ID Compra"]] += r["Rollos"]
+    if any(totales.get(k) != v for k, v in por_compra.items()):
+        errores.append("el detalle de alguna compra no suma su Total rollos")
+
+    libro = collections.Counter()
+    for r in filas("Movimientos"):
+        libro[(r["Tipo de tela"], r["Color"])] += r["Rollos"]
+    iniciales = {(t, c): r for t, c, r in stock_inicial[1:]}
+    diferencia = {k: v - iniciales.get(k, 0) for k, v in final.items() if v != iniciales.get(k, 0)}
+    if {k: v for k, v in libro.items() if v} != diferencia:
+        errores.append("el libro Movimientos no coincide con la diferencia de Stock")
+
+    print(f"Compras {len(filas('Compras'))} · Cortes {len(filas('Cortes'))} · Movimientos {len(filas('Movimientos'))}")
+    if errores:
+        for error in errores:
+            print(f"❌ {error}")
+        sys.exit(1)
+    print("✅ IDs únicos, Stock exacto y libro consistente")
+
+if __name__ == "__main__":
+    main()